@@ -1,83 +1,83 @@
-
 from pyesi.generator import *
 
-#take input from user
-name = input("Enter the name of the orbita: ")
-orbita_type = int(input("Enter the number of orbita: "))
-
-
-# Generate XML for the master with two slaves
-esi = ESI()
-esi.vendor_id = "0xF3F"
-esi.vendor_name = "Pollen Robotcs SAS"
-esi.group_name = "Pollen PYESI"
-# esi.devices = []
-
-slave = Device()
-slave.name = f"{name}Orbita{orbita_type}d"
-
-slave.sync_managers= [
-    SyncManager("MBoxOut",1000, SyncManagerType.MAILBOX, SyncManagerDir.Rx, 128),
-    SyncManager("MBoxIn",1180, SyncManagerType.MAILBOX, SyncManagerDir.Tx, 128),
-    SyncManager("OrbitaIn",1300, SyncManagerType.BUFFERED, SyncManagerDir.Rx),
-    SyncManager("OrbitaOut",1400, SyncManagerType.BUFFERED, SyncManagerDir.Tx),
-]
-
-
-pdos = PDOs()
-pdos.sm_index = 2
-pdos.name = "OrbitaIn"
-pdos.entries = [Entry(name="controlword", type=EntryType.UINT16, index="0x6041")]
-pdos.entries.append(Entry(name="mode_of_operation", type=EntryType.UINT8, index="0x6060"))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="target_position", type=EntryType.REAL, index="0x607A", sub_index=i+1)) 
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="target_velocity", type=EntryType.REAL, index="0x60FF", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="velocity_limit", type=EntryType.REAL, index="0x607F", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="target_torque", type=EntryType.REAL, index="0x6071", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="torque_limit", type=EntryType.REAL, index="0x6072", sub_index=i+1))
-slave.RxPdos.append(pdos)
-
-
-pdos = PDOs()
-pdos.sm_index = 3
-pdos.name = "OrbitaOut"
-pdos.entries = [Entry(name="statusword", type=EntryType.UINT16, index="0x6040")]
-pdos.entries.append(Entry(name="mode_of_operation_display", type=EntryType.UINT8, index="0x6061"))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="actual_position", type=EntryType.REAL, index="0x6064", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="actual_velocity", type=EntryType.REAL, index="0x606C", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="actual_torque", type=EntryType.REAL, index="0x6077", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="actual_axis_position", type=EntryType.REAL, index="0x6063", sub_index=i+1))
-slave.TxPdos.append(pdos)
-
-
-pdos = PDOs()
-pdos.sm_index = 3
-pdos.name = "OrbitaState"
-pdos.entries.append(Entry(name="error_code", type=EntryType.UINT16, index="0x603F"))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="error_code", type=EntryType.UINT16, index="0x603F", sub_index=i+1))
-pdos.entries.append(Entry(name="actuator_type", type=EntryType.UINT8, index="0x6402"))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="axis_position_zero_offset", type=EntryType.REAL, index="0x607C", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="board_temperatures", type=EntryType.REAL, index="0x6500", sub_index=i+1))
-for i in range(orbita_type):
-    pdos.entries.append(Entry(name="motor_temperatures", type=EntryType.REAL, index="0x6501", sub_index=i+1))
-slave.TxPdos.append(pdos)
-
-slave.enable_sdos = True
-slave.enable_foe = True
-
-esi.devices.append(slave)
-tree = esi.to_xml()
-print(tree)
-write_xml(tree, slave.name+".xml")
-print("XML file generated successfully: "+slave.name+".xml")
\ No newline at end of file
+
+def build_orbita(name, orbita_type):
+    """
+    build_orbita: Build the ESI of an Orbita board
+
+    name: Name prefix of the orbita
+    orbita_type: Number of axes of the orbita
+
+    return: The ESI object
+    """
+    esi = ESI()
+    esi.vendor_id = "0xF3F"
+    esi.vendor_name = "Pollen Robotcs SAS"
+    esi.group_name = "Pollen PYESI"
+    # esi.devices = []
+
+    slave = Device()
+    slave.name = f"{name}Orbita{orbita_type}d"
+
+    slave.sync_managers= [
+        SyncManager("MBoxOut",1000, SyncManagerType.MAILBOX, SyncManagerDir.Rx, 128),
+        SyncManager("MBoxIn",1180, SyncManagerType.MAILBOX, SyncManagerDir.Tx, 128),
+        SyncManager("OrbitaIn",1300, SyncManagerType.BUFFERED, SyncManagerDir.Rx),
+        SyncManager("OrbitaOut",1400, SyncManagerType.BUFFERED, SyncManagerDir.Tx),
+    ]
+
+
+    pdos = PDOs(compact=True)
+    pdos.sm_index = 2
+    pdos.name = "OrbitaIn"
+    pdos.add_entry("controlword", EntryType.UINT16, "0x6041")
+    pdos.add_entry("mode_of_operation", EntryType.UINT8, "0x6060")
+    pdos.add_array("target_position", EntryType.REAL, "0x607A", orbita_type)
+    pdos.add_array("target_velocity", EntryType.REAL, "0x60FF", orbita_type)
+    pdos.add_array("velocity_limit", EntryType.REAL, "0x607F", orbita_type)
+    pdos.add_array("target_torque", EntryType.REAL, "0x6071", orbita_type)
+    pdos.add_array("torque_limit", EntryType.REAL, "0x6072", orbita_type)
+    slave.RxPdos.append(pdos)
+
+
+    pdos = PDOs(compact=True)
+    pdos.sm_index = 3
+    pdos.name = "OrbitaOut"
+    pdos.add_entry("statusword", EntryType.UINT16, "0x6040")
+    pdos.add_entry("mode_of_operation_display", EntryType.UINT8, "0x6061")
+    pdos.add_array("actual_position", EntryType.REAL, "0x6064", orbita_type)
+    pdos.add_array("actual_velocity", EntryType.REAL, "0x606C", orbita_type)
+    pdos.add_array("actual_torque", EntryType.REAL, "0x6077", orbita_type)
+    pdos.add_array("actual_axis_position", EntryType.REAL, "0x6063", orbita_type)
+    slave.TxPdos.append(pdos)
+
+
+    pdos = PDOs(compact=True)
+    pdos.sm_index = 3
+    pdos.name = "OrbitaState"
+    pdos.add_entry("error_code", EntryType.UINT16, "0x603F")
+    pdos.add_array("error_code", EntryType.UINT16, "0x603F", orbita_type)
+    pdos.add_entry("actuator_type", EntryType.UINT8, "0x6402")
+    pdos.add_array("axis_position_zero_offset", EntryType.REAL, "0x607C", orbita_type)
+    pdos.add_array("board_temperatures", EntryType.REAL, "0x6500", orbita_type)
+    pdos.add_array("motor_temperatures", EntryType.REAL, "0x6501", orbita_type)
+    slave.TxPdos.append(pdos)
+
+    slave.enable_sdos = True
+    slave.enable_foe = True
+
+    esi.devices.append(slave)
+    return esi
+
+
+if __name__ == "__main__":
+    #take input from user
+    name = input("Enter the name of the orbita: ")
+    orbita_type = int(input("Enter the number of orbita: "))
+
+    esi = build_orbita(name, orbita_type)
+    slave = esi.devices[0]
+    tree = esi.to_xml()
+    print(tree)
+    write_xml(tree, slave.name+".xml")
+    print("XML file generated successfully: "+slave.name+".xml")
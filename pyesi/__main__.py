@@ -0,0 +1,5 @@
+import sys
+
+from pyesi.cli import main
+
+sys.exit(main())
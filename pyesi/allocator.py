@@ -0,0 +1,131 @@
+# Object dictionary ranges the allocator assigns indices from
+RXPDO_RANGE = (0x1600, 0x17FF)
+TXPDO_RANGE = (0x1A00, 0x1BFF)
+MANUFACTURER_RANGE = (0x2000, 0x5FFF)
+
+
+def parse_index(value):
+    """
+    parse_index: Parse an index or address as the model stores it
+
+    The model writes its indices and addresses as f"#x{value}", so the value
+    is hex digits (an int is read as its digits), optionally prefixed with
+    "0x" or "#x".
+
+    value: The index or address
+
+    return: The integer
+    """
+    value = str(value).strip()
+    if value[:2] in ("#x", "0x", "#X", "0X"):
+        value = value[2:]
+    return int(value, 16)
+
+
+class IndexRange:
+    """
+    IndexRange: Occupancy bitmap of a range of object indices
+
+    Bit i of the bitmap is set when first + i is used. The lowest free index
+    is found with a couple of integer operations on the bitmap, whatever the
+    number of used indices.
+
+    first: First index of the range
+    last: Last index of the range
+    """
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self._used = 0
+        # all the indices below first + _free_from are used
+        self._free_from = 0
+
+    def __contains__(self, index):
+        return self.first <= index <= self.last
+
+    def __len__(self):
+        return self._used.bit_count()
+
+    def is_used(self, index):
+        """
+        is_used: Whether an index of the range is used
+
+        index: The index
+
+        return: True if the index is used
+        """
+        return bool(self._used >> (index - self.first) & 1)
+
+    def reserve(self, index):
+        """
+        reserve: Mark an index of the range as used
+
+        index: The index
+
+        return: False if the index was already used
+        """
+        if index not in self:
+            raise ValueError(f"Index #x{index:04X} outside of #x{self.first:04X}-#x{self.last:04X}")
+        bit = 1 << (index - self.first)
+        if self._used & bit:
+            return False
+        self._used |= bit
+        return True
+
+    def allocate(self):
+        """
+        allocate: Use the lowest free index of the range
+
+        return: The index
+        """
+        free = ~(self._used >> self._free_from)
+        offset = self._free_from + (free & -free).bit_length() - 1
+        if self.first + offset > self.last:
+            raise ValueError(f"No free index left in #x{self.first:04X}-#x{self.last:04X}")
+        self._used |= 1 << offset
+        self._free_from = offset + 1
+        return self.first + offset
+
+
+class ObjectAllocator:
+    """
+    ObjectAllocator: Collision-free allocation of object dictionary indices
+
+    Indices used explicitly by the model are reserved first, the missing
+    ones are then allocated from the lowest free index of their range: RxPdo
+    (0x1600-0x17FF), TxPdo (0x1A00-0x1BFF) and manufacturer specific
+    objects (0x2000-0x5FFF).
+
+    ranges: IndexRange by name ("RxPdo", "TxPdo", "manufacturer")
+    """
+
+    def __init__(self):
+        self.ranges = {
+            "RxPdo": IndexRange(*RXPDO_RANGE),
+            "TxPdo": IndexRange(*TXPDO_RANGE),
+            "manufacturer": IndexRange(*MANUFACTURER_RANGE),
+        }
+
+    def reserve(self, index):
+        """
+        reserve: Mark an index as used, if it belongs to one of the ranges
+
+        index: The index
+
+        return: False if the index was already used
+        """
+        for index_range in self.ranges.values():
+            if index in index_range:
+                return index_range.reserve(index)
+        return True
+
+    def allocate(self, name):
+        """
+        allocate: Allocate the lowest free index of a range
+
+        name: Name of the range ("RxPdo", "TxPdo" or "manufacturer")
+
+        return: The index
+        """
+        return self.ranges[name].allocate()
@@ -0,0 +1,439 @@
+import hashlib
+import json
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from collections.abc import Sequence
+from enum import Enum
+
+from pyesi.allocator import parse_index
+
+# Bump when the XML generated for a device changes, so that fragments stored
+# on disk by an older version are not reused
+CACHE_FORMAT = 4
+
+
+def canonical(value):
+    """
+    canonical: Convert a model object to a JSON-serializable canonical form
+
+    Model objects are converted to a dictionary of their public, non-callable
+    attributes (class defaults included), enums to their qualified name.
+
+    value: The object to convert
+
+    return: The canonical form
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Enum):
+        return f"{type(value).__name__}.{value.name}"
+    if isinstance(value, Sequence):
+        return [canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in value.items()}
+    attributes = {"__type__": type(value).__name__}
+    for name in dir(value):
+        if name.startswith("_"):
+            continue
+        attribute = getattr(value, name)
+        if callable(attribute):
+            continue
+        attributes[name] = canonical(attribute)
+    return attributes
+
+
+def content_hash(*values):
+    """
+    content_hash: Compute a stable content hash of plain data (specs)
+
+    Model objects are hashed through canonical too, but walking them is
+    slow: devices are keyed with device_key instead.
+
+    values: The objects to hash
+
+    return: The hex digest
+    """
+    data = json.dumps([CACHE_FORMAT] + [canonical(value) for value in values], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _normalize(value):
+    """
+    _normalize: Convert a field to the form it is compared and hashed in
+
+    Enums are replaced by their name, so models and files read back compare
+    equal.
+    """
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
+def _normalize_index(value):
+    # "6041", "0x6041" and "#x6041" are the same index
+    if value is None:
+        return None
+    try:
+        return parse_index(value)
+    except ValueError:
+        return value
+
+
+class Node:
+    """
+    Node: Subtree of an ESI model with its Merkle hash
+
+    The hash of a node covers its kind, its fields and the keys and hashes
+    of its children, in order: two nodes with the same hash have the same
+    content, whatever their size. The hashes are stable between runs (and
+    include the cache format), so they can be used as cache keys.
+
+    The entries of a PDO are hashed with it, as rows of values, and their
+    nodes are only created when the PDO has to be compared entry by entry.
+
+    kind: Kind of the node ("esi", "device", "sm", "pdo", "entry")
+    label: Label of the node in the reports ("Device Orbita", "TxPdo OrbitaOut"...)
+    fields: Dictionary of the values of the node
+    children: Dictionary of the child nodes by key, in model order
+    hash: The hex digest
+    """
+
+    __slots__ = ("kind", "label", "fields", "hash", "_children", "_rows")
+
+    def __init__(self, kind, label, fields, children=None, rows=None):
+        self.kind = kind
+        self.label = label
+        self.fields = fields
+        self._children = children if children is not None or rows is not None else {}
+        self._rows = rows
+        digest = hashlib.blake2b(repr((CACHE_FORMAT, kind, sorted(fields.items()), rows)).encode("utf-8"), digest_size=16)
+        for key, child in (children or {}).items():
+            digest.update(repr(key).encode("utf-8"))
+            digest.update(child.hash.encode("ascii"))
+        self.hash = digest.hexdigest()
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = _entry_nodes(self._rows)
+        return self._children
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.hash == other.hash
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    def __repr__(self):
+        return f"Node({self.label!r}, {self.hash})"
+
+
+def _unique_key(children, key):
+    # keep the repeated keys apart (same name or index used twice)
+    unique, occurrence = key, 1
+    while unique in children:
+        occurrence += 1
+        unique = (key, occurrence)
+    return unique
+
+
+def _entry_nodes(rows):
+    """
+    _entry_nodes: Create the entry nodes of a PDO from its rows
+
+    rows: The (name, type, index, sub_index, bitlen) of the entries
+
+    return: Dictionary of the entry nodes by key
+    """
+    nodes = {}
+    for position, (name, entry_type, index, sub_index, bitlen) in enumerate(rows):
+        if entry_type is None:
+            key, label = ("padding", position), f"padding {position}"
+        else:
+            key, label = (index, sub_index), f"entry {name} (#x{index}:{sub_index})"
+        fields = {"name": name, "type": entry_type, "index": index, "sub_index": sub_index, "bitlen": bitlen}
+        nodes[_unique_key(nodes, key)] = Node("entry", label, fields)
+    return nodes
+
+
+def device_tree(device):
+    """
+    device_tree: Build the hashed tree of a device
+
+    The PDOs and entries are taken as they are mapped in the ESI (see
+    Device.iter_mapped_pdos), with their indices resolved: a model compares
+    equal to the file generated from it. Sync managers are keyed by their
+    position, PDOs by their tag and name, entries by index and sub index.
+
+    device: The Device
+
+    return: The device Node
+    """
+    children = {}
+    for sm_index, sm in enumerate(device.sync_managers):
+        fields = {
+            "name": sm.name,
+            "sm_type": _normalize(sm.sm_type),
+            "address": _normalize_index(sm.address),
+            "enabled": int(sm.enabled),
+            "default_size": sm.default_size,
+            "control_byte": _normalize_index(sm.control_byte),
+            "dir": _normalize(sm.dir),
+        }
+        children[("sm", sm_index)] = Node("sm", f"Sm[{sm_index}] {sm.name}", fields)
+
+    for tag, pdo, pdo_index, entries in device.iter_mapped_pdos():
+        # the indices are already written as 4 hex digits
+        rows = [(name, entry_type and entry_type.name, index, sub_index, int(bitlen))
+                for name, entry_type, index, sub_index, bitlen in entries]
+        fields = {"name": pdo.name, "sm_index": pdo.sm_index, "index": pdo_index}
+        key = _unique_key(children, (tag, pdo.name))
+        children[key] = Node("pdo", f"{tag} {pdo.name}", fields, rows=rows)
+
+    fields = {
+        "name": device.name,
+        "product_code": _normalize_index(device.product_code),
+        "revision_no": _normalize_index(device.revision_no),
+        "enable_sdos": device.enable_sdos,
+        "enable_foe": device.enable_foe,
+        "sdo_info": device.sdo_info,
+        "segmented_sdo": device.segmented_sdo,
+        "complete_access": device.complete_access,
+        "embed_dictionary": device.embed_dictionary and device.enable_sdos,
+        "dc_cycle_time": device.dc_cycle_time,
+        "dc_shift_time": device.dc_shift_time,
+        "pdo_sets": tuple((name, tuple(pdo_names)) for name, pdo_names in device.pdo_sets.items()),
+    }
+    return Node("device", f"Device {device.name}", fields, children)
+
+
+def esi_tree(esi):
+    """
+    esi_tree: Build the hashed tree of an ESI, see device_tree
+
+    Devices are keyed by name.
+
+    esi: The ESI
+
+    return: The esi Node
+    """
+    children = {}
+    for device in esi.devices:
+        children[_unique_key(children, device.name)] = device_tree(device)
+    fields = {
+        "vendor_id": _normalize_index(esi.vendor_id),
+        "vendor_name": esi.vendor_name,
+        "group_type": esi.group_type,
+        "group_name": esi.group_name,
+        "lan9252": esi.lan9252,
+    }
+    return Node("esi", "ESI", fields, children)
+
+
+def device_key(lan9252, device):
+    """
+    device_key: Compute the cache key of the element of a device
+
+    The key is the Merkle hash of the device (see device_tree), plus the
+    fields it normalizes but the XML writes as they are.
+
+    lan9252: The ESI configures a LAN9252
+    device: The Device
+
+    return: The hex digest
+    """
+    raw = (device.product_code, device.revision_no,
+           tuple((sm.address, sm.control_byte, sm.enabled) for sm in device.sync_managers))
+    data = repr((CACHE_FORMAT, bool(lan9252), device_tree(device).hash, raw))
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DeviceCache:
+    """
+    DeviceCache: Cache of fragments keyed by content hash
+
+    Fragments are kept in a bounded in-memory LRU and, if a directory is
+    given, stored on disk so that they survive between runs. In memory, a
+    fragment can be any object (ESI.to_xml keeps the device elements, with
+    their rendered text); on disk, elements are stored serialized.
+
+    maxsize: Maximum number of fragments kept in memory
+    directory: Optional directory of the on-disk store
+    hits: Number of fragments found in the cache
+    misses: Number of fragments not found in the cache
+    """
+
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.xml")
+
+    def get(self, key):
+        """
+        get: Get a fragment from the cache
+
+        key: The content hash
+
+        return: The fragment, the serialized fragment (bytes) if it was read
+                from the disk, or None
+        """
+        fragment = self._fragments.get(key)
+        if fragment is not None:
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+        if self.directory is not None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    fragment = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self._remember(key, fragment)
+                self.hits += 1
+                return fragment
+        self.misses += 1
+        return None
+
+    def put(self, key, fragment):
+        """
+        put: Store a fragment in the cache
+
+        key: The content hash
+        fragment: The fragment (bytes or an element)
+        """
+        self._remember(key, fragment)
+        if self.directory is not None and not os.path.exists(self._path(key)):
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(fragment if isinstance(fragment, bytes) else ET.tostring(fragment))
+            os.replace(tmp, self._path(key))
+
+    def _remember(self, key, fragment):
+        self._fragments[key] = fragment
+        self._fragments.move_to_end(key)
+        while len(self._fragments) > self.maxsize:
+            self._fragments.popitem(last=False)
+
+    def clear(self):
+        """
+        clear: Empty the in-memory cache (the on-disk store is kept)
+        """
+        self._fragments.clear()
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+def file_digest(filename):
+    """
+    file_digest: Compute the sha256 of a file
+
+    filename: The file name
+
+    return: The hex digest, or None if the file does not exist
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def _sidecar_digest(filename):
+    """
+    _sidecar_digest: Read the digest recorded next to a file
+
+    The sidecar is ignored if it is older than the file, which then has been
+    modified by someone else.
+
+    filename: The file name
+
+    return: The hex digest, or None if there is no usable sidecar
+    """
+    try:
+        if os.path.getmtime(filename + ".sha256") < os.path.getmtime(filename):
+            return None
+        with open(filename + ".sha256") as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def _default_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def write_if_changed(chunks, filename, sidecar=False):
+    """
+    write_if_changed: Atomically write a file, only if its content changed
+
+    The chunks are written to a temporary file next to the target while
+    their hash is computed. The hash is then compared to the one of the
+    existing file (or of its sidecar digest): if they match, the existing
+    file and its modification time are left untouched. Otherwise the
+    temporary file replaces the target with a rename, so readers never see
+    a partial file.
+
+    chunks: Iterable of str (encoded as UTF-8) or bytes
+    filename: The file name
+    sidecar: Record the digest in filename + ".sha256", so the next call
+             compares against it instead of reading the whole file back
+
+    return: True if the file was written, False if it was unchanged
+    """
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filename)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                digest.update(chunk)
+                f.write(chunk)
+        digest = digest.hexdigest()
+
+        previous = None
+        if os.path.exists(filename):
+            previous = (sidecar and _sidecar_digest(filename)) or file_digest(filename)
+        if previous == digest:
+            os.unlink(tmp)
+            if sidecar and _sidecar_digest(filename) is None:
+                _write_sidecar(filename, digest)
+            return False
+
+        try:
+            mode = os.stat(filename).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = _default_mode()
+        os.chmod(tmp, mode)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    if sidecar:
+        _write_sidecar(filename, digest)
+    return True
+
+
+def _write_sidecar(filename, digest):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{digest}  {os.path.basename(filename)}\n")
+    os.replace(tmp, filename + ".sha256")
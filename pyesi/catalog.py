@@ -0,0 +1,448 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+from pyesi.cache import esi_tree, file_digest, write_if_changed
+from pyesi.generator import Device, Entry, EntryType, PDOs, SyncManager, SyncManagerDir, SyncManagerType
+from pyesi.reader import parse_number
+
+# Bump when the layout of the catalog changes (or the order of EntryType)
+CATALOG_VERSION = 4
+CATALOG_MAGIC = b"PYESICAT"
+
+# magic, version, number of sources, number of index records, offset of the
+# source table, offset of the index
+_HEADER = struct.Struct("<8sIIIQQ")
+# product code, revision number, vendor id, source, offset of the device
+_INDEX = struct.Struct("<IIIIQ")
+_SOURCE = struct.Struct("<QQI")
+# flags, DC cycle time, DC shift time (signed, as the ESI DINT), number of sync
+# managers and PDOs
+_DEVICE = struct.Struct("<BIiHH")
+_SYNC_MANAGER = struct.Struct("<iBBB")
+_PDO = struct.Struct("<BiI")
+_ENTRY = struct.Struct("<BiH")
+_STRING = struct.Struct("<H")
+_COUNT = struct.Struct("<I")
+
+_ENTRY_TYPES = list(EntryType)
+_ENTRY_TYPE_CODES = {entry_type: code for code, entry_type in enumerate(_ENTRY_TYPES)}
+_PADDING = 0xFF
+_NONE = -1
+
+
+def _key_number(value):
+    # identity numbers that are not numbers ("Test" vendor) are indexed as 0
+    try:
+        return parse_number(str(value)) & 0xFFFFFFFF
+    except (TypeError, ValueError):
+        return 0
+
+
+class _RecordWriter:
+    def __init__(self):
+        self.chunks = []
+
+    def pack(self, packer, *values):
+        self.chunks.append(packer.pack(*values))
+
+    def string(self, value):
+        data = b"" if value is None else str(value).encode("utf-8")
+        self.chunks.append(_STRING.pack(len(data)) + data)
+
+
+def device_record(device):
+    """
+    device_record: Pack a device in the binary form of the catalog
+
+    The PDOs and entries are stored as they are mapped in the ESI, with
+    their indices resolved (see Device.iter_mapped_pdos).
+
+    device: The Device
+
+    return: The record (bytes)
+    """
+    writer = _RecordWriter()
+    flags = (device.enable_sdos | device.enable_foe << 1 | device.embed_dictionary << 2 | device.sdo_info << 3
+             | device.segmented_sdo << 4 | device.complete_access << 5)
+    mapped = list(device.iter_mapped_pdos())
+    writer.pack(_DEVICE, flags, device.dc_cycle_time, device.dc_shift_time, len(device.sync_managers), len(mapped))
+    for string in (device.name, device.product_code, device.revision_no):
+        writer.string(string)
+
+    for sm in device.sync_managers:
+        writer.pack(_SYNC_MANAGER, _NONE if sm.default_size is None else sm.default_size, int(sm.enabled),
+                    sm.sm_type == SyncManagerType.BUFFERED, sm.dir == SyncManagerDir.Tx)
+        for string in (sm.name, sm.address, sm.control_byte):
+            writer.string(string)
+
+    for tag, pdo, pdo_index, entries in mapped:
+        writer.pack(_PDO, tag == "TxPdo", pdo.sm_index, len(entries))
+        writer.string(pdo.name)
+        writer.string(pdo_index)
+        for name, entry_type, index, sub_index, bitlen in entries:
+            code = _PADDING if entry_type is None else _ENTRY_TYPE_CODES[entry_type]
+            writer.pack(_ENTRY, code, sub_index, int(bitlen))
+            writer.string(name)
+            writer.string(index)
+
+    writer.pack(_COUNT, len(device.pdo_sets))
+    for name, pdo_names in device.pdo_sets.items():
+        writer.string(name)
+        writer.pack(_COUNT, len(pdo_names))
+        for pdo_name in pdo_names:
+            writer.string(pdo_name)
+    return b"".join(writer.chunks)
+
+
+class _RecordReader:
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def unpack(self, packer):
+        values = packer.unpack_from(self.buffer, self.offset)
+        self.offset += packer.size
+        return values
+
+    def string(self):
+        size, = _STRING.unpack_from(self.buffer, self.offset)
+        start = self.offset + _STRING.size
+        self.offset = start + size
+        return self.buffer[start:self.offset].decode("utf-8")
+
+
+def read_device_record(buffer, offset=0):
+    """
+    read_device_record: Unpack a device packed by device_record
+
+    buffer: The buffer (bytes, mmap...)
+    offset: Offset of the record in the buffer
+
+    return: The Device
+    """
+    reader = _RecordReader(buffer, offset)
+    device = Device()
+    flags, device.dc_cycle_time, device.dc_shift_time, sm_count, pdo_count = reader.unpack(_DEVICE)
+    device.enable_sdos = bool(flags & 1)
+    device.enable_foe = bool(flags & 2)
+    device.embed_dictionary = bool(flags & 4)
+    device.sdo_info = bool(flags & 8)
+    device.segmented_sdo = bool(flags & 16)
+    device.complete_access = bool(flags & 32)
+    device.name, device.product_code, device.revision_no = reader.string(), reader.string(), reader.string()
+
+    for _ in range(sm_count):
+        default_size, enabled, buffered, tx = reader.unpack(_SYNC_MANAGER)
+        name, address, control_byte = reader.string(), reader.string(), reader.string()
+        sm = SyncManager(name, address, SyncManagerType.BUFFERED if buffered else SyncManagerType.MAILBOX,
+                         SyncManagerDir.Tx if tx else SyncManagerDir.Rx, None if default_size == _NONE else default_size,
+                         enabled)
+        sm.control_byte = control_byte
+        device.sync_managers.append(sm)
+
+    for _ in range(pdo_count):
+        tx, sm_index, entry_count = reader.unpack(_PDO)
+        pdos = PDOs()
+        pdos.sm_index = sm_index
+        pdos.name = reader.string()
+        pdos.index = reader.string()
+        for _ in range(entry_count):
+            code, sub_index, bitlen = reader.unpack(_ENTRY)
+            name, index = reader.string(), reader.string()
+            if code == _PADDING:
+                pdos.entries.append(Entry(name, None, index, sub_index, bitlen))
+            else:
+                pdos.entries.append(Entry(name, _ENTRY_TYPES[code], index, sub_index))
+        (device.TxPdos if tx else device.RxPdos).append(pdos)
+
+    set_count, = reader.unpack(_COUNT)
+    for _ in range(set_count):
+        name = reader.string()
+        count, = reader.unpack(_COUNT)
+        device.add_pdo_set(name, [reader.string() for _ in range(count)])
+    return device
+
+
+def _load_source(source, dependencies):
+    from pyesi.loader import load_esi
+    from pyesi.reader import read_esi
+
+    if source.lower().endswith(".xml"):
+        dependencies.append(os.path.abspath(source))
+        return read_esi(source)
+    return load_esi(source, dependencies=dependencies)
+
+
+def _dependencies_digest(dependencies):
+    """
+    _dependencies_digest: Digest of the content of the files a source was
+    read from
+
+    dependencies: The file names (the source, and the specs it includes)
+
+    return: The hex digest (a missing file gives a digest of its own)
+    """
+    digest = hashlib.sha256()
+    for filename in dependencies:
+        digest.update(f"{filename}\0{file_digest(filename)}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _compile_source(source):
+    """
+    _compile_source: Pack the devices of a source
+
+    return: (digest, dependencies, segment bytes, list of (key, offset in
+            the segment)), the digest covering the content of the files the
+            source was read from, or the structure of a model
+    """
+    dependencies = []
+    if isinstance(source, (str, os.PathLike)):
+        esi = _load_source(os.fspath(source), dependencies)
+        digest = _dependencies_digest(dependencies)
+    else:
+        esi = source
+        digest = esi_tree(esi).hash
+    vendor_id = _key_number(esi.vendor_id)
+    records = []
+    entries = []
+    size = 0
+    for device in esi.devices:
+        record = device_record(device)
+        entries.append(((_key_number(device.product_code), _key_number(device.revision_no), vendor_id), size))
+        records.append(record)
+        size += len(record)
+    return digest, dependencies, b"".join(records), entries
+
+
+def compile_catalog(sources, filename):
+    """
+    compile_catalog: Compile ESI files, specs or models into a binary catalog
+
+    The catalog holds a sorted index of the devices by (product code,
+    revision number, vendor id) and their packed records. When the catalog
+    already exists, the sources whose content did not change (spec files
+    with their includes) are copied from it without being parsed again:
+    only the changed sources are compiled. Model sources are compared by
+    their structural hash (see pyesi.cache.esi_tree).
+
+    sources: ESI XML files, YAML/JSON specs or ESI objects
+    filename: The catalog file name
+
+    return: The names of the sources that were compiled (the others were
+            reused)
+
+    raise: ValueError if two devices have the same identity
+    """
+    previous = {}
+    if os.path.exists(filename):
+        try:
+            with Catalog(filename) as old:
+                previous = old.segments()
+        except ValueError:
+            previous = {}
+
+    compiled = []
+    segments = []
+    for position, source in enumerate(sources):
+        if isinstance(source, (str, os.PathLike)):
+            name = os.path.abspath(source)
+            reused = previous.get(name)
+            if reused is not None and reused[0] == _dependencies_digest(reused[1]):
+                segments.append((name,) + reused)
+                continue
+        else:
+            name = f"<model {position}>"
+            reused = previous.get(name)
+            if reused is not None and reused[0] == esi_tree(source).hash:
+                segments.append((name,) + reused)
+                continue
+        segments.append((name,) + _compile_source(source))
+        compiled.append(name)
+
+    offset = _HEADER.size
+    index = {}
+    source_table = []
+    for number, (name, digest, dependencies, segment, entries) in enumerate(segments):
+        for key, relative in entries:
+            if key in index:
+                raise ValueError(f"Devices #x{key[0]:X} revision #x{key[1]:X} of vendor #x{key[2]:X} found in both "
+                                 f"{segments[index[key][0]][0]} and {name}")
+            index[key] = (number, offset + relative)
+        source_table.append((name, digest, dependencies, offset, len(segment), entries))
+        offset += len(segment)
+
+    chunks = [segment for _, _, _, segment, _ in segments]
+    writer = _RecordWriter()
+    for name, digest, dependencies, start, size, entries in source_table:
+        writer.string(name)
+        writer.string(digest)
+        writer.pack(_COUNT, len(dependencies))
+        for dependency in dependencies:
+            writer.string(dependency)
+        writer.pack(_SOURCE, start, size, len(entries))
+        for key, relative in entries:
+            writer.pack(_INDEX, *key, 0, relative)
+    table = b"".join(writer.chunks)
+    index_offset = offset + len(table)
+    header = _HEADER.pack(CATALOG_MAGIC, CATALOG_VERSION, len(segments), len(index), offset, index_offset)
+    records = b"".join(_INDEX.pack(*key, number, record) for key, (number, record) in sorted(index.items()))
+    write_if_changed([header] + chunks + [table, records], filename)
+    return compiled
+
+
+class Catalog:
+    """
+    Catalog: Memory-mapped reader of a compiled catalog, see compile_catalog
+
+    Looking a device up is a binary search in the mapped index, loading it
+    unpacks its record: no XML is parsed and only the pages used are read.
+
+    filename: The catalog file name
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f"{filename} is not a pyesi catalog") from None
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ValueError(f"{filename} is not a pyesi catalog")
+        magic, version, self._source_count, self._count, self._sources_offset, self._index_offset = \
+            _HEADER.unpack_from(self._map)
+        if magic != CATALOG_MAGIC or version != CATALOG_VERSION:
+            self.close()
+            raise ValueError(f"{filename} is not a pyesi catalog of version {CATALOG_VERSION}")
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, i):
+        return _INDEX.unpack_from(self._map, self._index_offset + i * _INDEX.size)
+
+    def keys(self):
+        """
+        keys: The identities of the devices of the catalog
+
+        return: The list of (product code, revision number, vendor id), sorted
+        """
+        return [self._key(i)[:3] for i in range(self._count)]
+
+    def find(self, product_code, revision_no=None, vendor_id=None):
+        """
+        find: Look a device up in the index
+
+        product_code: The product code (integer or ESI number text)
+        revision_no: The revision number (None for the lowest revision)
+        vendor_id: The vendor id (None for any vendor)
+
+        return: The offset of the device record, or None if there is no such
+                device
+        """
+        key = [_key_number(value) if value is not None else None for value in (product_code, revision_no, vendor_id)]
+        low, high = 0, self._count
+        target = tuple(0 if value is None else value for value in key)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[:3] < target:
+                low = middle + 1
+            else:
+                high = middle
+        for i in range(low, self._count):
+            found = self._key(i)
+            if found[0] != key[0] or (key[1] is not None and found[1] != key[1]):
+                return None
+            if key[2] is None or found[2] == key[2]:
+                return found[4]
+        return None
+
+    def get(self, product_code, revision_no=None, vendor_id=None):
+        """
+        get: Load a device by its identity, see find
+
+        return: The Device, or None if there is no such device
+        """
+        offset = self.find(product_code, revision_no, vendor_id)
+        return None if offset is None else read_device_record(self._map, offset)
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield read_device_record(self._map, self._key(i)[4])
+
+    def segments(self):
+        """
+        segments: The compiled segment of each source
+
+        return: Dictionary by source name of (digest, list of the files the
+                source was read from, segment bytes, list of (key, offset in
+                the segment))
+        """
+        reader = _RecordReader(self._map, self._sources_offset)
+        segments = {}
+        for _ in range(self._source_count):
+            name, digest = reader.string(), reader.string()
+            count, = reader.unpack(_COUNT)
+            dependencies = [reader.string() for _ in range(count)]
+            start, size, count = reader.unpack(_SOURCE)
+            entries = []
+            for _ in range(count):
+                product_code, revision_no, vendor_id, _, relative = reader.unpack(_INDEX)
+                entries.append(((product_code, revision_no, vendor_id), relative))
+            segments[name] = (digest, dependencies, self._map[start:start + size], entries)
+        return segments
+
+
+def main(argv=None):
+    """
+    main: Entry point of python -m pyesi.catalog
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code, 1 if the device is not found
+    """
+    parser = argparse.ArgumentParser(prog="python -m pyesi.catalog", description="Compile and query device catalogs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="compile ESI files and specs into a catalog")
+    build.add_argument("catalog", help="the catalog file")
+    build.add_argument("sources", nargs="+", help="ESI XML files or YAML/JSON specs")
+    find = commands.add_parser("find", help="look a device up")
+    find.add_argument("catalog", help="the catalog file")
+    find.add_argument("product_code", help="product code of the device")
+    find.add_argument("revision_no", nargs="?", help="revision number of the device")
+    find.add_argument("--vendor-id", help="vendor id of the device")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        compiled = compile_catalog(args.sources, args.catalog)
+        print(f"{args.catalog}: {len(compiled)} of {len(args.sources)} sources compiled")
+        return 0
+
+    with Catalog(args.catalog) as catalog:
+        device = catalog.get(args.product_code, args.revision_no, args.vendor_id)
+    if device is None:
+        print("not found")
+        return 1
+    print(f"{device.name} ({device.product_code} {device.revision_no}): {len(device.sync_managers)} sync managers, "
+          f"{len(device.RxPdos)} RxPdos, {len(device.TxPdos)} TxPdos")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import re
+
+from pyesi.cache import write_if_changed
+from pyesi.generator import EntryType
+from pyesi.layout import DeviceLayout
+
+_C_TYPES = {
+    EntryType.UINT8: "uint8_t",
+    EntryType.UINT16: "uint16_t",
+    EntryType.UINT32: "uint32_t",
+    EntryType.UINT64: "uint64_t",
+    EntryType.INT8: "int8_t",
+    EntryType.INT16: "int16_t",
+    EntryType.INT32: "int32_t",
+    EntryType.INT64: "int64_t",
+    EntryType.REAL: "float",
+    EntryType.LREAL: "double",
+}
+
+
+def c_identifier(name):
+    """
+    c_identifier: Convert a name to a valid C identifier
+
+    name: The name
+
+    return: The identifier
+    """
+    identifier = re.sub(r"\W", "_", name, flags=re.ASCII)
+    if not identifier or identifier[0].isdigit():
+        identifier = "_" + identifier
+    return identifier
+
+
+def _entry_comment(entry):
+    if entry.type is None:
+        return f"padding, {entry.bitlen} bits"
+    return f"{entry.index}:{entry.sub_index} {entry.type.value} ({entry.pdo})"
+
+
+def _image_struct(image, type_name, macro_prefix):
+    """
+    _image_struct: Generate the packed struct of a process image
+
+    Byte-aligned entries become struct members. Runs of bit-sized entries and
+    padding become byte arrays, with a byte offset and bit macro per entry.
+
+    image: The ImageLayout
+    type_name: Name of the struct type
+    macro_prefix: Prefix of the macros
+
+    return: The lines of the struct definition and of its checks
+    """
+    members = []
+    checks = []
+    macros = []
+    position = 0
+    bits_start = None
+    bits_entries = []
+
+    def flush_bits(end):
+        nonlocal bits_start
+        if bits_start is None:
+            return
+        name = f"bits_{bits_start}"
+        comment = ", ".join(f"{entry.field} bit {entry.bit_offset - bits_start * 8}" for entry in bits_entries if entry.type is not None)
+        members.append(f"    uint8_t {name}[{end - bits_start}];" + (f" /* {comment} */" if comment else ""))
+        checks.append(f'static_assert(offsetof({type_name}, {name}) == {bits_start}, "{type_name}.{name} offset");')
+        bits_start = None
+        bits_entries.clear()
+
+    for entry in image.entries:
+        if entry.byte_aligned:
+            flush_bits(entry.byte_offset)
+            field = c_identifier(entry.field)
+            members.append(f"    {_C_TYPES[entry.type]} {field}; /* {_entry_comment(entry)} */")
+            checks.append(f'static_assert(offsetof({type_name}, {field}) == {entry.byte_offset}, "{type_name}.{field} offset");')
+            position = entry.byte_offset + entry.bitlen // 8
+            continue
+        if bits_start is None:
+            bits_start = position
+        bits_entries.append(entry)
+        position = (entry.bit_offset + entry.bitlen + 7) // 8
+        if entry.type is not None:
+            field = c_identifier(entry.field).upper()
+            macros.append(f"#define {macro_prefix}_{field}_BYTE {entry.byte_offset}")
+            macros.append(f"#define {macro_prefix}_{field}_BIT {entry.bit}")
+    flush_bits(position)
+
+    lines = [f"/* {image.dir.name}PDO process image, {image.size} bytes */", "typedef struct {"]
+    lines += members or ["    uint8_t reserved; /* empty image */"]
+    lines.append(f"}} {type_name};")
+    lines.append(f"#define {macro_prefix}_SIZE {image.size}")
+    lines += macros
+    if image.entries:
+        lines += checks
+        lines.append(f'static_assert(sizeof({type_name}) == {macro_prefix}_SIZE, "{type_name} size");')
+    return lines
+
+
+def generate_c_header(device, prefix=None):
+    """
+    generate_c_header: Generate a C header with the packed process images of
+    a device
+
+    The structs mirror the PDO mapping of the ESI entry by entry, so the
+    firmware can exchange each image with a single memcpy.
+
+    device: The device
+    prefix: Prefix of the generated names (defaults to the device name)
+
+    return: The header text
+    """
+    prefix = c_identifier(prefix if prefix is not None else device.name).lower()
+    guard = f"{prefix.upper()}_PDO_H"
+    layout = DeviceLayout(device)
+
+    lines = [
+        f"/* Process data images of {device.name}, generated by pyesi: do not edit */",
+        f"#ifndef {guard}",
+        f"#define {guard}",
+        "",
+        "#include <assert.h>",
+        "#include <stddef.h>",
+        "#include <stdint.h>",
+        "",
+        "#pragma pack(push, 1)",
+        "",
+    ]
+    lines += _image_struct(layout.rx, f"{prefix}_rxpdo_t", f"{prefix.upper()}_RXPDO")
+    lines.append("")
+    lines += _image_struct(layout.tx, f"{prefix}_txpdo_t", f"{prefix.upper()}_TXPDO")
+    lines += [
+        "",
+        "#pragma pack(pop)",
+        "",
+        f"#endif /* {guard} */",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def write_c_header(device, filename, prefix=None):
+    """
+    write_c_header: Write the C header of a device, only if it changed
+
+    device: The device
+    filename: The file name
+    prefix: Prefix of the generated names (defaults to the device name)
+
+    return: True if the file was written, False if it was unchanged
+    """
+    return write_if_changed([generate_c_header(device, prefix)], filename)
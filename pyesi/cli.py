@@ -0,0 +1,206 @@
+import argparse
+import importlib
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from pyesi.cache import DeviceCache
+from pyesi.generator import write_xml
+from pyesi.loader import load_esi
+from pyesi.validator import ValidationError, check_esi
+
+# Device cache, compiled spec directory, sidecar digest and validation
+# options of the current process, set up by _init_worker
+_cache = None
+_spec_cache_dir = None
+_sidecar = False
+_validate = False
+
+
+def load_manifest(filename):
+    """
+    load_manifest: Load a fleet manifest (YAML or JSON)
+
+    The manifest lists the variants to build. Each variant names either a
+    builder callable ("module:function", returning an ESI object) and the
+    keyword arguments to call it with, or a YAML/JSON "spec" file (see
+    pyesi.loader), and the output file. A variant can give a
+    "matrix" of argument lists instead of single values, it is then expanded
+    into the cartesian product of its values, and "output" is formatted with
+    the arguments of each combination:
+
+        builder: orbita:build_orbita
+        output_dir: build
+        variants:
+          - output: "{name}Orbita{orbita_type}d.xml"
+            matrix:
+              name: [Left, Right]
+              orbita_type: [2, 3]
+
+    filename: The manifest file name
+
+    return: The list of variants, in manifest order
+    """
+    with open(filename) as f:
+        manifest = yaml.safe_load(f) or {}
+
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    output_dir = os.path.join(base_dir, manifest.get("output_dir", "."))
+    default_builder = manifest.get("builder")
+
+    variants = []
+    for entry in manifest.get("variants", []):
+        if "spec" in entry:
+            variants.append({
+                "spec": os.path.join(base_dir, entry["spec"]),
+                "output": os.path.join(output_dir, entry["output"]),
+            })
+            continue
+        builder = entry.get("builder", default_builder)
+        if builder is None:
+            raise ValueError(f"No builder given for variant {entry}")
+        args = dict(entry.get("args", {}))
+        matrix = entry.get("matrix", {})
+        keys = list(matrix)
+        for values in itertools.product(*(matrix[key] for key in keys)):
+            variant_args = dict(args, **dict(zip(keys, values)))
+            output = entry["output"].format(**variant_args)
+            variants.append({
+                "builder": builder,
+                "args": variant_args,
+                "output": os.path.join(output_dir, output),
+            })
+
+    outputs = set()
+    for variant in variants:
+        if variant["output"] in outputs:
+            raise ValueError(f"Several variants write {variant['output']}")
+        outputs.add(variant["output"])
+    return variants
+
+
+def resolve_builder(name):
+    """
+    resolve_builder: Import a builder callable
+
+    name: The builder as "module:function"
+
+    return: The callable
+    """
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError(f"Builder must be given as module:function, got {name}")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def build_variant(variant):
+    """
+    build_variant: Build and write the ESI file of one variant
+
+    variant: The variant, as returned by load_manifest
+
+    return: (output file, build time, write time, written): the times in
+            seconds, written is False if the file was already up to date
+    """
+    start = time.perf_counter()
+    if "spec" in variant:
+        esi = load_esi(variant["spec"], _spec_cache_dir)
+    else:
+        esi = resolve_builder(variant["builder"])(**variant["args"])
+    if _validate:
+        check_esi(esi)
+    tree = esi.to_xml(cache=_cache)
+    built = time.perf_counter()
+    os.makedirs(os.path.dirname(variant["output"]) or ".", exist_ok=True)
+    written = write_xml(tree, variant["output"], sidecar=_sidecar)
+    return variant["output"], built - start, time.perf_counter() - built, written
+
+
+def _init_worker(paths, cache_dir=None, sidecar=False, validate=False):
+    """
+    _init_worker: Set up a worker process
+
+    paths: The paths to prepend to sys.path, to import the builder modules
+    cache_dir: Optional directory of the device cache
+    sidecar: Record the digest of each output file next to it
+    validate: Check each ESI with pyesi.validator before generating it
+    """
+    global _cache, _spec_cache_dir, _sidecar, _validate
+    _sidecar = sidecar
+    _validate = validate
+    _cache = DeviceCache(directory=cache_dir) if cache_dir is not None else None
+    _spec_cache_dir = os.path.join(cache_dir, "specs") if cache_dir is not None else None
+    for path in reversed(paths):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def build_fleet(variants, jobs=None, search_paths=(), cache_dir=None, sidecar=False, validate=False):
+    """
+    build_fleet: Build the ESI files of all the variants
+
+    variants: The variants, as returned by load_manifest
+    jobs: Number of worker processes (None for one per CPU, 1 to build serially)
+    search_paths: Extra paths to import the builder modules from
+    cache_dir: Optional directory of the on-disk device and spec caches shared
+               by the runs
+    sidecar: Record the digest of each output file in a ".sha256" file next
+             to it, to skip reading unchanged files back on the next run
+    validate: Check each ESI before generating it, raising ValidationError
+
+    return: The (output file, build time, write time, written) of each
+            variant, in the order of the variants
+    """
+    search_paths = list(search_paths)
+    if jobs == 1 or len(variants) <= 1:
+        _init_worker(search_paths, cache_dir, sidecar, validate)
+        return [build_variant(variant) for variant in variants]
+
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(variants) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(search_paths, cache_dir, sidecar, validate)) as pool:
+        return list(pool.map(build_variant, variants, chunksize=chunksize))
+
+
+def main(argv=None):
+    """
+    main: Entry point of the pyesi command
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code
+    """
+    parser = argparse.ArgumentParser(prog="pyesi", description="Build the ESI files of a fleet of device variants.")
+    parser.add_argument("manifest", help="YAML or JSON manifest listing the variants to build")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--cache-dir", default=None, help="directory of a device cache reused between runs")
+    parser.add_argument("--sidecar", action="store_true", help="record a .sha256 digest next to each output file")
+    parser.add_argument("--validate", action="store_true", help="check each ESI for model errors before generating it")
+    args = parser.parse_args(argv)
+
+    variants = load_manifest(args.manifest)
+    search_paths = [os.path.dirname(os.path.abspath(args.manifest)), os.getcwd()]
+
+    start = time.perf_counter()
+    try:
+        results = build_fleet(variants, jobs=args.jobs, search_paths=search_paths, cache_dir=args.cache_dir,
+                              sidecar=args.sidecar, validate=args.validate)
+    except ValidationError as e:
+        print(e, file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    for output, build_time, write_time, written in results:
+        status = "written" if written else "unchanged"
+        print(f"{build_time * 1000:9.2f} ms build {write_time * 1000:9.2f} ms write  {status:9}  {output}")
+    unchanged = sum(not written for *_, written in results)
+    print(f"{len(results)} ESI files generated in {elapsed:.2f} s ({unchanged} unchanged)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
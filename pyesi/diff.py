@@ -0,0 +1,126 @@
+import argparse
+import sys
+
+# the hashed trees live in pyesi.cache (they key the device cache), re-exported here
+from pyesi.cache import Node, device_tree, esi_tree
+
+
+class Change:
+    """
+    Change: A semantic difference between two trees
+
+    kind: "added", "removed", "changed" or "reordered"
+    path: Labels of the nodes from the root to the changed node
+    field: Name of the changed field ("changed" only)
+    old: Old value of the field ("changed" only)
+    new: New value of the field ("changed" only)
+    """
+
+    def __init__(self, kind, path, field=None, old=None, new=None):
+        self.kind = kind
+        self.path = path
+        self.field = field
+        self.old = old
+        self.new = new
+
+    def __str__(self):
+        location = " / ".join(self.path)
+        if self.kind == "changed":
+            return f"{location}: {self.field} {self.old!r} -> {self.new!r}"
+        return f"{location}: {self.kind}"
+
+    def __repr__(self):
+        return f"Change({str(self)!r})"
+
+
+def diff_trees(old, new, path=()):
+    """
+    diff_trees: Compare two hashed trees
+
+    Subtrees with the same hash are skipped without being visited, so the
+    cost only depends on the size of what changed.
+
+    old: The old Node
+    new: The new Node
+    path: Labels of the parents of the nodes
+
+    return: The list of Change
+    """
+    if old.hash == new.hash:
+        return []
+    path = path + (new.label,)
+    changes = []
+    for field, value in old.fields.items():
+        if new.fields.get(field) != value:
+            changes.append(Change("changed", path, field, value, new.fields.get(field)))
+    for field, value in new.fields.items():
+        if field not in old.fields:
+            changes.append(Change("changed", path, field, None, value))
+
+    common = []
+    for key, child in old.children.items():
+        if key in new.children:
+            common.append(key)
+            changes += diff_trees(child, new.children[key], path)
+        else:
+            changes.append(Change("removed", path + (child.label,)))
+    for key, child in new.children.items():
+        if key not in old.children:
+            changes.append(Change("added", path + (child.label,)))
+    if common != [key for key in new.children if key in old.children]:
+        changes.append(Change("reordered", path))
+    return changes
+
+
+def diff_esi(old, new):
+    """
+    diff_esi: Compare two ESI models, see diff_trees
+
+    old: The old ESI
+    new: The new ESI
+
+    return: The list of Change
+    """
+    return diff_trees(esi_tree(old), esi_tree(new))
+
+
+def load_tree(filename):
+    """
+    load_tree: Build the hashed tree of an ESI file or spec
+
+    filename: An ESI XML file, or a YAML/JSON spec
+
+    return: The esi Node
+    """
+    from pyesi.loader import load_esi
+    from pyesi.reader import read_esi
+
+    return esi_tree(read_esi(filename) if filename.lower().endswith(".xml") else load_esi(filename))
+
+
+def main(argv=None):
+    """
+    main: Entry point of python -m pyesi.diff
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code, 1 if the files differ
+    """
+    parser = argparse.ArgumentParser(prog="python -m pyesi.diff", description="Structural diff of ESI specs and files.")
+    parser.add_argument("old", help="old YAML/JSON spec or ESI XML file")
+    parser.add_argument("new", help="new YAML/JSON spec or ESI XML file")
+    parser.add_argument("--hashes", action="store_true", help="print the hash of each device of the new file")
+    args = parser.parse_args(argv)
+
+    old, new = load_tree(args.old), load_tree(args.new)
+    if args.hashes:
+        for device in new.children.values():
+            print(f"{device.hash}  {device.label}")
+    changes = diff_trees(old, new)
+    for change in changes:
+        print(change)
+    return 1 if changes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,15 @@
+import copy
+import sys
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from array import array
+from collections.abc import MutableSequence
+from functools import lru_cache
 import yaml
 
+from pyesi.allocator import ObjectAllocator, parse_index
+from pyesi.cache import device_key, write_if_changed
+from pyesi.stats import phase
+
 from enum import Enum
 
 class EntryType(Enum):
@@ -12,11 +20,25 @@ class EntryType(Enum):
     UINT16: 16-bit unsigned integer
     UINT32: 32-bit unsigned integer
     REAL: 32-bit float
+    BOOL: 1-bit boolean
+    INT8: 8-bit signed integer
+    INT16: 16-bit signed integer
+    INT32: 32-bit signed integer
+    UINT64: 64-bit unsigned integer
+    INT64: 64-bit signed integer
+    LREAL: 64-bit float
     """
     UINT8 = "UINT8"
     UINT16 = "UINT16"
     UINT32 = "UINT32"
     REAL = "REAL"
+    BOOL = "BOOL"
+    INT8 = "INT8"
+    INT16 = "INT16"
+    INT32 = "INT32"
+    UINT64 = "UINT64"
+    INT64 = "INT64"
+    LREAL = "LREAL"
 
     def bitlen(self):
         if self == self.UINT8:
@@ -27,6 +49,16 @@ class EntryType(Enum):
             return "32"
         if self == self.REAL:
             return "32"
+        if self == self.BOOL:
+            return "1"
+        if self == self.INT8:
+            return "8"
+        if self == self.INT16:
+            return "16"
+        if self == self.INT32:
+            return "32"
+        if self in (self.UINT64, self.INT64, self.LREAL):
+            return "64"
 
 class SyncManagerType(Enum):
     """
@@ -60,14 +92,8 @@ class SyncManager:
     control_byte: Control byte of the Sync Manager
     dir: Direction of the Sync Manager
     """
-        
-    name = "Sync Manager"
-    sm_type = SyncManagerType.BUFFERED
-    address = "1000"
-    enabled = True
-    default_size = 128
-    control_byte = "#x64"
-    dir = SyncManagerDir.Rx
+    
+    __slots__ = ("name", "sm_type", "address", "enabled", "default_size", "control_byte", "dir")
     
     def __init__(self, name, address, sm_type, sm_dir, default_size = None, enabled = 1):
         self.name = name
@@ -94,23 +120,143 @@ class Entry:
     Entry: Class for the entry of the PDO
     
     name: Name of the entry
-    bitlen: Bit length of the entry
-    type: Type of the entry
+    bitlen: Bit length of the entry (None for the bit length of its type)
+    type: Type of the entry (None for a padding gap of bitlen bits)
     index: Index of the entry
     sub_index: Sub index of the entry
     """
     
-    name = "Test Entry"
-    bitlen = "8"
-    type = EntryType.UINT8
-    index = None
-    sub_index = 0
+    __slots__ = ("name", "type", "index", "sub_index", "bitlen")
 
-    def __init__(self, name, type, index =None, sub_index = 0):
+    def __init__(self, name, type, index =None, sub_index = 0, bitlen = None):
         self.name = name
         self.type = type
         self.index = index
         self.sub_index = sub_index
+        self.bitlen = bitlen
+
+class EntryArray(MutableSequence):
+    """
+    EntryArray: Compact struct-of-arrays storage of PDO entries
+    
+    Behaves like a list of Entry, but stores the fields in typed arrays and
+    only creates Entry objects when items are accessed one by one.
+    
+    names: Names of the entries (interned strings)
+    types: EntryType codes of the entries
+    indices: Codes of the entry indices in index_values
+    index_values: Distinct index values, code 0 is None
+    sub_indices: Sub indices of the entries
+    bitlens: Bit lengths of the entries
+    """
+    
+    def __init__(self, entries=()):
+        self.names = []
+        self.types = array("B")
+        self.indices = array("H")
+        self.index_values = [None]
+        self._index_codes = {None: 0}
+        self.sub_indices = array("H")
+        self.bitlens = array("B")
+        self.extend(entries)
+    
+    def _index_code(self, index):
+        code = self._index_codes.get(index)
+        if code is None:
+            code = len(self.index_values)
+            self.index_values.append(index)
+            self._index_codes[index] = code
+        return code
+    
+    def add(self, name, type, index=None, sub_index=0):
+        """
+        add: Add an entry without creating an Entry object
+        
+        name: Name of the entry
+        type: Type of the entry
+        index: Index of the entry
+        sub_index: Sub index of the entry
+        """
+        if type is None:
+            raise TypeError("EntryArray can't store padding entries, use a list of Entry")
+        self.names.append(sys.intern(name))
+        self.types.append(_ENTRY_TYPE_CODES[type])
+        self.indices.append(self._index_code(index))
+        self.sub_indices.append(sub_index)
+        self.bitlens.append(_ENTRY_TYPE_BITLENS[type])
+    
+    def add_array(self, name, type, index, count, first_sub_index=1):
+        """
+        add_array: Add the entries of an array object in a single call
+        
+        name: Name of the entries
+        type: Type of the entries
+        index: Index of the array object
+        count: Number of entries
+        first_sub_index: Sub index of the first entry
+        """
+        self.names.extend([sys.intern(name)] * count)
+        self.types.extend(array("B", [_ENTRY_TYPE_CODES[type]]) * count)
+        self.indices.extend(array("H", [self._index_code(index)]) * count)
+        self.sub_indices.extend(range(first_sub_index, first_sub_index + count))
+        self.bitlens.extend(array("B", [_ENTRY_TYPE_BITLENS[type]]) * count)
+    
+    def iter_fields(self):
+        """
+        iter_fields: Iterate over the entries without creating Entry objects
+        
+        return: A generator of (name, type, index, sub_index, bitlen) tuples
+        """
+        types = _ENTRY_TYPES
+        index_values = self.index_values
+        for name, type_code, index_code, sub_index, bitlen in zip(self.names, self.types, self.indices, self.sub_indices, self.bitlens):
+            yield name, types[type_code], index_values[index_code], sub_index, bitlen
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        index = self.index_values[self.indices[i]]
+        return Entry(self.names[i], _ENTRY_TYPES[self.types[i]], index, self.sub_indices[i])
+    
+    def __setitem__(self, i, entry):
+        if isinstance(i, slice):
+            raise TypeError("EntryArray does not support slice assignment")
+        self.names[i] = sys.intern(entry.name)
+        self.types[i] = _ENTRY_TYPE_CODES[entry.type]
+        self.indices[i] = self._index_code(entry.index)
+        self.sub_indices[i] = entry.sub_index
+        self.bitlens[i] = _ENTRY_TYPE_BITLENS[entry.type]
+    
+    def __delitem__(self, i):
+        for column in (self.names, self.types, self.indices, self.sub_indices, self.bitlens):
+            del column[i]
+    
+    def insert(self, i, entry):
+        self.names.insert(i, sys.intern(entry.name))
+        self.types.insert(i, _ENTRY_TYPE_CODES[entry.type])
+        self.indices.insert(i, self._index_code(entry.index))
+        self.sub_indices.insert(i, entry.sub_index)
+        self.bitlens.insert(i, _ENTRY_TYPE_BITLENS[entry.type])
+    
+    def append(self, entry):
+        self.add(entry.name, entry.type, entry.index, entry.sub_index)
+    
+    def extend(self, entries):
+        if isinstance(entries, EntryArray):
+            for name, type, index, sub_index, _ in entries.iter_fields():
+                self.add(name, type, index, sub_index)
+            return
+        for entry in entries:
+            self.append(entry)
+
+
+_ENTRY_TYPES = list(EntryType)
+_ENTRY_TYPE_CODES = {entry_type: code for code, entry_type in enumerate(_ENTRY_TYPES)}
+_ENTRY_TYPE_BITLENS = {entry_type: int(entry_type.bitlen()) for entry_type in _ENTRY_TYPES}
+
 
 class PDOs:
     """
@@ -118,15 +264,63 @@ class PDOs:
     
     name: Name of the PDO group
     sm_index: Index of the Sync Manager
-    entries: List of entries in the PDO group
+    index: Index of the PDO (hex digits, allocated by create_device when None)
+    entries: List of entries in the PDO group (a list of Entry or an EntryArray)
+    compact: Store the entries in an EntryArray
     """
     
-    name = "Test PDOs"
-    sm_index = 0
-    entries = []
+    __slots__ = ("name", "sm_index", "index", "entries")
 
-    def __init__(self):
-        self.entries = []
+    def __init__(self, compact=False):
+        self.name = "Test PDOs"
+        self.sm_index = 0
+        self.index = None
+        self.entries = EntryArray() if compact else []
+
+    def add_entry(self, name, type, index=None, sub_index=0):
+        """
+        add_entry: Add an entry to the PDO group
+        
+        name: Name of the entry
+        type: Type of the entry
+        index: Index of the entry
+        sub_index: Sub index of the entry
+        """
+        if isinstance(self.entries, EntryArray):
+            self.entries.add(name, type, index, sub_index)
+        else:
+            self.entries.append(Entry(name=name, type=type, index=index, sub_index=sub_index))
+
+    def add_array(self, name, type, index, count, first_sub_index=1):
+        """
+        add_array: Add the entries of an array object, with consecutive sub
+        indices, in a single call
+        
+        name: Name of the entries
+        type: Type of the entries
+        index: Index of the array object
+        count: Number of entries
+        first_sub_index: Sub index of the first entry
+        """
+        if isinstance(self.entries, EntryArray):
+            self.entries.add_array(name, type, index, count, first_sub_index)
+        else:
+            self.entries.extend(Entry(name=name, type=type, index=index, sub_index=first_sub_index + i) for i in range(count))
+
+    def iter_entries(self):
+        """
+        iter_entries: Iterate over the fields of the entries
+        
+        return: An iterator of (name, type, index, sub_index, bitlen) tuples
+        """
+        if isinstance(self.entries, EntryArray):
+            return self.entries.iter_fields()
+        return ((entry.name, entry.type, entry.index, entry.sub_index, entry.bitlen or entry.type.bitlen()) for entry in self.entries)
+
+
+# Default Sync0 timing of the DC_Sync mode, in ns
+DC_CYCLE_TIME = 0
+DC_SHIFT_TIME = 2000200000
 
 
 class Device:
@@ -134,25 +328,521 @@ class Device:
     Device: Class representing a slave device
     
     name: Name of the device
+    product_code: Product code of the device
+    revision_no: Revision number of the device
+    sync_managers: List of Sync Managers
     TxPdos: List of Transmit PDOs
     RxPdos: List of Receive PDOs
     enable_sdos: Enable SDOs
     enable_foe: Enable FoE
+    sdo_info: Support the SDO information service (CoE)
+    segmented_sdo: Support segmented SDO transfers (CoE)
+    complete_access: Support SDO complete access, reading or writing all
+                     the sub indices of an object in one transfer (CoE)
+    embed_dictionary: Embed the CoE object dictionary in the ESI when SDOs
+                      are enabled, so masters don't upload it over SDO info
+    dc_cycle_time: Sync0 cycle time of the DC_Sync mode in ns (0 for the
+                   cycle time of the master), see pyesi.timing
+    dc_shift_time: Sync0 shift time of the DC_Sync mode in ns
+    pdo_sets: Alternative PDO assignments, dictionary of the names of the
+              PDOs of each set (the first set is assigned by default). Empty
+              for a single, mandatory, assignment of all the PDOs
     """
     
-    name = "Test Device"
-    
-    sync_managers = []
-    
-    TxPdos = []
-    RxPdos = []
-    
-    enable_sdos = False
-    enable_foe = False
+    __slots__ = ("name", "product_code", "revision_no", "sync_managers", "TxPdos", "RxPdos", "enable_sdos", "enable_foe",
+                 "sdo_info", "segmented_sdo", "complete_access", "embed_dictionary", "dc_cycle_time", "dc_shift_time",
+                 "pdo_sets")
 
     def __init__(self):
+        self.name = "Test Device"
+        self.product_code = "#x1"
+        self.revision_no = "#x1"
+        self.sync_managers = []
         self.TxPdos = []
         self.RxPdos = []
+        self.enable_sdos = False
+        self.enable_foe = False
+        self.sdo_info = True
+        self.segmented_sdo = True
+        self.complete_access = False
+        self.embed_dictionary = True
+        self.dc_cycle_time = DC_CYCLE_TIME
+        self.dc_shift_time = DC_SHIFT_TIME
+        self.pdo_sets = {}
+
+    def add_pdo_set(self, name, pdo_names):
+        """
+        add_pdo_set: Add an alternative PDO assignment
+        
+        name: Name of the set ("minimal", "position", "full"...)
+        pdo_names: Names of the RxPdos and TxPdos of the set
+        """
+        self.pdo_sets[name] = list(pdo_names)
+
+    def optional_pdos(self):
+        """
+        optional_pdos: The PDOs missing from at least one PDO set
+        
+        return: The set of the names of the optional PDOs (empty without
+                pdo_sets: every PDO is mandatory)
+        """
+        if not self.pdo_sets:
+            return set()
+        names = {pdo.name for pdos_list in (self.RxPdos, self.TxPdos) for pdo in pdos_list}
+        return names - set.intersection(*(set(pdo_names) for pdo_names in self.pdo_sets.values()))
+
+    def pdo_exclusions(self):
+        """
+        pdo_exclusions: The PDOs that can't be assigned together
+        
+        Two PDOs of the same direction exclude each other when no set holds
+        both of them.
+        
+        return: Dictionary of the names of the excluded PDOs by PDO name
+                (empty without pdo_sets)
+        """
+        exclusions = {}
+        if not self.pdo_sets:
+            return exclusions
+        sets = [set(names) for names in self.pdo_sets.values()]
+        for pdos_list in (self.RxPdos, self.TxPdos):
+            for pdo in pdos_list:
+                excluded = [other.name for other in pdos_list if other is not pdo and
+                            not any(pdo.name in names and other.name in names for names in sets)]
+                if excluded:
+                    exclusions[pdo.name] = excluded
+        return exclusions
+
+    def iter_mapped_pdos(self):
+        """
+        iter_mapped_pdos: Iterate over the PDOs as they are mapped in the ESI
+        (RxPdos, then TxPdos), with their indices resolved
+        
+        The indices given in the model are reserved first. PDOs without an
+        index then get the lowest free one of the RxPdo (0x1600) or TxPdo
+        (0x1A00) range, entries without an index the lowest free one of the
+        manufacturer range (0x2000), see pyesi.allocator. The indices are
+        written as 4 hex digits.
+        
+        return: A generator of (tag, pdos, pdo_index, entries) with tag
+                "RxPdo" or "TxPdo" and entries a list of (name, type, index,
+                sub_index, bitlen) tuples
+        """
+        allocator = ObjectAllocator()
+        parsed = {}
+
+        def resolve(index):
+            # normalized hex digits of an index, unparsable ones are kept as is
+            resolved = parsed.get(index)
+            if resolved is None:
+                try:
+                    value = parse_index(index)
+                except ValueError:
+                    resolved = parsed[index] = (None, index)
+                else:
+                    resolved = parsed[index] = (value, f"{value:04X}")
+            return resolved
+
+        pdos_lists = (("RxPdo", self.RxPdos), ("TxPdo", self.TxPdos))
+        for tag, pdos_list in pdos_lists:
+            for pdo in pdos_list:
+                if pdo.index is not None:
+                    value = resolve(pdo.index)[0]
+                    if value is not None:
+                        allocator.reserve(value)
+                for _, entry_type, entry_idx, _, _ in pdo.iter_entries():
+                    if entry_type is not None and entry_idx is not None:
+                        value = resolve(entry_idx)[0]
+                        if value is not None:
+                            allocator.reserve(value)
+
+        for tag, pdos_list in pdos_lists:
+            for pdo in pdos_list:
+                if pdo.index is None:
+                    index = f"{allocator.allocate(tag):04X}"
+                else:
+                    index = resolve(pdo.index)[1]
+                entries = []
+                for name, entry_type, entry_idx, sub_index, bitlen in pdo.iter_entries():
+                    if entry_type is None:
+                        entry_idx = entry_idx or 0
+                    elif entry_idx is None:
+                        entry_idx = f"{allocator.allocate('manufacturer'):04X}"
+                    else:
+                        entry_idx = resolve(entry_idx)[1]
+                    entries.append((name, entry_type, entry_idx, sub_index, bitlen))
+                yield tag, pdo, index, entries
+
+
+class Fragment(ET.Element):
+    """
+    Fragment: Element whose subtree never changes once built
+    
+    Fragments are built once per parameter set and cached, they never leave
+    this module: the trees get copies (see _copy_fragment). The pretty writer
+    renders each fragment once per indentation level and splices the
+    rendered text in place of the copies that were not modified.
+    
+    rendered: The rendered text per (level, indent)
+    """
+    
+    def __init__(self, tag, attrib={}, **extra):
+        super().__init__(tag, attrib, **extra)
+        self.rendered = {}
+
+
+class _FragmentCopy(ET.Element):
+    """
+    _FragmentCopy: Copy of a Fragment in a tree
+    
+    source: The Fragment it was copied from
+    """
+    
+    def __init__(self, tag, attrib={}, **extra):
+        super().__init__(tag, attrib, **extra)
+        self.source = None
+
+
+def _copy_fragment(fragment):
+    """
+    _copy_fragment: Copy a Fragment, the copy can be modified freely
+    
+    fragment: The Fragment
+    
+    return: The copy
+    """
+    element = _FragmentCopy(fragment.tag, fragment.attrib)
+    element.text = fragment.text
+    element[:] = [copy.deepcopy(child) for child in fragment]
+    element.source = fragment
+    return element
+
+
+def _unchanged(element, source):
+    """
+    _unchanged: Compare a subtree to the one it was copied from (the tail of
+    element itself is not part of the rendered text and is ignored)
+    
+    return: True if both have the same content
+    """
+    if element.tail != source.tail:
+        # same walk, with the tails of the roots made equal
+        element = copy.copy(element)
+        element.tail = source.tail
+    for node, source_node in zip(element.iter(), source.iter()):
+        if (node.tag != source_node.tag or node.text != source_node.text or node.tail != source_node.tail
+                or len(node) != len(source_node) or node.attrib != source_node.attrib):
+            return False
+    return True
+
+
+def _as_fragment(element):
+    """
+    _as_fragment: Turn a built element into a Fragment with the same subtree
+    
+    element: The element, left empty
+    
+    return: The Fragment
+    """
+    fragment = Fragment(element.tag, element.attrib)
+    fragment.text, fragment.tail = element.text, element.tail
+    fragment[:] = list(element)
+    return fragment
+
+
+@lru_cache(maxsize=128)
+def _vendor_fragment(vendor_id, vendor_name):
+    vendor = Fragment("Vendor")
+    ET.SubElement(vendor, "Id").text = vendor_id
+    ET.SubElement(vendor, "Name").text = vendor_name
+    ET.SubElement(vendor, "ImageData16x14").text = (
+        "424dd6020000000000003600000028000000100000000e0000000100180000000000a0020000c40e0000c40e000000000000000000004cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb122ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff241cedffffff241cedffffff241ced241cedffffffffffffffffff241ced241ced241cedffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffffffffff241cedffffffffffff241ced241ced241cedffffff241ced241cedffffffffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffffffffffffffffffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffffffffffffffffffffff241ced241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
+    )
+    return vendor
+
+
+@lru_cache(maxsize=128)
+def _group_fragment(group_type, group_name):
+    group = Fragment("Group", SortOrder="0")
+    ET.SubElement(group, "Type").text =  group_type
+    ET.SubElement(group, "Name", LcId="1033").text = group_name
+    ET.SubElement(group, "ImageData16x14").text = (
+    "424dd6020000000000003600000028000000100000000e0000000100180000000000a0020000c40e0000c40e00000000000000000000241ced241ced241ced241cedffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241ced241ced241ced241ced241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241ced241cedffffff241ced241cedffffff241cedffffff241cedffffff241ced241ced241ced241ced241cedffffffffffff241ced241ced241cedffffffffffff241ced241ced241ced241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff241ced241ced241cedffffffffffff241ced241ced241cedffffff241ced241ced241cedffffff241ced241ced241ced241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241ced241cedffffffffffffffffffffffff241ced241cedffffffffffff241ced241ced241cedffffff241ced241ced241ced241ced241cedffffffffffffffffffffffffffffff241cedffffff241cedffffffffffffffffff241cedffffff241ced241cedffffffffffffffffffffffff241ced241ced241cedffffff241ced241ced241cedffffff241cedffffff241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff241ced241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
+    )
+    return group
+
+
+@lru_cache(maxsize=None)
+def _sync_manager_fragment(cycle_time=DC_CYCLE_TIME, shift_time=DC_SHIFT_TIME):
+    sync_manager = Fragment("Dc")
+
+
+    op_mode1 = ET.SubElement(sync_manager, "OpMode")
+    ET.SubElement(op_mode1, "Name").text = "SM_Sync or Async"
+    ET.SubElement(op_mode1, "Desc").text = "SM_Sync or Async"
+    ET.SubElement(op_mode1, "AssignActivate").text = "#x0000"
+
+
+    op_mode = ET.SubElement(sync_manager, "OpMode")
+    ET.SubElement(op_mode, "Name").text = "DC_Sync"
+    ET.SubElement(op_mode, "Desc").text = "DC_Sync"
+    ET.SubElement(op_mode, "AssignActivate").text = "#x300"
+    ET.SubElement(op_mode, "CycleTimeSync0", Factor="1").text = f"{cycle_time}"
+    ET.SubElement(op_mode, "ShiftTimeSync0").text = f"{shift_time}"
+    return sync_manager
+
+
+# EEPROM configuration of the LAN9252 (see _lan9252_fragment for the details)
+LAN9252_EEPROM_BYTE_SIZE = 4096
+LAN9252_CONFIG_DATA = "8003006EFF00FF000000"
+LAN9252_BOOTSTRAP = "0010800080108000"
+
+
+@lru_cache(maxsize=None)
+def _lan9252_fragment():
+    eeprom = Fragment("Eeprom")
+    ET.SubElement(eeprom, "ByteSize").text = f"{LAN9252_EEPROM_BYTE_SIZE}"
+    ET.SubElement(eeprom, "ConfigData").text = LAN9252_CONFIG_DATA
+    eeprom.append(ET.Comment("0x140   0x80 PDI type LAN9252 Spi  "))
+    eeprom.append(ET.Comment("0x141   0x03 device emulation     "))
+    eeprom.append(ET.Comment("        enhanced link detection        "))
+    eeprom.append(ET.Comment("0x150   0x00 not used for LAN9252 Spi  "))
+    eeprom.append(ET.Comment("0x151   0x6E map Sync0 to AL event     "))
+    eeprom.append(ET.Comment("        Sync0/Latch0 assigned to Sync0 "))
+    eeprom.append(ET.Comment("        Sync1/Latch1 assigned to Sync1 "))
+    eeprom.append(ET.Comment("        Sync0/1 push/pull active high  "))
+    eeprom.append(ET.Comment("0x982-3 0x00FF Sync0/1 lenght = 2.5uS  "))
+    eeprom.append(ET.Comment("0x152   0xFF all GPIO set to out       "))
+    eeprom.append(ET.Comment("0x153   0x00 reserved                  "))
+    eeprom.append(ET.Comment("0x12-13 0x0000 alias address           "))
+    eeprom.append(ET.Comment("see more here: https://ww1.microchip.com/downloads/en/AppNotes/00001920A.pdf"))
+    ET.SubElement(eeprom, "BootStrap").text = LAN9252_BOOTSTRAP
+    return eeprom
+
+
+def _xml_bool(value):
+    return "true" if value else "false"
+
+
+def _little_endian_hex(value, size):
+    """
+    _little_endian_hex: Format a value as the hex bytes of a DefaultData
+    
+    value: The integer value
+    size: Size of the value in bytes
+    
+    return: The hex digits, least significant byte first
+    """
+    return value.to_bytes(size, "little").hex().upper()
+
+
+@lru_cache(maxsize=None)
+def _base_data_type_fragment(name, bitsize):
+    data_type = Fragment("DataType")
+    ET.SubElement(data_type, "Name").text = name
+    ET.SubElement(data_type, "BitSize").text = f"{bitsize}"
+    return data_type
+
+
+@lru_cache(maxsize=None)
+def _array_data_type_fragment(name, base_type, bitsize, elements):
+    data_type = Fragment("DataType")
+    ET.SubElement(data_type, "Name").text = name
+    ET.SubElement(data_type, "BaseType").text = base_type
+    ET.SubElement(data_type, "BitSize").text = f"{bitsize}"
+    array_info = ET.SubElement(data_type, "ArrayInfo")
+    ET.SubElement(array_info, "LBound").text = "1"
+    ET.SubElement(array_info, "Elements").text = f"{elements}"
+    return data_type
+
+
+@lru_cache(maxsize=None)
+def _record_data_type_fragment(name, bitsize, sub_items):
+    data_type = Fragment("DataType")
+    ET.SubElement(data_type, "Name").text = name
+    ET.SubElement(data_type, "BitSize").text = f"{bitsize}"
+    for sub_index, item_name, item_type, item_bitsize, bit_offset, access, pdo_mapping in sub_items:
+        sub_item = ET.SubElement(data_type, "SubItem")
+        if sub_index is not None:
+            ET.SubElement(sub_item, "SubIdx").text = f"{sub_index}"
+        ET.SubElement(sub_item, "Name").text = item_name
+        ET.SubElement(sub_item, "Type").text = item_type
+        ET.SubElement(sub_item, "BitSize").text = f"{item_bitsize}"
+        ET.SubElement(sub_item, "BitOffs").text = f"{bit_offset}"
+        flags = ET.SubElement(sub_item, "Flags")
+        ET.SubElement(flags, "Access").text = access
+        if pdo_mapping is not None:
+            ET.SubElement(flags, "PdoMapping").text = pdo_mapping
+    return data_type
+
+
+class _Dictionary:
+    """
+    _Dictionary: Builder of the CoE object dictionary of a device
+    
+    Data types are keyed by their definition: an array or record layout
+    used by several objects is defined once, named after the first of them.
+    
+    mapped: The mapped PDOs of the device, see Device.iter_mapped_pdos
+    assigned: Names of the PDOs assigned by default (None for all of them,
+              with read-only assignment objects)
+    """
+    
+    def __init__(self, mapped, assigned=None):
+        self.data_types = {}
+        self.objects = []
+        variables = {}
+        for tag, pdo, pdo_index, entries in mapped:
+            access, pdo_mapping = ("rw", "R") if tag == "RxPdo" else ("ro", "T")
+            for name, entry_type, index, sub_index, bitlen in entries:
+                if entry_type is None:
+                    continue
+                variable = variables.setdefault(index, {"name": name, "access": access, "pdo_mapping": pdo_mapping, "subs": {}})
+                variable["subs"].setdefault(sub_index, (name, entry_type.value, int(bitlen)))
+        for index in sorted(variables, key=parse_index):
+            self.add_variable(index, variables[index])
+        
+        # PDO assignment object 0x1C10 + n of each sync manager n
+        assignments = {}
+        for tag, pdo, pdo_index, entries in mapped:
+            values = [(parse_index(index) << 16 | (sub_index if entry_type is not None else 0) << 8 | int(bitlen), 4)
+                      for name, entry_type, index, sub_index, bitlen in entries]
+            self.add_array(pdo_index, pdo.name, EntryType.UINT32.value, 32, "ro", None, values)
+            selected, others = assignments.setdefault(int(pdo.sm_index), ([], []))
+            (selected if assigned is None or pdo.name in assigned else others).append((parse_index(pdo_index), 2))
+        # with alternative PDO sets, the assignment lists the first set and
+        # has room for all the PDOs
+        access = "ro" if assigned is None else "rw"
+        for sm_index, (selected, others) in sorted(assignments.items()):
+            self.add_array(f"{0x1C10 + sm_index:04X}", f"Sync manager {sm_index} PDO assignment", EntryType.UINT16.value,
+                           16, access, None, selected + [(0, 2)] * len(others), used=len(selected), sub0_access=access)
+        self.objects.sort(key=lambda item: parse_index(item[0]))
+    
+    def data_type(self, key, fragment):
+        """
+        data_type: Register a data type, once per definition
+        
+        key: The definition of the data type
+        fragment: Function creating the DataType element
+        
+        return: The name of the data type
+        """
+        element = self.data_types.get(key)
+        if element is None:
+            element = self.data_types[key] = fragment()
+        return element.find("Name").text
+    
+    def base_type(self, type_name, bitsize):
+        return self.data_type((type_name, bitsize), lambda: _base_data_type_fragment(type_name, bitsize))
+    
+    def add_variable(self, index, variable):
+        """
+        add_variable: Add the object of the entries mapped at an index
+        
+        index: The index of the object
+        variable: The name, access, pdo_mapping and subs (sub index: (name,
+                  type, bitlen)) of the object
+        """
+        subs = variable["subs"]
+        access, pdo_mapping = variable["access"], variable["pdo_mapping"]
+        if list(subs) == [0]:
+            name, type_name, bitlen = subs[0]
+            type_name = self.base_type(type_name, bitlen)
+            self.objects.append((index, variable["name"], type_name, bitlen, access, pdo_mapping, None))
+            return
+        
+        items = sorted((sub_index, item) for sub_index, item in subs.items() if sub_index > 0)
+        count = items[-1][0]
+        types = {(type_name, bitlen) for _, (_, type_name, bitlen) in items}
+        if len(types) == 1 and len(items) == count:
+            type_name, bitlen = types.pop()
+            self.add_array(index, variable["name"], type_name, bitlen, access, pdo_mapping, [None] * count,
+                           [name for _, (name, _, _) in items])
+            return
+        
+        # record of different types (or with gaps)
+        self.base_type(EntryType.UINT8.value, 8)
+        sub_items = [(0, "SubIndex 000", EntryType.UINT8.value, 8, 0, "ro", None)]
+        bit_offset = 16
+        for sub_index, (name, type_name, bitlen) in items:
+            sub_items.append((sub_index, name, self.base_type(type_name, bitlen), bitlen, bit_offset, access, pdo_mapping))
+            bit_offset += bitlen
+        record = ("record", bit_offset, tuple(sub_items))
+        type_name = self.data_type(record, lambda: _record_data_type_fragment(f"DT{parse_index(index):04X}", bit_offset, tuple(sub_items)))
+        info = [(f"{count:02X}", "SubIndex 000")] + [(None, name) for _, (name, _, _) in items]
+        self.objects.append((index, variable["name"], type_name, bit_offset, access, pdo_mapping, info))
+    
+    def add_array(self, index, name, type_name, bitlen, access, pdo_mapping, values, names=None, used=None,
+                  sub0_access="ro"):
+        """
+        add_array: Add an array object
+        
+        index: The index of the object
+        name: The name of the object
+        type_name: The type of the elements
+        bitlen: The bit length of the elements
+        access: The access of the elements
+        pdo_mapping: The PdoMapping flag of the elements (None if not mappable)
+        values: The (value, size in bytes) default data of the elements, or
+                None for the elements without default data
+        names: The names of the elements (None for "SubIndex nnn")
+        used: The default number of elements in use (sub index 0), all by
+              default
+        sub0_access: The access of sub index 0
+        """
+        count = len(values)
+        element_type = self.base_type(type_name, bitlen)
+        self.base_type(EntryType.UINT8.value, 8)
+        array_name = f"ARRAY [1..{count}] OF {element_type}"
+        self.data_type(("array", element_type, count),
+                       lambda: _array_data_type_fragment(array_name, element_type, count * bitlen, count))
+        bitsize = 16 + count * bitlen
+        sub_items = ((0, "SubIndex 000", EntryType.UINT8.value, 8, 0, sub0_access, None),
+                     (None, "Elements", array_name, count * bitlen, 16, access, pdo_mapping))
+        type_name = self.data_type(("record", bitsize, sub_items),
+                                   lambda: _record_data_type_fragment(f"DT{parse_index(index):04X}", bitsize, sub_items))
+        info = [(f"{count if used is None else used:02X}", "SubIndex 000")]
+        for i, value in enumerate(values):
+            item_name = names[i] if names is not None else f"SubIndex {i + 1:03}"
+            info.append((None if value is None else _little_endian_hex(*value), item_name))
+        self.objects.append((index, name, type_name, bitsize, access, pdo_mapping, info))
+    
+    def to_element(self):
+        profile = ET.Element("Profile")
+        dictionary = ET.SubElement(profile, "Dictionary")
+        data_types = ET.SubElement(dictionary, "DataTypes")
+        for element in sorted(self.data_types.values(), key=_data_type_order):
+            data_types.append(_copy_fragment(element))
+        objects = ET.SubElement(dictionary, "Objects")
+        for index, name, type_name, bitsize, access, pdo_mapping, info in self.objects:
+            obj = ET.SubElement(objects, "Object")
+            ET.SubElement(obj, "Index").text = f"#x{index}"
+            ET.SubElement(obj, "Name").text = name
+            ET.SubElement(obj, "Type").text = type_name
+            ET.SubElement(obj, "BitSize").text = f"{bitsize}"
+            if info is not None:
+                info_element = ET.SubElement(obj, "Info")
+                for default_data, item_name in info:
+                    sub_item = ET.SubElement(info_element, "SubItem")
+                    ET.SubElement(sub_item, "Name").text = item_name
+                    if default_data is not None:
+                        ET.SubElement(ET.SubElement(sub_item, "Info"), "DefaultData").text = default_data
+            flags = ET.SubElement(obj, "Flags")
+            ET.SubElement(flags, "Access").text = access
+            if pdo_mapping is not None and info is None:
+                ET.SubElement(flags, "PdoMapping").text = pdo_mapping
+        return profile
+
+
+def _data_type_order(element):
+    # base types, then arrays, then records: each type is defined before use
+    if element.find("ArrayInfo") is not None:
+        rank = 1
+    elif element.find("SubItem") is not None:
+        rank = 2
+    else:
+        rank = 0
+    return rank, element.find("Name").text
 
 
 class ESI:
@@ -166,18 +856,15 @@ class ESI:
     group_name: Group Name
     devices: List of devices
     """
-        
-    vendor_id = "Test"
-    vendor_name = "Test Name"
-
-    group_type = "SSC_Device"
-    group_name = "Test Group Name"
     
-    lan9252 = True
-
-    devices = []
+    __slots__ = ("vendor_id", "vendor_name", "group_type", "group_name", "lan9252", "devices")
 
     def __init__(self):
+        self.vendor_id = "Test"
+        self.vendor_name = "Test Name"
+        self.group_type = "SSC_Device"
+        self.group_name = "Test Group Name"
+        self.lan9252 = True
         self.devices = []
 
 
@@ -189,13 +876,7 @@ class ESI:
         
         return: The vendor element
         """
-        vendor = ET.Element("Vendor")
-        ET.SubElement(vendor, "Id").text = self.vendor_id
-        ET.SubElement(vendor, "Name").text = self.vendor_name
-        ET.SubElement(vendor, "ImageData16x14").text = (
-            "424dd6020000000000003600000028000000100000000e0000000100180000000000a0020000c40e0000c40e000000000000000000004cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb1224cb122ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff241cedffffff241cedffffff241ced241cedffffffffffffffffff241ced241ced241cedffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffffffffff241cedffffffffffff241ced241ced241cedffffff241ced241cedffffffffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffff241cedffffff241cedffffff241cedffffffffffffffffffffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffffffffffffffffffffff241ced241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
-        )
-        return vendor
+        return _copy_fragment(_vendor_fragment(self.vendor_id, self.vendor_name))
 
     def create_group(self):
         """
@@ -203,13 +884,7 @@ class ESI:
         
         return: The group element
         """
-        group = ET.Element("Group", SortOrder="0")
-        ET.SubElement(group, "Type").text =  self.group_type
-        ET.SubElement(group, "Name", LcId="1033").text = self.group_name
-        ET.SubElement(group, "ImageData16x14").text = (
-        "424dd6020000000000003600000028000000100000000e0000000100180000000000a0020000c40e0000c40e00000000000000000000241ced241ced241ced241cedffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241ced241ced241ced241ced241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffffffffff241ced241cedffffff241ced241cedffffff241cedffffff241cedffffff241ced241ced241ced241ced241cedffffffffffff241ced241ced241cedffffffffffff241ced241ced241ced241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff241ced241ced241cedffffffffffff241ced241ced241cedffffff241ced241ced241cedffffff241ced241ced241ced241cedffffffffffffffffff241cedffffffffffff241cedffffffffffffffffff241cedffffffffffffffffff241ced241cedffffffffffffffffffffffff241ced241cedffffffffffff241ced241ced241cedffffff241ced241ced241ced241ced241cedffffffffffffffffffffffffffffff241cedffffff241cedffffffffffffffffff241cedffffff241ced241cedffffffffffffffffffffffff241ced241ced241cedffffff241ced241ced241cedffffff241cedffffff241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff241ced241ced241cedffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
-        )
-        return group
+        return _copy_fragment(_group_fragment(self.group_type, self.group_name))
 
     def create_device(self, device):
         """
@@ -222,10 +897,17 @@ class ESI:
         
         device_element = ET.Element("Device", Physics="YY")
         device_element.append(ET.Comment(f"{device.name} Device"))
-        ET.SubElement(device_element, "Type", ProductCode="#x1", RevisionNo="#x1", CheckRevisionNo="EQ_OR_G").text = f'{device.name}'
+        ET.SubElement(device_element, "Type", ProductCode=device.product_code, RevisionNo=device.revision_no, CheckRevisionNo="EQ_OR_G").text = f'{device.name}'
         ET.SubElement(device_element, "Name", LcId="1033").text = f"{device.name}"
         ET.SubElement(device_element, "GroupType").text = "SSC_Device"
 
+        mapped = list(device.iter_mapped_pdos())
+        assigned = None
+        if device.pdo_sets:
+            assigned = set(next(iter(device.pdo_sets.values())))
+        if device.enable_sdos and device.embed_dictionary:
+            device_element.append(self.generate_dictionary(mapped, assigned))
+
         # Add Fmmu units
         for fmmu in device.sync_managers:
             ET.SubElement(device_element, "Fmmu").text = fmmu.name
@@ -237,94 +919,124 @@ class ESI:
             else:
                 ET.SubElement(device_element, "Sm", StartAddress=f'#x{sm.address}', DefaultSize=f"{sm.default_size}", ControlByte=sm.control_byte, Enable=f"{sm.enabled}").text = sm.name
         
-        # Add RxPDOs
-        pdo_index = 1600
-        entry_index = 10
-        for pdo in device.RxPdos:
+        # Add RxPDOs, then TxPDOs
+        exclusions = device.pdo_exclusions()
+        optional = device.optional_pdos()
+        indices = {(tag, pdo.name): pdo_index for tag, pdo, pdo_index, _ in mapped}
+        for tag, pdo, pdo_index, entries in mapped:
             device_element.append(ET.Comment(f"{pdo.name} PDOs" ))
-            rxpdo = ET.SubElement(device_element, "RxPdo", Fixed="1", Mandatory="1", Sm=f"{pdo.sm_index}")
-            ET.SubElement(rxpdo, "Index").text = f"#x{pdo_index}"
-            ET.SubElement(rxpdo, "Name").text = pdo.name
-            pdo_index += 100
-            for i, entry in enumerate(pdo.entries):
-                e = ET.SubElement(rxpdo, "Entry")
-                if entry.index is not None:
-                    ET.SubElement(e, "Index").text = f"#x{entry.index}"
-                else:
-                    ET.SubElement(e, "Index").text = f"#x{entry_index}"
-                    entry_index += 1
-                ET.SubElement(e, "SubIndex").text = f"{entry.sub_index}"
-                ET.SubElement(e, "BitLen").text = entry.type.bitlen()
-                ET.SubElement(e, "Name").text = entry.name
-                ET.SubElement(e, "DataType").text = entry.type.value
-
-        # Add TxPDOs
-        for pdo in device.TxPdos:
-            device_element.append(ET.Comment(f"{pdo.name} PDOs" ))
-            txpdo = ET.SubElement(device_element, "TxPdo", Fixed="1", Mandatory="1", Sm=f"{pdo.sm_index}")
-            ET.SubElement(txpdo, "Index").text = f"#x{pdo_index}"
-            ET.SubElement(txpdo, "Name").text = pdo.name
-            pdo_index += 100
-            for i, entry in enumerate(pdo.entries):
-                e = ET.SubElement(txpdo, "Entry")
-                if entry.index is not None:
-                    ET.SubElement(e, "Index").text = f"#x{entry.index}"
-                else:
-                    ET.SubElement(e, "Index").text = f"#x{entry_index}"
-                    entry_index += 1
-                ET.SubElement(e, "SubIndex").text = f"{entry.sub_index}"
-                ET.SubElement(e, "BitLen").text = entry.type.bitlen()
-                ET.SubElement(e, "Name").text = entry.name
-                ET.SubElement(e, "DataType").text = entry.type.value
+            if pdo.name in optional:
+                pdo_element = ET.SubElement(device_element, tag, Fixed="1", Sm=f"{pdo.sm_index}")
+            else:
+                pdo_element = ET.SubElement(device_element, tag, Fixed="1", Mandatory="1", Sm=f"{pdo.sm_index}")
+            ET.SubElement(pdo_element, "Index").text = f"#x{pdo_index}"
+            ET.SubElement(pdo_element, "Name").text = pdo.name
+            for excluded in exclusions.get(pdo.name, ()):
+                if (tag, excluded) in indices:
+                    ET.SubElement(pdo_element, "Exclude").text = f"#x{indices[tag, excluded]}"
+            for name, entry_type, index, sub_index, bitlen in entries:
+                e = ET.SubElement(pdo_element, "Entry")
+                ET.SubElement(e, "Index").text = f"#x{index}"
+                if entry_type is None:
+                    # padding gap
+                    ET.SubElement(e, "BitLen").text = f"{bitlen}"
+                    continue
+                ET.SubElement(e, "SubIndex").text = f"{sub_index}"
+                ET.SubElement(e, "BitLen").text = f"{bitlen}"
+                ET.SubElement(e, "Name").text = name
+                ET.SubElement(e, "DataType").text = entry_type.value
         
         # Add Mailbox SDO and FOE if enabled
         if device.enable_sdos:
-            device_element.append(self.generate_mailbox_config(device.enable_foe))
+            device_element.append(self.generate_mailbox_config(device.enable_foe, bool(device.pdo_sets), device.sdo_info,
+                                                               device.segmented_sdo, device.complete_access))
         
         # configure LAN9252
-        device_element.append(self.generate_sync_manager_config())
+        device_element.append(self.generate_sync_manager_config(device.dc_cycle_time, device.dc_shift_time))
         if self.lan9252:
             device_element.append(self.generate_ln9252_config())
+        if device.pdo_sets:
+            device_element.append(self.generate_alternative_mappings(device.pdo_sets, mapped))
 
         return device_element
 
 
-    def generate_mailbox_config(self, enable_foe):
+    def generate_mailbox_config(self, enable_foe, pdo_assign=False, sdo_info=True, segmented_sdo=True,
+                                complete_access=False):
         """
         generate_mailbox_config: Generate the mailbox configuration
         
         enable_foe: Enable FoE
+        pdo_assign: The master can change the PDO assignment
+        sdo_info: Support the SDO information service
+        segmented_sdo: Support segmented SDO transfers
+        complete_access: Support SDO complete access
         
         return: The mailbox configuration element
         """
         mailbox_config = ET.Element("Mailbox", DataLinkLayer="true")
-        ET.SubElement(mailbox_config, "CoE", SdoInfo="true", PdoAssign="false", PdoConfig="false", CompleteAccess="false", SegmentedSdo="true")
+        ET.SubElement(mailbox_config, "CoE", SdoInfo=_xml_bool(sdo_info), PdoAssign=_xml_bool(pdo_assign), PdoConfig="false",
+                      CompleteAccess=_xml_bool(complete_access), SegmentedSdo=_xml_bool(segmented_sdo))
         if enable_foe:
             ET.SubElement(mailbox_config, "FoE")
         return mailbox_config
 
-    def generate_sync_manager_config(self):
+    def generate_alternative_mappings(self, pdo_sets, mapped):
         """
-        generate_sync_manager_config: Generate the sync manager configuration
+        generate_alternative_mappings: Generate the named PDO assignments
         
-        return: The sync manager configuration element
+        Each PDO set becomes an AlternativeSmMapping (the first one is the
+        default), listing its PDOs per sync manager, as TwinCAT reads them.
+        
+        pdo_sets: The PDO sets of the device, see Device.pdo_sets
+        mapped: The mapped PDOs of the device, see Device.iter_mapped_pdos
+        
+        return: The VendorSpecific element
         """
-        sync_manager = ET.Element("Dc")
-
-
-        op_mode1 = ET.SubElement(sync_manager, "OpMode")
-        ET.SubElement(op_mode1, "Name").text = "SM_Sync or Async"
-        ET.SubElement(op_mode1, "Desc").text = "SM_Sync or Async"
-        ET.SubElement(op_mode1, "AssignActivate").text = "#x0000"
+        vendor_specific = ET.Element("VendorSpecific")
+        twincat = ET.SubElement(vendor_specific, "TwinCAT")
+        for position, (name, pdo_names) in enumerate(pdo_sets.items()):
+            mapping = ET.SubElement(twincat, "AlternativeSmMapping")
+            if position == 0:
+                mapping.set("Default", "1")
+            ET.SubElement(mapping, "Name").text = name
+            sync_managers = {}
+            for tag, pdo, pdo_index, entries in mapped:
+                if pdo.name in pdo_names:
+                    sync_managers.setdefault(int(pdo.sm_index), []).append(pdo_index)
+            for sm_index, pdo_indices in sorted(sync_managers.items()):
+                sm = ET.SubElement(mapping, "Sm", No=f"{sm_index}")
+                for pdo_index in pdo_indices:
+                    ET.SubElement(sm, "Pdo").text = f"#x{pdo_index}"
+        return vendor_specific
 
+    def generate_dictionary(self, mapped, assigned=None):
+        """
+        generate_dictionary: Generate the CoE object dictionary of a device
+        
+        The dictionary holds the objects of the mapped entries (variables,
+        or one array/record object per index), the PDO mapping objects and
+        the PDO assignment object 0x1C10 + n of each sync manager n. Identical
+        data types are defined once and shared between objects.
+        
+        mapped: The mapped PDOs of the device, see Device.iter_mapped_pdos
+        assigned: Names of the PDOs assigned by default, when the PDO
+                  assignment can be changed (None for all of them)
+        
+        return: The Profile element
+        """
+        return _Dictionary(mapped, assigned).to_element()
 
-        op_mode = ET.SubElement(sync_manager, "OpMode")
-        ET.SubElement(op_mode, "Name").text = "DC_Sync"
-        ET.SubElement(op_mode, "Desc").text = "DC_Sync"
-        ET.SubElement(op_mode, "AssignActivate").text = "#x300"
-        ET.SubElement(op_mode, "CycleTimeSync0", Factor="1").text = "0"
-        ET.SubElement(op_mode, "ShiftTimeSync0").text = "2000200000"
-        return sync_manager
+    def generate_sync_manager_config(self, cycle_time=DC_CYCLE_TIME, shift_time=DC_SHIFT_TIME):
+        """
+        generate_sync_manager_config: Generate the sync manager configuration
+        
+        cycle_time: Sync0 cycle time of the DC_Sync mode in ns
+        shift_time: Sync0 shift time of the DC_Sync mode in ns
+        
+        return: The sync manager configuration element
+        """
+        return _copy_fragment(_sync_manager_fragment(cycle_time, shift_time))
  
     def generate_ln9252_config(self):
         """
@@ -332,54 +1044,175 @@ class ESI:
         
         return: The LAN9252 configuration element
         """
-        eeprom = ET.Element("Eeprom")
-        ET.SubElement(eeprom, "ByteSize").text = "4096"
-        ET.SubElement(eeprom, "ConfigData").text = "8003006EFF00FF000000"
-        eeprom.append(ET.Comment("0x140   0x80 PDI type LAN9252 Spi  "))
-        eeprom.append(ET.Comment("0x141   0x03 device emulation     "))
-        eeprom.append(ET.Comment("        enhanced link detection        "))
-        eeprom.append(ET.Comment("0x150   0x00 not used for LAN9252 Spi  "))
-        eeprom.append(ET.Comment("0x151   0x6E map Sync0 to AL event     "))
-        eeprom.append(ET.Comment("        Sync0/Latch0 assigned to Sync0 "))
-        eeprom.append(ET.Comment("        Sync1/Latch1 assigned to Sync1 "))
-        eeprom.append(ET.Comment("        Sync0/1 push/pull active high  "))
-        eeprom.append(ET.Comment("0x982-3 0x00FF Sync0/1 lenght = 2.5uS  "))
-        eeprom.append(ET.Comment("0x152   0xFF all GPIO set to out       "))
-        eeprom.append(ET.Comment("0x153   0x00 reserved                  "))
-        eeprom.append(ET.Comment("0x12-13 0x0000 alias address           "))
-        eeprom.append(ET.Comment("see more here: https://ww1.microchip.com/downloads/en/AppNotes/00001920A.pdf"))
-        ET.SubElement(eeprom, "BootStrap").text = "0010800080108000"
-        return eeprom
-
-    def to_xml(self):
+        return _copy_fragment(_lan9252_fragment())
+
+    def create_cached_device(self, device, cache):
+        """
+        create_cached_device: Create the device element, reusing the cached
+        element when the device content did not change
+        
+        The cache holds a Fragment, the tree gets a copy of it: the pretty
+        writer splices the rendered text of the cached element as long as the
+        copy is not modified.
+        
+        device: The device to create
+        cache: The DeviceCache to use
+        
+        return: The device element
+        """
+        key = device_key(self.lan9252, device)
+        fragment = cache.get(key)
+        if isinstance(fragment, bytes):
+            # read from the on-disk store, parsed once per cache
+            parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+            parser.feed(fragment)
+            fragment = _as_fragment(parser.close())
+            cache.put(key, fragment)
+        elif fragment is None:
+            fragment = _as_fragment(self.create_device(device))
+            cache.put(key, fragment)
+        return _copy_fragment(fragment)
+
+    def to_xml(self, cache=None):
         """
         to_xml: Generate the XML tree
         
+        cache: Optional DeviceCache of the device elements
+        
         return: The XML tree
         """
-        root = ET.Element("EtherCATInfo")
-        root.set('xmlns:xsi',"http://www.w3.org/2001/XMLSchema-instance")
-        root.set('xsi:noNamespaceSchemaLocation',"EtherCATInfo.xsd")
-        root.set("Version", "1.6")
+        with phase("to_xml") as stats:
+            root = ET.Element("EtherCATInfo")
+            root.set('xmlns:xsi',"http://www.w3.org/2001/XMLSchema-instance")
+            root.set('xsi:noNamespaceSchemaLocation',"EtherCATInfo.xsd")
+            root.set("Version", "1.6")
 
-        
-        root.append(self.create_vendor())
+            
+            root.append(self.create_vendor())
 
-        description = ET.Element("Descriptions")
-        groups = ET.Element("Groups")
-        groups.append(self.create_group())
-        description.append(groups)
+            description = ET.Element("Descriptions")
+            groups = ET.Element("Groups")
+            groups.append(self.create_group())
+            description.append(groups)
 
-        devices = ET.Element("Devices")
-        for device in self.devices:
-            devices.append(self.create_device(device))
-        description.append(devices)
+            devices = ET.Element("Devices")
+            for device in self.devices:
+                with phase("device", device.name) as device_stats:
+                    if cache is None:
+                        device_element = self.create_device(device)
+                    else:
+                        device_element = self.create_cached_device(device, cache)
+                    if device_stats is not None:
+                        device_stats.elements = sum(1 for _ in device_element.iter())
+                devices.append(device_element)
+            description.append(devices)
 
-        root.append(description)
+            root.append(description)
 
-        tree = ET.ElementTree(root)
+            tree = ET.ElementTree(root)
+            if stats is not None:
+                stats.elements = sum(1 for _ in root.iter())
         return tree
 
+
+def _escape_data(data):
+    """
+    _escape_data: Escape character data the way minidom does
+    
+    data: The text or attribute value
+    
+    return: The escaped string
+    """
+    if "&" in data:
+        data = data.replace("&", "&amp;")
+    if "<" in data:
+        data = data.replace("<", "&lt;")
+    if "\"" in data:
+        data = data.replace("\"", "&quot;")
+    if ">" in data:
+        data = data.replace(">", "&gt;")
+    return data
+
+
+def _normalize_text(text):
+    """
+    _normalize_text: Apply the end-of-line normalization an XML parser would
+    
+    text: The text of a node
+    
+    return: The normalized text
+    """
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def iter_pretty_xml(tree, indent="  "):
+    """
+    iter_pretty_xml: Serialize the XML tree in a single pass, chunk by chunk
+    
+    The output is the same as minidom's toprettyxml, without building the
+    intermediate string and DOM.
+    
+    tree: The XML tree (xml.etree.ElementTree)
+    indent: The indentation added per level
+    
+    return: A generator of string chunks
+    
+    raise: TypeError if the tree is not an xml.etree.ElementTree tree
+    """
+    if isinstance(tree, ET.ElementTree):
+        tree = tree.getroot()
+    if not isinstance(tree, ET.Element):
+        # the comment and processing instruction nodes of other libraries
+        # would be written as elements
+        raise TypeError(f"Can't serialize a {type(tree).__name__}, only xml.etree.ElementTree trees")
+    comment_tag, pi_tag = ET.Comment, ET.ProcessingInstruction
+
+    def write_node(node, level, splice=True):
+        if splice and isinstance(node, _FragmentCopy) and _unchanged(node, node.source):
+            key = (level, indent)
+            rendered = node.source.rendered.get(key)
+            if rendered is None:
+                rendered = node.source.rendered[key] = "".join(write_node(node.source, level, splice=False))
+            yield rendered
+            return
+        prefix = indent * level
+        tag = node.tag
+        if tag is comment_tag:
+            text = _normalize_text(node.text or "")
+            if "--" in text:
+                raise ValueError("'--' is not allowed in a comment node")
+            yield f"{prefix}<!--{text}-->\n"
+            return
+        if tag is pi_tag:
+            target, _, data = _normalize_text(node.text or "").strip().partition(" ")
+            yield f"{prefix}<?{target} {data.lstrip()}?>\n"
+            return
+
+        attributes = "".join(f' {key}="{_escape_data(value)}"' for key, value in node.attrib.items())
+        text = _normalize_text(node.text) if node.text else None
+        if len(node) == 0:
+            if text is None:
+                yield f"{prefix}<{tag}{attributes}/>\n"
+            else:
+                yield f"{prefix}<{tag}{attributes}>{_escape_data(text)}</{tag}>\n"
+            return
+
+        yield f"{prefix}<{tag}{attributes}>\n"
+        child_prefix = prefix + indent
+        if text is not None:
+            yield _escape_data(f"{child_prefix}{text}\n")
+        for child in node:
+            yield from write_node(child, level + 1)
+            if child.tail:
+                yield _escape_data(f"{child_prefix}{_normalize_text(child.tail)}\n")
+        yield f"{prefix}</{tag}>\n"
+
+    yield '<?xml version="1.0" ?>\n'
+    yield from write_node(tree, 0)
+
+
 def prettify_xml(tree):
     """
     prettify_xml: Prettify the XML tree
@@ -388,21 +1221,50 @@ def prettify_xml(tree):
     
     return: The prettified XML
     """
-    raw_xml = ET.tostring(tree.getroot(), 'utf-8')
-    parsed = minidom.parseString(raw_xml)
-    return parsed.toprettyxml(indent="  ")
+    with phase("prettify_xml") as stats:
+        xml = "".join(iter_pretty_xml(tree))
+        if stats is not None:
+            stats.bytes = len(xml.encode("utf-8"))
+    return xml
 
 
-def write_xml( tree, filename):
+def _count_bytes(chunks, stats):
+    """
+    _count_bytes: Pass the chunks through, counting their UTF-8 bytes
+    """
+    stats.bytes = 0
+    for chunk in chunks:
+        stats.bytes += len(chunk.encode("utf-8"))
+        yield chunk
+
+
+def write_xml(tree, filename, sidecar=False):
     """
     write_xml: Write the XML tree to a file
     
+    The tree is streamed to the file without building the whole document
+    in memory. A file is only replaced, atomically, when its content
+    changed, so unchanged ESI files keep their modification time and do not
+    trigger downstream rebuilds (see pyesi.cache.write_if_changed).
+    
     tree: The XML tree
-    filename: The file name
+    filename: The file name or a writable text file object
+    sidecar: Record the digest of the file in filename + ".sha256"
+    
+    return: True if the file was written, False if it was unchanged
     """
-    pretty_xml = prettify_xml(tree)
-    with open(filename, "w") as f:
-        f.write(pretty_xml)
+    with phase("write_xml") as stats:
+        chunks = iter_pretty_xml(tree)
+        if stats is not None:
+            chunks = _count_bytes(chunks, stats)
+        if hasattr(filename, "write"):
+            filename.writelines(chunks)
+            written = True
+        else:
+            written = write_if_changed(chunks, filename, sidecar)
+        if stats is not None:
+            stats.info["written"] = written
+    return written
 
 # Main code
 if __name__ == "__main__":
@@ -417,13 +1279,11 @@ if __name__ == "__main__":
 
     pdos = PDOs()
     pdos.name = "MyInputPDO"
-    pdos.address = "1000"
     pdos.entries = [Entry(name="MyInput", type=EntryType.UINT32)]
     slave.TxPdos.append(pdos)
 
     pdos = PDOs()
     pdos.name = "MyOutputPDOs"
-    pdos.address = "1200" 
     pdos.entries = [Entry(name="MyOutput", type=EntryType.UINT32)]
     slave.RxPdos.append(pdos)
 
@@ -0,0 +1,146 @@
+import sys
+
+from pyesi.generator import EntryArray
+
+
+def _entry_key(entry):
+    return (entry.name, entry.type, entry.index, entry.sub_index, entry.bitlen)
+
+
+class Interner:
+    """
+    Interner: Flyweight store of the model definitions
+
+    Identical sync managers, entries and PDO groups are replaced by a single
+    shared instance, and the names by interned strings. Fleets repeating the
+    same definitions for every device then store them once.
+
+    The shared instances must be treated as immutable: copy a definition
+    before modifying it for a single device.
+    """
+
+    def __init__(self):
+        self._sync_managers = {}
+        self._entries = {}
+        self._pdos = {}
+
+    def counts(self):
+        """
+        counts: Number of distinct definitions stored
+
+        return: Dictionary with the sync_managers, entries and pdos counts
+        """
+        return {"sync_managers": len(self._sync_managers), "entries": len(self._entries), "pdos": len(self._pdos)}
+
+    @staticmethod
+    def string(value):
+        """
+        string: Intern a string
+
+        value: The string (or None)
+
+        return: The interned string
+        """
+        return sys.intern(value) if type(value) is str else value
+
+    def sync_manager(self, sm):
+        """
+        sync_manager: Intern a sync manager
+
+        sm: The SyncManager
+
+        return: The shared SyncManager equal to sm
+        """
+        key = (sm.name, sm.sm_type, sm.address, sm.enabled, sm.default_size, sm.control_byte, sm.dir)
+        shared = self._sync_managers.get(key)
+        if shared is None:
+            sm.name = self.string(sm.name)
+            sm.control_byte = self.string(sm.control_byte)
+            shared = self._sync_managers[key] = sm
+        return shared
+
+    def entry(self, entry):
+        """
+        entry: Intern an entry
+
+        entry: The Entry
+
+        return: The shared Entry equal to entry
+        """
+        key = _entry_key(entry)
+        shared = self._entries.get(key)
+        if shared is None:
+            entry.name = self.string(entry.name)
+            entry.index = self.string(entry.index)
+            shared = self._entries[key] = entry
+        return shared
+
+    def pdos(self, pdos):
+        """
+        pdos: Intern a PDO group and its entries
+
+        pdos: The PDOs
+
+        return: The shared PDOs equal to pdos
+        """
+        compact = isinstance(pdos.entries, EntryArray)
+        if compact:
+            entries = tuple(pdos.entries.iter_fields())
+        else:
+            pdos.entries = [self.entry(entry) for entry in pdos.entries]
+            entries = tuple(_entry_key(entry) for entry in pdos.entries)
+        key = (pdos.name, pdos.sm_index, pdos.index, compact, entries)
+        shared = self._pdos.get(key)
+        if shared is None:
+            pdos.name = self.string(pdos.name)
+            pdos.index = self.string(pdos.index)
+            shared = self._pdos[key] = pdos
+        return shared
+
+    def device(self, device):
+        """
+        device: Intern the definitions of a device, in place
+
+        device: The Device
+
+        return: The device
+        """
+        device.name = self.string(device.name)
+        device.product_code = self.string(device.product_code)
+        device.revision_no = self.string(device.revision_no)
+        device.sync_managers = [self.sync_manager(sm) for sm in device.sync_managers]
+        device.RxPdos = [self.pdos(pdos) for pdos in device.RxPdos]
+        device.TxPdos = [self.pdos(pdos) for pdos in device.TxPdos]
+        return device
+
+    def esi(self, esi):
+        """
+        esi: Intern the definitions of all the devices of an ESI, in place
+
+        esi: The ESI
+
+        return: The esi
+        """
+        for device in esi.devices:
+            self.device(device)
+        return esi
+
+
+def intern_esi(esi):
+    """
+    intern_esi: Share the identical definitions of the devices of an ESI
+
+    Afterwards, a sync manager, PDO group or entry can belong to many
+    devices: modifying it in place changes all of them. Replace it by a copy
+    to change a single device. The pyesi functions that modify a device do
+    so: apply_mailbox_plan and optimize_device copy the sync managers and
+    PDO groups they change, apply_timing and add_pdo_set only set fields of
+    the Device itself, which is never shared.
+
+    esi: The ESI, modified in place
+
+    return: The Interner used, see Interner.counts
+    """
+    interner = Interner()
+    interner.esi(esi)
+    return interner
@@ -0,0 +1,292 @@
+import struct
+
+from pyesi.generator import EntryType, SyncManagerDir
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# struct format of the entry types (little endian, as on the bus)
+_STRUCT_FORMATS = {
+    EntryType.UINT8: "B",
+    EntryType.UINT16: "H",
+    EntryType.UINT32: "I",
+    EntryType.UINT64: "Q",
+    EntryType.INT8: "b",
+    EntryType.INT16: "h",
+    EntryType.INT32: "i",
+    EntryType.INT64: "q",
+    EntryType.REAL: "f",
+    EntryType.LREAL: "d",
+}
+
+
+class EntryLayout:
+    """
+    EntryLayout: Position of an entry in the process image
+
+    pdo: Name of the PDO group of the entry
+    name: Name of the entry
+    field: Unique field name of the entry in its image
+    type: Type of the entry (None for padding)
+    index: Index of the entry, as 4 hex digits resolved as in the ESI (see
+           Device.iter_mapped_pdos)
+    sub_index: Sub index of the entry
+    bit_offset: Offset of the entry in its image, in bits
+    bitlen: Bit length of the entry
+    """
+
+    def __init__(self, pdo, name, type, index, sub_index, bit_offset, bitlen):
+        self.pdo = pdo
+        self.name = name
+        self.field = name
+        self.type = type
+        self.index = index
+        self.sub_index = sub_index
+        self.bit_offset = bit_offset
+        self.bitlen = bitlen
+
+    @property
+    def byte_offset(self):
+        return self.bit_offset // 8
+
+    @property
+    def bit(self):
+        return self.bit_offset % 8
+
+    @property
+    def byte_aligned(self):
+        """
+        byte_aligned: Whether the entry can be read as a whole number of bytes
+        """
+        return self.bit_offset % 8 == 0 and self.type in _STRUCT_FORMATS and self.bitlen == int(self.type.bitlen())
+
+
+class SyncManagerLayout:
+    """
+    SyncManagerLayout: Layout of the PDOs mapped to a sync manager
+
+    sm_index: Index of the sync manager
+    dir: Direction of the sync manager
+    entries: EntryLayout of the entries, offsets relative to the sync manager
+    bits: Size of the mapped data in bits
+    size: Size of the mapped data in bytes
+    default_size: Default size of the sync manager (None if not set)
+    """
+
+    def __init__(self, sm_index, sm_dir, default_size=None):
+        self.sm_index = sm_index
+        self.dir = sm_dir
+        self.default_size = default_size
+        self.entries = []
+        self.bits = 0
+
+    @property
+    def size(self):
+        return (self.bits + 7) // 8
+
+
+class ImageLayout:
+    """
+    ImageLayout: Process image of one direction (Rx or Tx) of a device
+
+    The sync managers of the direction are laid out one after the other, in
+    sync manager order. Byte-aligned entries are exposed through a
+    precompiled struct.Struct and a NumPy structured dtype; bit-sized
+    entries are read with read_bit.
+
+    dir: Direction of the image
+    sync_managers: SyncManagerLayout of the sync managers, in image order
+    entries: EntryLayout of the entries, offsets relative to the image
+    size: Size of the image in bytes
+    struct: struct.Struct of the byte-aligned entries
+    fields: Field names of the values of struct, in order
+    """
+
+    def __init__(self, sm_dir, sync_managers):
+        self.dir = sm_dir
+        self.sync_managers = sync_managers
+        self.entries = []
+        offset = 0
+        for sm in sync_managers:
+            for entry in sm.entries:
+                self.entries.append(EntryLayout(entry.pdo, entry.name, entry.type, entry.index, entry.sub_index,
+                                                offset * 8 + entry.bit_offset, entry.bitlen))
+            offset += sm.size
+        self.size = offset
+        self._dtype = None
+        self._name_fields()
+        self._compile()
+
+    def _name_fields(self):
+        """
+        _name_fields: Give each entry a unique field name
+
+        Repeated names get their sub index appended, then a counter if that is
+        still not enough.
+        """
+        counts = {}
+        for entry in self.entries:
+            counts[entry.name] = counts.get(entry.name, 0) + 1
+        used = set()
+        for entry in self.entries:
+            field = entry.name if counts[entry.name] == 1 else f"{entry.name}_{entry.sub_index}"
+            unique = field
+            n = 1
+            while unique in used:
+                unique = f"{field}_{n}"
+                n += 1
+            used.add(unique)
+            entry.field = unique
+
+    def _compile(self):
+        fmt = ["<"]
+        self.fields = []
+        position = 0
+        for entry in self.entries:
+            if not entry.byte_aligned or entry.byte_offset < position:
+                continue
+            if entry.byte_offset > position:
+                fmt.append(f"{entry.byte_offset - position}x")
+            fmt.append(_STRUCT_FORMATS[entry.type])
+            self.fields.append(entry.field)
+            position = entry.byte_offset + entry.bitlen // 8
+        if self.size > position:
+            fmt.append(f"{self.size - position}x")
+        self.struct = struct.Struct("".join(fmt))
+
+    def dtype(self):
+        """
+        dtype: NumPy structured dtype of the byte-aligned entries
+
+        The dtype is built on the first call and kept (dtypes are immutable).
+
+        return: The numpy.dtype, its itemsize is the size of the image
+        """
+        if self._dtype is None:
+            if np is None:
+                raise ImportError("ImageLayout.dtype requires numpy")
+            entries = [entry for entry in self.entries if entry.byte_aligned]
+            self._dtype = np.dtype({
+                "names": [entry.field for entry in entries],
+                "formats": ["<" + _STRUCT_FORMATS[entry.type] for entry in entries],
+                "offsets": [entry.byte_offset for entry in entries],
+                "itemsize": self.size,
+            })
+        return self._dtype
+
+    def view(self, buffer, offset=0, count=1):
+        """
+        view: View a buffer as process images, without copying
+
+        buffer: The buffer (bytes, bytearray, memoryview...)
+        offset: Offset of the first image in the buffer
+        count: Number of consecutive images
+
+        return: The structured numpy array
+        """
+        return np.frombuffer(buffer, dtype=self.dtype(), count=count, offset=offset)
+
+    def unpack(self, buffer, offset=0):
+        """
+        unpack: Decode the byte-aligned entries of a process image
+
+        buffer: The buffer
+        offset: Offset of the image in the buffer
+
+        return: Dictionary of the values by field name
+        """
+        return dict(zip(self.fields, self.struct.unpack_from(buffer, offset)))
+
+    def pack_into(self, buffer, offset=0, **values):
+        """
+        pack_into: Encode the byte-aligned entries of a process image
+
+        buffer: The writable buffer
+        offset: Offset of the image in the buffer
+        values: The values by field name (missing ones are set to 0)
+        """
+        self.struct.pack_into(buffer, offset, *(values.get(field, 0) for field in self.fields))
+
+    def read_bit(self, buffer, field, offset=0):
+        """
+        read_bit: Read a bit-sized entry
+
+        buffer: The buffer
+        field: Field name of the entry
+        offset: Offset of the image in the buffer
+
+        return: The value of the entry
+        """
+        entry = self.entry(field)
+        value = int.from_bytes(buffer[offset + entry.byte_offset:offset + (entry.bit_offset + entry.bitlen + 7) // 8], "little")
+        return (value >> entry.bit) & ((1 << entry.bitlen) - 1)
+
+    def entry(self, field):
+        """
+        entry: Find an entry by field name
+
+        field: The field name
+
+        return: The EntryLayout
+        """
+        for entry in self.entries:
+            if entry.field == field:
+                return entry
+        raise KeyError(field)
+
+
+class DeviceLayout:
+    """
+    DeviceLayout: Process data layout of a device
+
+    The PDOs are mapped to their sync manager in the order create_device
+    emits them (RxPdos, then TxPdos), each PDO right after the previous one.
+    Only the PDOs of a PDO set are assigned to the sync managers: the set
+    named, or by default the first set (the default assignment of the
+    ESI). Devices without PDO sets, or all_pdos, map every PDO.
+
+    device: The Device
+    pdo_set: Name of the PDO set (None for the default assignment)
+    all_pdos: Map every PDO, whatever the sets (the room the sync managers
+              need for any assignment)
+
+    sync_managers: SyncManagerLayout by sync manager index
+    rx: ImageLayout of the outputs (master to slave)
+    tx: ImageLayout of the inputs (slave to master)
+    """
+
+    def __init__(self, device, pdo_set=None, all_pdos=False):
+        self.sync_managers = {}
+        if pdo_set is None and not all_pdos and device.pdo_sets:
+            pdo_set = next(iter(device.pdo_sets))
+        assigned = None if pdo_set is None or all_pdos else set(device.pdo_sets[pdo_set])
+        # the indices are resolved over all the PDOs, as the ESI writes them
+        for tag, pdo, pdo_index, entries in device.iter_mapped_pdos():
+            if assigned is not None and pdo.name not in assigned:
+                continue
+            sm = self._sync_manager(device, pdo.sm_index, SyncManagerDir.Rx if tag == "RxPdo" else SyncManagerDir.Tx)
+            for name, entry_type, index, sub_index, bitlen in entries:
+                bitlen = int(bitlen)
+                sm.entries.append(EntryLayout(pdo.name, name, entry_type, index, sub_index, sm.bits, bitlen))
+                sm.bits += bitlen
+
+        for sm_dir in (SyncManagerDir.Rx, SyncManagerDir.Tx):
+            sync_managers = [sm for _, sm in sorted(self.sync_managers.items()) if sm.dir == sm_dir]
+            image = ImageLayout(sm_dir, sync_managers)
+            if sm_dir == SyncManagerDir.Rx:
+                self.rx = image
+            else:
+                self.tx = image
+
+    def _sync_manager(self, device, sm_index, sm_dir):
+        sm = self.sync_managers.get(sm_index)
+        if sm is None:
+            default_size = None
+            if 0 <= sm_index < len(device.sync_managers):
+                default_size = device.sync_managers[sm_index].default_size
+            sm = self.sync_managers[sm_index] = SyncManagerLayout(sm_index, sm_dir, default_size)
+        elif sm.dir != sm_dir:
+            raise ValueError(f"Sync manager {sm_index} has both RxPdos and TxPdos mapped")
+        return sm
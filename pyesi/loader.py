@@ -0,0 +1,285 @@
+import hashlib
+import json
+import marshal
+import os
+
+import yaml
+
+from pyesi.generator import ESI, Device, PDOs, Entry, EntryArray, SyncManager, SyncManagerType, SyncManagerDir, EntryType
+
+try:
+    _BaseLoader = yaml.CSafeLoader
+except AttributeError:
+    _BaseLoader = yaml.SafeLoader
+
+# Bump when the layout of the compiled specs changes
+SPEC_CACHE_FORMAT = 1
+
+
+class _SpecLoader(_BaseLoader):
+    """
+    _SpecLoader: YAML safe loader (libyaml when available) supporting
+    "!include path" relative to the including file
+
+    spec_dir: Directory of the file being loaded
+    dependencies: Files read while loading, including the included ones
+    stack: Files being loaded, to detect recursive includes
+    """
+    spec_dir = "."
+    dependencies = None
+    stack = ()
+
+
+def _include(loader, node):
+    filename = os.path.join(loader.spec_dir, loader.construct_scalar(node))
+    return _read_spec(filename, loader.dependencies, loader.stack)
+
+
+_SpecLoader.add_constructor("!include", _include)
+
+
+def _read_spec(filename, dependencies, stack=()):
+    """
+    _read_spec: Parse a YAML or JSON spec file, resolving the includes
+
+    filename: The spec file name
+    dependencies: List the file names read are appended to
+    stack: Files being loaded (the includers of this file)
+
+    return: The spec data
+    """
+    filename = os.path.abspath(filename)
+    if filename in stack:
+        raise ValueError(f"Recursive include of {filename}")
+    if filename not in dependencies:
+        dependencies.append(filename)
+    with open(filename, "rb") as f:
+        if filename.endswith(".json"):
+            return json.load(f)
+        loader = _SpecLoader(f)
+        loader.spec_dir = os.path.dirname(filename)
+        loader.dependencies = dependencies
+        loader.stack = stack + (filename,)
+        try:
+            return loader.get_single_data()
+        finally:
+            loader.dispose()
+
+
+def _file_hash(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _cache_path(cache_dir, filename):
+    key = hashlib.sha256(os.path.abspath(filename).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{key}.spec")
+
+
+def _load_compiled(path):
+    """
+    _load_compiled: Load a compiled spec if its dependencies did not change
+
+    A dependency whose mtime or size changed is still accepted when its
+    content hash is the same.
+
+    path: The compiled spec file
+
+    return: (spec data, list of the file names it was read from), or None
+            if missing or outdated
+    """
+    try:
+        with open(path, "rb") as f:
+            version, dependencies, data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != SPEC_CACHE_FORMAT:
+        return None
+    for filename, mtime, size, digest in dependencies:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if (stat.st_mtime_ns, stat.st_size) != (mtime, size) and _file_hash(filename) != digest:
+            return None
+    return data, [filename for filename, _, _, _ in dependencies]
+
+
+def _store_compiled(path, dependencies, data):
+    stats = []
+    for filename in dependencies:
+        stat = os.stat(filename)
+        stats.append((filename, stat.st_mtime_ns, stat.st_size, _file_hash(filename)))
+    try:
+        compiled = marshal.dumps((SPEC_CACHE_FORMAT, stats, data))
+    except ValueError:
+        # the spec holds values marshal can't store (e.g. YAML dates)
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(compiled)
+    os.replace(tmp, path)
+
+
+def load_spec(filename, cache_dir=None, dependencies=None):
+    """
+    load_spec: Load a YAML or JSON spec file
+
+    filename: The spec file name
+    cache_dir: Optional directory of the compiled specs, reused as long as
+               the spec file and its includes did not change
+    dependencies: Optional list the absolute names of the files the spec
+                  was read from (the spec and its includes) are appended to
+
+    return: The spec data
+    """
+    if dependencies is None:
+        dependencies = []
+    if cache_dir is None:
+        return _read_spec(filename, dependencies)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, filename)
+    compiled = _load_compiled(path)
+    if compiled is not None:
+        data, filenames = compiled
+        dependencies.extend(filenames)
+        return data
+    start = len(dependencies)
+    data = _read_spec(filename, dependencies)
+    _store_compiled(path, dependencies[start:], data)
+    return data
+
+
+def _check_keys(spec, allowed, what):
+    unknown = set(spec) - set(allowed)
+    if unknown:
+        raise ValueError(f"Unknown {what} keys: {', '.join(sorted(unknown))}")
+
+
+def sync_manager_from_spec(spec):
+    """
+    sync_manager_from_spec: Create a SyncManager from its spec
+
+    spec: Dictionary with name, address, type (MAILBOX or BUFFERED),
+          dir (Rx or Tx) and optionally default_size and enabled
+
+    return: The SyncManager
+    """
+    _check_keys(spec, ("name", "address", "type", "dir", "default_size", "enabled"), "sync manager")
+    return SyncManager(spec["name"], spec["address"], SyncManagerType[spec["type"]], SyncManagerDir[spec["dir"]],
+                       spec.get("default_size"), spec.get("enabled", 1))
+
+
+def pdos_from_spec(spec):
+    """
+    pdos_from_spec: Create a PDOs group from its spec
+
+    An entry with a "count" expands to the entries of an array object, with
+    consecutive sub indices starting at "first_sub_index" (default 1). An
+    entry {"padding": bits} is a gap of that many bits.
+
+    spec: Dictionary with name, sm_index, entries and optionally index (the
+          PDO index, allocated when missing) and compact
+
+    return: The PDOs
+
+    raise: ValueError for padding entries in a compact PDO (an EntryArray
+           can't store them)
+    """
+    _check_keys(spec, ("name", "sm_index", "index", "entries", "compact"), "PDO")
+    pdos = PDOs(compact=spec.get("compact", False))
+    pdos.name = spec["name"]
+    pdos.sm_index = spec.get("sm_index", 0)
+    pdos.index = _esi_index(spec.get("index"))
+    for entry in spec.get("entries", []):
+        if "padding" in entry:
+            _check_keys(entry, ("padding", "index"), "padding entry")
+            if isinstance(pdos.entries, EntryArray):
+                raise ValueError(f"PDO {pdos.name}: padding entries need compact: false")
+            pdos.entries.append(Entry(name="", type=None, index=_esi_index(entry.get("index", 0)), bitlen=entry["padding"]))
+            continue
+        _check_keys(entry, ("name", "type", "index", "sub_index", "count", "first_sub_index"), "entry")
+        entry_type = EntryType[entry["type"]]
+        if "count" in entry:
+            pdos.add_array(entry["name"], entry_type, _esi_index(entry.get("index")), entry["count"],
+                           entry.get("first_sub_index", 1))
+        else:
+            pdos.add_entry(entry["name"], entry_type, _esi_index(entry.get("index")), entry.get("sub_index", 0))
+    return pdos
+
+
+def _esi_index(value):
+    # indices are hex digits in the model, YAML reads 0x1600 as an int
+    return f"{value:04X}" if isinstance(value, int) else value
+
+
+def _esi_number(value):
+    # the ESI writes numbers as "#x" hex text, YAML reads 0x... as an int
+    return f"#x{value:X}" if isinstance(value, int) else value
+
+
+def device_from_spec(spec):
+    """
+    device_from_spec: Create a Device from its spec
+
+    spec: Dictionary with name, product_code and revision_no (ints, or ESI
+          number text such as "#x3F03052"), sync_managers, RxPdos, TxPdos,
+          enable_sdos, enable_foe, sdo_info, segmented_sdo, complete_access,
+          embed_dictionary, dc_cycle_time, dc_shift_time and pdo_sets
+          (mapping of the set names to lists of PDO names)
+
+    return: The Device
+    """
+    _check_keys(spec, ("name", "product_code", "revision_no", "sync_managers", "RxPdos", "TxPdos", "enable_sdos", "enable_foe", "sdo_info",
+                       "segmented_sdo", "complete_access", "embed_dictionary",
+                       "dc_cycle_time", "dc_shift_time", "pdo_sets"), "device")
+    device = Device()
+    device.name = spec.get("name", device.name)
+    device.product_code = _esi_number(spec.get("product_code", device.product_code))
+    device.revision_no = _esi_number(spec.get("revision_no", device.revision_no))
+    device.sync_managers = [sync_manager_from_spec(sm) for sm in spec.get("sync_managers", [])]
+    device.RxPdos = [pdos_from_spec(pdos) for pdos in spec.get("RxPdos", [])]
+    device.TxPdos = [pdos_from_spec(pdos) for pdos in spec.get("TxPdos", [])]
+    device.enable_sdos = spec.get("enable_sdos", device.enable_sdos)
+    device.enable_foe = spec.get("enable_foe", device.enable_foe)
+    device.sdo_info = spec.get("sdo_info", device.sdo_info)
+    device.segmented_sdo = spec.get("segmented_sdo", device.segmented_sdo)
+    device.complete_access = spec.get("complete_access", device.complete_access)
+    device.embed_dictionary = spec.get("embed_dictionary", device.embed_dictionary)
+    device.dc_cycle_time = spec.get("dc_cycle_time", device.dc_cycle_time)
+    device.dc_shift_time = spec.get("dc_shift_time", device.dc_shift_time)
+    for name, pdo_names in spec.get("pdo_sets", {}).items():
+        device.add_pdo_set(name, pdo_names)
+    return device
+
+
+def esi_from_spec(spec):
+    """
+    esi_from_spec: Create an ESI from its spec
+
+    spec: Dictionary with vendor_id, vendor_name, group_type, group_name,
+          lan9252 and devices
+
+    return: The ESI
+    """
+    _check_keys(spec, ("vendor_id", "vendor_name", "group_type", "group_name", "lan9252", "devices"), "ESI")
+    esi = ESI()
+    for name in ("vendor_id", "vendor_name", "group_type", "group_name", "lan9252"):
+        if name in spec:
+            setattr(esi, name, spec[name])
+    esi.devices = [device_from_spec(device) for device in spec.get("devices", [])]
+    return esi
+
+
+def load_esi(filename, cache_dir=None, dependencies=None):
+    """
+    load_esi: Load an ESI from a YAML or JSON spec file
+
+    filename: The spec file name
+    cache_dir: Optional directory of the compiled specs, see load_spec
+    dependencies: Optional list of the files read, see load_spec
+
+    return: The ESI
+    """
+    return esi_from_spec(load_spec(filename, cache_dir, dependencies))
@@ -0,0 +1,243 @@
+import argparse
+import copy
+import sys
+
+from pyesi.allocator import parse_index
+from pyesi.generator import SyncManagerType
+from pyesi.layout import DeviceLayout
+from pyesi.validator import LAN9252_PROCESS_RAM_END, PROCESS_RAM_START
+
+# Headers of a mailbox transfer, in bytes
+MAILBOX_HEADER = 6
+COE_HEADER = 2
+SDO_HEADER = 8
+SDO_SEGMENT_HEADER = 1
+FOE_HEADER = 6
+# Largest data of an expedited SDO transfer
+SDO_EXPEDITED_SIZE = 4
+# Smallest mailbox the planner proposes
+MIN_MAILBOX_SIZE = 64
+
+
+def foe_round_trips(data_bytes, mailbox_size):
+    """
+    foe_round_trips: Number of mailbox round trips of an FoE write
+
+    The write request is acknowledged, then every data packet is. A last
+    packet shorter than the others (empty if needed) ends the transfer.
+
+    data_bytes: Size of the file
+    mailbox_size: Size of the mailbox
+
+    return: The number of round trips
+    """
+    payload = mailbox_size - MAILBOX_HEADER - FOE_HEADER
+    if payload <= 0:
+        raise ValueError(f"A mailbox of {mailbox_size} bytes can't carry FoE data")
+    return 1 + data_bytes // payload + 1
+
+
+def sdo_round_trips(data_bytes, mailbox_size, segmented_sdo=True):
+    """
+    sdo_round_trips: Number of mailbox round trips of an SDO transfer
+
+    Up to 4 bytes fit in an expedited transfer. Larger data fills the
+    initiate request, then segments of the mailbox size.
+
+    data_bytes: Size of the data (the whole object with complete access)
+    mailbox_size: Size of the mailbox
+    segmented_sdo: The device supports segmented transfers
+
+    return: The number of round trips
+    """
+    if data_bytes <= SDO_EXPEDITED_SIZE:
+        return 1
+    first = mailbox_size - MAILBOX_HEADER - COE_HEADER - SDO_HEADER
+    if data_bytes <= first:
+        return 1
+    if not segmented_sdo:
+        raise ValueError(f"{data_bytes} bytes don't fit in a mailbox of {mailbox_size} bytes without segmented SDO")
+    segment = mailbox_size - MAILBOX_HEADER - COE_HEADER - SDO_SEGMENT_HEADER
+    return 1 + -(-(data_bytes - first) // segment)
+
+
+class MailboxPlan:
+    """
+    MailboxPlan: Mailbox sizes and sync manager addresses, see plan_mailboxes
+
+    sizes: Size of each mailbox sync manager, by sync manager index
+    addresses: Start address of each sync manager, by sync manager index
+    footprints: Bytes of ESC memory used by each sync manager (three
+                buffers for the buffered ones), by sync manager index
+    ram_end: End of the process RAM the plan fits in
+    """
+
+    def __init__(self, ram_end):
+        self.sizes = {}
+        self.addresses = {}
+        self.footprints = {}
+        self.ram_end = ram_end
+
+    @property
+    def free(self):
+        """
+        free: Bytes of process RAM left unused
+        """
+        return self.ram_end - PROCESS_RAM_START - sum(self.footprints.values())
+
+    def __str__(self):
+        lines = []
+        for sm_index, address in sorted(self.addresses.items()):
+            line = f"Sm[{sm_index}] #x{address:04X}-#x{address + self.footprints[sm_index] - 1:04X}"
+            if sm_index in self.sizes:
+                line += f" mailbox of {self.sizes[sm_index]} bytes"
+            lines.append(line)
+        lines.append(f"{self.free} bytes free")
+        return "\n".join(lines)
+
+
+def _footprint(sm, size):
+    return size if sm.sm_type == SyncManagerType.MAILBOX else 3 * size
+
+
+def plan_mailboxes(device, size=None, relocate=False, ram_end=LAN9252_PROCESS_RAM_END, max_size=1024, granularity=8):
+    """
+    plan_mailboxes: Size the mailbox sync managers against the ESC memory
+
+    Larger mailboxes carry more data per SDO segment or FoE packet, so a
+    transfer needs fewer round trips.
+
+    Without relocate, the sync managers keep their addresses and each
+    mailbox grows up to the next sync manager (or the end of the RAM). With
+    relocate, the mailboxes are placed at the start of the process RAM,
+    followed by the buffered sync managers, and share the memory left.
+
+    device: The device
+    size: The mailbox size to check (None for the largest that fits)
+    relocate: Move the sync managers
+    ram_end: End of the process RAM of the ESC (the LAN9252 by default)
+    max_size: Largest mailbox size proposed
+    granularity: Mailbox sizes and relocated addresses are multiples of it
+
+    return: The MailboxPlan
+
+    raise: ValueError if the mailboxes don't fit or overlap a sync manager
+    """
+    # the sync managers need room for any PDO assignment
+    layout = DeviceLayout(device, all_pdos=True)
+    mailboxes = [sm_index for sm_index, sm in enumerate(device.sync_managers) if sm.sm_type == SyncManagerType.MAILBOX]
+    if not mailboxes:
+        raise ValueError(f"{device.name} has no mailbox sync manager")
+    plan = MailboxPlan(ram_end)
+
+    buffered = {}
+    for sm_index, sm in enumerate(device.sync_managers):
+        if sm_index not in mailboxes:
+            mapped = layout.sync_managers[sm_index].size if sm_index in layout.sync_managers else 0
+            buffered[sm_index] = _footprint(sm, max(mapped, sm.default_size or 0))
+
+    if relocate:
+        used = sum(-(-footprint // granularity) * granularity for footprint in buffered.values())
+        available = (ram_end - PROCESS_RAM_START - used) // len(mailboxes)
+        if size is None:
+            size = min(max_size, available // granularity * granularity)
+        if size < MIN_MAILBOX_SIZE or size > available:
+            raise ValueError(f"{device.name}: {available} bytes left per mailbox, can't fit mailboxes of {size} bytes")
+        address = PROCESS_RAM_START
+        for sm_index in mailboxes:
+            plan.addresses[sm_index], plan.sizes[sm_index], plan.footprints[sm_index] = address, size, size
+            address += size
+        for sm_index, footprint in buffered.items():
+            address = -(-address // granularity) * granularity
+            plan.addresses[sm_index], plan.footprints[sm_index] = address, footprint
+            address += footprint
+        return plan
+
+    for sm_index, sm in enumerate(device.sync_managers):
+        plan.addresses[sm_index] = parse_index(sm.address)
+        if sm_index in buffered:
+            plan.footprints[sm_index] = buffered[sm_index]
+    for sm_index in mailboxes:
+        start = plan.addresses[sm_index]
+        limit = ram_end
+        for other, address in plan.addresses.items():
+            if other == sm_index:
+                continue
+            if address > start:
+                limit = min(limit, address)
+            elif other in plan.footprints and address + plan.footprints[other] > start:
+                raise ValueError(f"{device.name}: the mailbox Sm[{sm_index}] at #x{start:04X} overlaps Sm[{other}]")
+        if size is None:
+            mailbox_size = min(max_size, (limit - start) // granularity * granularity)
+            if mailbox_size < MIN_MAILBOX_SIZE:
+                raise ValueError(f"{device.name}: only {limit - start} bytes free for the mailbox Sm[{sm_index}]")
+        elif start + size > limit:
+            raise ValueError(f"{device.name}: a mailbox of {size} bytes at #x{start:04X} overlaps #x{limit:04X}")
+        else:
+            mailbox_size = size
+        plan.sizes[sm_index] = plan.footprints[sm_index] = mailbox_size
+    return plan
+
+
+def apply_mailbox_plan(device, plan):
+    """
+    apply_mailbox_plan: Set the mailbox sizes and addresses of a plan
+
+    The sync managers are replaced by modified copies, so the ones shared
+    with other devices (see pyesi.interning) are left untouched.
+
+    device: The device
+    plan: The MailboxPlan, see plan_mailboxes
+    """
+    device.sync_managers = [copy.copy(sm) for sm in device.sync_managers]
+    for sm_index, sm in enumerate(device.sync_managers):
+        sm.address = f"{plan.addresses[sm_index]:04X}"
+        if sm_index in plan.sizes:
+            sm.default_size = plan.sizes[sm_index]
+
+
+def main(argv=None):
+    """
+    main: Entry point of python -m pyesi.mailbox
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code, 1 if a device has no valid plan
+    """
+    from pyesi.loader import load_esi
+    from pyesi.reader import read_esi
+
+    parser = argparse.ArgumentParser(prog="python -m pyesi.mailbox", description="Plan the mailbox sizes of devices.")
+    parser.add_argument("file", help="YAML/JSON spec or ESI XML file")
+    parser.add_argument("--size", type=int, help="mailbox size to check (default: the largest that fits)")
+    parser.add_argument("--relocate", action="store_true", help="move the sync managers to make room")
+    parser.add_argument("--ram-end", type=lambda value: int(value, 0), default=LAN9252_PROCESS_RAM_END,
+                        help="end of the process RAM (default: 0x2000, LAN9252)")
+    parser.add_argument("--firmware", type=int, default=0, help="size of a firmware image, to count the FoE round trips")
+    args = parser.parse_args(argv)
+
+    esi = read_esi(args.file) if args.file.lower().endswith(".xml") else load_esi(args.file)
+    status = 0
+    for device in esi.devices:
+        try:
+            plan = plan_mailboxes(device, args.size, args.relocate, args.ram_end)
+        except ValueError as e:
+            print(e)
+            status = 1
+            continue
+        print(f"{device.name}:\n{plan}")
+        if args.firmware:
+            planned = min(plan.sizes.values())
+            sizes = [sm.default_size for sm in device.sync_managers if sm.sm_type == SyncManagerType.MAILBOX]
+            if None in sizes:
+                print(f"FoE round trips for {args.firmware} bytes: {foe_round_trips(args.firmware, planned)} with "
+                      f"{planned} bytes mailboxes (the current mailbox size is not set)")
+            else:
+                current = min(sizes)
+                print(f"FoE round trips for {args.firmware} bytes: {foe_round_trips(args.firmware, current)} with "
+                      f"{current} bytes mailboxes, {foe_round_trips(args.firmware, planned)} with {planned} bytes")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import copy
+import warnings
+
+from pyesi.generator import Entry, SyncManagerDir
+from pyesi.layout import DeviceLayout
+
+
+def _alignment(entry):
+    """
+    _alignment: Natural alignment of an entry in bytes
+
+    entry: The Entry
+
+    return: The alignment, 0 for bit-sized entries
+    """
+    bitlen = int(entry.bitlen or entry.type.bitlen())
+    if bitlen % 8:
+        return 0
+    size = bitlen // 8
+    return size if size & (size - 1) == 0 else 1
+
+
+def optimize_pdos(pdos):
+    """
+    optimize_pdos: Reorder the entries of a PDO group for natural alignment
+
+    Entries are sorted by decreasing size (stable, so arrays keep their sub
+    index order), bit-sized entries are grouped at the end and the padding
+    entries are dropped. Starting from an aligned offset, every entry is then
+    naturally aligned without any padding byte.
+
+    pdos: The PDOs group, reordered in place
+    """
+    entries = [entry for entry in pdos.entries if entry.type is not None]
+    entries.sort(key=lambda entry: -_alignment(entry))
+    pdos.entries = type(pdos.entries)(entries)
+
+
+def _bits(pdos):
+    return sum(int(bitlen) for *_, bitlen in pdos.iter_entries())
+
+
+def _pad_to(pdos, bits, alignment):
+    """
+    _pad_to: Append a padding entry so that the next PDO starts aligned
+
+    pdos: The PDOs group
+    bits: Offset of the end of the group in its sync manager, in bits
+    alignment: Alignment needed by the next group, in bytes
+
+    return: The number of padding bits added
+    """
+    missing = -bits % (alignment * 8)
+    if missing:
+        pdos.entries = list(pdos.entries)
+        pdos.entries.append(Entry(name="", type=None, index="0", bitlen=missing))
+    return missing
+
+
+def optimize_device(device, pad=False):
+    """
+    optimize_device: Reorder the entries of all the PDOs of a device
+
+    The PDO groups are replaced by modified copies, so the ones shared with
+    other devices (see pyesi.interning) are left untouched.
+
+    device: The device, modified in place
+    pad: Also pad each PDO group so that the next group mapped to the same
+         sync manager starts naturally aligned (costs some bytes)
+
+    return: The size report of the optimized device, see size_report
+    """
+    # optimize_pdos and _pad_to replace the entries, a shallow copy is enough
+    device.RxPdos = [copy.copy(pdos) for pdos in device.RxPdos]
+    device.TxPdos = [copy.copy(pdos) for pdos in device.TxPdos]
+    for pdos in device.RxPdos + device.TxPdos:
+        optimize_pdos(pdos)
+
+    if pad:
+        for pdos_list in (device.RxPdos, device.TxPdos):
+            groups = {}
+            for pdos in pdos_list:
+                groups.setdefault(pdos.sm_index, []).append(pdos)
+            for group in groups.values():
+                bits = 0
+                for pdos, next_pdos in zip(group, group[1:]):
+                    bits += _bits(pdos)
+                    alignment = max([_alignment(entry) for entry in next_pdos.entries] + [1])
+                    bits += _pad_to(pdos, bits, alignment)
+
+    return size_report(device)
+
+
+class SyncManagerReport:
+    """
+    SyncManagerReport: Process data size of a sync manager
+
+    sm_index: Index of the sync manager
+    name: Name of the sync manager (None if not defined in the device)
+    dir: Direction of the sync manager
+    size: Bytes of process data mapped to the sync manager
+    default_size: Default size of the sync manager (None if not set)
+    misaligned: The "name:sub_index" of the entries that are not naturally aligned
+    overflow: Whether the mapped data exceeds the default size
+    """
+
+    def __init__(self, sm_index, name, sm_dir, size, default_size, misaligned):
+        self.sm_index = sm_index
+        self.name = name
+        self.dir = sm_dir
+        self.size = size
+        self.default_size = default_size
+        self.misaligned = misaligned
+        self.overflow = default_size is not None and size > default_size
+
+    def __repr__(self):
+        return f"SyncManagerReport(sm_index={self.sm_index}, name={self.name!r}, size={self.size}, default_size={self.default_size}, misaligned={len(self.misaligned)})"
+
+
+def size_report(device, warn=True, pdo_set=None):
+    """
+    size_report: Report the process data bytes per sync manager
+
+    device: The device
+    warn: Emit a warning for each sync manager whose mapped data exceeds its
+          default size
+    pdo_set: Only count the PDOs of this set of device.pdo_sets (None for
+             all the PDOs)
+
+    return: The list of SyncManagerReport, by sync manager index
+    """
+    layout = DeviceLayout(device, pdo_set, all_pdos=pdo_set is None)
+    reports = []
+    for sm_index, sm in sorted(layout.sync_managers.items()):
+        name = None
+        if 0 <= sm_index < len(device.sync_managers):
+            name = device.sync_managers[sm_index].name
+        misaligned = []
+        for entry in sm.entries:
+            if entry.type is None:
+                continue
+            size = entry.bitlen // 8 if entry.bitlen % 8 == 0 else 0
+            if size and (entry.bit_offset % 8 or entry.bit_offset // 8 % size):
+                misaligned.append(f"{entry.name}:{entry.sub_index}")
+        report = SyncManagerReport(sm_index, name, sm.dir, sm.size, sm.default_size, misaligned)
+        if warn and report.overflow:
+            warnings.warn(f"{device.name}: {sm.size} bytes of PDOs mapped to sync manager {sm_index} ({name}), "
+                          f"its size is {sm.default_size} bytes")
+        reports.append(report)
+    return reports
+
+
+def total_size(reports, sm_dir=None):
+    """
+    total_size: Total process data bytes of a report
+
+    reports: The list of SyncManagerReport
+    sm_dir: Only count the sync managers of this direction (None for both)
+
+    return: The number of bytes
+    """
+    return sum(report.size for report in reports if sm_dir is None or report.dir == sm_dir)
+
+
+def pdo_set_sizes(device):
+    """
+    pdo_set_sizes: Process data bytes of each alternative PDO set
+
+    device: The device
+
+    return: Dictionary of the (Rx bytes, Tx bytes) by set name, in
+            device.pdo_sets order
+    """
+    sizes = {}
+    for name in device.pdo_sets:
+        reports = size_report(device, warn=False, pdo_set=name)
+        sizes[name] = (total_size(reports, SyncManagerDir.Rx), total_size(reports, SyncManagerDir.Tx))
+    return sizes
@@ -0,0 +1,438 @@
+import xml.etree.ElementTree as ET
+import xml.parsers.expat
+
+from pyesi.generator import ESI, Device, PDOs, Entry, EntryType, SyncManager, SyncManagerType, SyncManagerDir
+
+# IEC 61131 names of the data types found in third-party ESI files
+_DATA_TYPE_ALIASES = {
+    "USINT": EntryType.UINT8,
+    "BYTE": EntryType.UINT8,
+    "UINT": EntryType.UINT16,
+    "WORD": EntryType.UINT16,
+    "UDINT": EntryType.UINT32,
+    "DWORD": EntryType.UINT32,
+    "ULINT": EntryType.UINT64,
+    "SINT": EntryType.INT8,
+    "INT": EntryType.INT16,
+    "DINT": EntryType.INT32,
+    "LINT": EntryType.INT64,
+    "REAL32": EntryType.REAL,
+    "FLOAT": EntryType.REAL,
+    "REAL64": EntryType.LREAL,
+}
+
+
+def parse_number(value):
+    """
+    parse_number: Parse an ESI number ("#x1F" hexadecimal or decimal)
+
+    value: The text of the number
+
+    return: The integer, or None if value is None
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value[:2] in ("#x", "0x", "#X", "0X"):
+        return int(value[2:], 16)
+    return int(value)
+
+
+def _hex_digits(value):
+    """
+    _hex_digits: Convert an ESI number to the hex digits the model stores
+
+    The model writes its addresses and indices as f"#x{value}". Both the
+    "#x" and the "0x" prefixes are found in ESI files.
+
+    value: The text of the number
+
+    return: The hex digits
+    """
+    value = value.strip()
+    if value[:2] in ("#x", "0x", "#X", "0X"):
+        return value[2:]
+    return f"{int(value):X}"
+
+
+def _text(element, tag, default=None):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+
+def _entry_type(data_type, name):
+    if data_type in EntryType.__members__:
+        return EntryType[data_type]
+    if data_type in _DATA_TYPE_ALIASES:
+        return _DATA_TYPE_ALIASES[data_type]
+    raise ValueError(f"Unsupported DataType {data_type} of entry {name}")
+
+
+def sync_manager_from_element(element):
+    """
+    sync_manager_from_element: Create a SyncManager from an Sm element
+
+    The type and direction are decoded from the control byte (mode bits 0-1,
+    direction bit 2), the control byte itself is kept as written.
+
+    element: The Sm element
+
+    return: The SyncManager
+    """
+    control_byte = element.get("ControlByte", "#x64")
+    value = parse_number(control_byte)
+    sm_type = SyncManagerType.MAILBOX if value & 0x3 == 0x2 else SyncManagerType.BUFFERED
+    sm_dir = SyncManagerDir.Rx if value & 0x4 else SyncManagerDir.Tx
+    default_size = element.get("DefaultSize")
+    sm = SyncManager((element.text or "").strip(), _hex_digits(element.get("StartAddress", "0")), sm_type, sm_dir,
+                     parse_number(default_size) if default_size is not None else None,
+                     parse_number(element.get("Enable", "1")))
+    sm.control_byte = control_byte
+    return sm
+
+
+def pdos_from_element(element):
+    """
+    pdos_from_element: Create a PDOs group from an RxPdo or TxPdo element
+
+    element: The RxPdo or TxPdo element
+
+    return: The PDOs
+    """
+    pdos = PDOs()
+    pdos.name = _text(element, "Name", "")
+    if element.get("Sm") is not None:
+        pdos.sm_index = parse_number(element.get("Sm"))
+    index = _text(element, "Index")
+    if index is not None:
+        pdos.index = _hex_digits(index)
+    for e in element.iterfind("Entry"):
+        name = _text(e, "Name", "")
+        index = _hex_digits(_text(e, "Index", "0"))
+        bitlen = parse_number(_text(e, "BitLen", "0"))
+        data_type = _text(e, "DataType")
+        if data_type is None:
+            pdos.entries.append(Entry(name=name, type=None, index=index, bitlen=bitlen))
+            continue
+        entry_type = _entry_type(data_type, name)
+        sub_index = parse_number(_text(e, "SubIndex", "0"))
+        entry = Entry(name=name, type=entry_type, index=index, sub_index=sub_index)
+        if bitlen != int(entry_type.bitlen()):
+            entry.bitlen = bitlen
+        pdos.entries.append(entry)
+    return pdos
+
+
+def _compatible_groups(pdos):
+    """
+    _compatible_groups: The largest groups of PDOs that don't exclude each other
+
+    pdos: List of (index, excluded indices) of the PDOs of one direction
+
+    return: The list of the groups (lists of indices, in PDO order)
+    """
+    indices = [index for index, _ in pdos]
+    excluded = dict(pdos)
+    groups = []
+
+    def extend(group, candidates, skipped):
+        if not candidates and not skipped:
+            groups.append(sorted(group, key=indices.index))
+            return
+        for index in list(candidates):
+            compatible = {other for other in indices if other != index and other not in excluded[index]
+                          and index not in excluded[other]}
+            extend(group + [index], candidates & compatible, skipped & compatible)
+            candidates = candidates - {index}
+            skipped = skipped | {index}
+
+    extend([], set(indices), set())
+    return sorted(groups, key=lambda group: [indices.index(index) for index in group])
+
+
+def pdo_sets_from_element(element, names):
+    """
+    pdo_sets_from_element: Read the alternative PDO sets of a Device element
+
+    The named sets are read from the AlternativeSmMapping elements (written
+    by pyesi and TwinCAT), the default one first. Files without them but
+    with Exclude elements or optional PDOs get unnamed sets ("set 1",
+    "set 2"...): the largest groups of RxPdos and of TxPdos that don't
+    exclude each other, combined, or without exclusions the mandatory PDOs
+    alone, then all of them.
+
+    element: The Device element
+    names: Names of the PDOs by index
+
+    return: Dictionary of the lists of PDO names by set name (empty if the
+            device has no alternative PDO sets)
+    """
+    pdo_sets = {}
+    mappings = list(element.iterfind("VendorSpecific/TwinCAT/AlternativeSmMapping"))
+    mappings.sort(key=lambda mapping: mapping.get("Default") not in ("1", "true"))
+    for mapping in mappings:
+        pdo_sets[_text(mapping, "Name", f"set {len(pdo_sets) + 1}")] = [
+            names.get(parse_number(pdo.text), pdo.text) for pdo in mapping.iterfind("Sm/Pdo")]
+    if pdo_sets:
+        return pdo_sets
+
+    pdo_elements = list(element.iterfind("RxPdo")) + list(element.iterfind("TxPdo"))
+    mandatory = [parse_number(_text(pdo, "Index", "0")) for pdo in pdo_elements if pdo.get("Mandatory") in ("1", "true")]
+    excludes = any(pdo.find("Exclude") is not None for pdo in pdo_elements)
+    if not excludes and (not mandatory or len(mandatory) == len(pdo_elements)):
+        return pdo_sets
+
+    combinations = [[]]
+    for tag in ("RxPdo", "TxPdo"):
+        pdos = [(parse_number(_text(pdo, "Index", "0")), {parse_number(exclude.text) for exclude in pdo.iterfind("Exclude")})
+                for pdo in element.iterfind(tag)]
+        if pdos:
+            combinations = [combination + group for combination in combinations for group in _compatible_groups(pdos)]
+    # without exclusions, the optional PDOs are the difference between the
+    # mandatory PDOs alone and all of them
+    if not excludes:
+        combinations.insert(0, mandatory)
+    for combination in combinations:
+        pdo_sets[f"set {len(pdo_sets) + 1}"] = [names.get(index, f"#x{index:04X}") for index in combination]
+    return pdo_sets
+
+
+def device_from_element(element):
+    """
+    device_from_element: Create a Device from a Device element
+
+    element: The Device element
+
+    return: The Device
+    """
+    device = Device()
+    type_element = element.find("Type")
+    device.name = _text(element, "Name") or _text(element, "Type", device.name)
+    if type_element is not None:
+        device.product_code = type_element.get("ProductCode", device.product_code)
+        device.revision_no = type_element.get("RevisionNo", device.revision_no)
+    device.sync_managers = [sync_manager_from_element(sm) for sm in element.iterfind("Sm")]
+    device.RxPdos = [pdos_from_element(pdo) for pdo in element.iterfind("RxPdo")]
+    device.TxPdos = [pdos_from_element(pdo) for pdo in element.iterfind("TxPdo")]
+    names = {}
+    for pdos in device.RxPdos + device.TxPdos:
+        try:
+            names[int(pdos.index, 16)] = pdos.name
+        except (TypeError, ValueError):
+            pass
+    device.pdo_sets = pdo_sets_from_element(element, names)
+    mailbox = element.find("Mailbox")
+    if mailbox is not None:
+        device.enable_sdos = mailbox.find("CoE") is not None
+        device.enable_foe = mailbox.find("FoE") is not None
+        coe = mailbox.find("CoE")
+        if coe is not None:
+            device.sdo_info = coe.get("SdoInfo", "false") in ("true", "1")
+            device.segmented_sdo = coe.get("SegmentedSdo", "false") in ("true", "1")
+            device.complete_access = coe.get("CompleteAccess", "false") in ("true", "1")
+    device.embed_dictionary = element.find("Profile/Dictionary") is not None
+    for op_mode in element.iterfind("Dc/OpMode"):
+        if op_mode.findtext("Name") == "DC_Sync":
+            device.dc_cycle_time = parse_number(op_mode.findtext("CycleTimeSync0", str(device.dc_cycle_time)))
+            device.dc_shift_time = parse_number(op_mode.findtext("ShiftTimeSync0", str(device.dc_shift_time)))
+    return device
+
+
+def _read_header(esi, vendor, group):
+    if vendor is not None:
+        esi.vendor_id = _text(vendor, "Id", esi.vendor_id)
+        esi.vendor_name = _text(vendor, "Name", esi.vendor_name)
+    if group is not None:
+        esi.group_type = _text(group, "Type", esi.group_type)
+        esi.group_name = _text(group, "Name", esi.group_name)
+
+
+def iter_devices(source):
+    """
+    iter_devices: Stream the devices of an ESI file
+
+    Each Device element is converted and then cleared, so memory stays flat
+    whatever the number of devices.
+
+    source: The file name or a binary file object
+
+    return: A generator of Device
+    """
+    parents = []
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag == "Device" and parents and parents[-1].tag == "Devices":
+            yield device_from_element(element)
+            element.clear()
+            parents[-1].remove(element)
+
+
+def read_esi(source):
+    """
+    read_esi: Load an ESI file into an ESI object, with all its devices
+
+    source: The file name or a binary file object
+
+    return: The ESI
+    """
+    esi = ESI()
+    esi.lan9252 = False
+    parents = []
+    group = None
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            parents.append(element)
+            continue
+        parents.pop()
+        parent = parents[-1].tag if parents else None
+        if element.tag == "Vendor" and parent == "EtherCATInfo":
+            _read_header(esi, element, None)
+        elif element.tag == "Group" and parent == "Groups" and group is None:
+            group = element
+            _read_header(esi, None, group)
+        elif element.tag == "Device" and parent == "Devices":
+            esi.devices.append(device_from_element(element))
+            esi.lan9252 = esi.lan9252 or element.find("Eeprom") is not None
+            element.clear()
+            parents[-1].remove(element)
+    return esi
+
+
+class ESIReader:
+    """
+    ESIReader: Lazy reader of an ESI file
+
+    Opening the reader scans the file once, without building any element,
+    and indexes the byte range of each device by ProductCode and RevisionNo.
+    Devices are then parsed on demand.
+
+    filename: The ESI file name
+    esi: ESI object with the vendor and group information (and no devices)
+    index: The (product code, revision number) of each device, in file order
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = []
+        self._ranges = []
+        self._by_key = {}
+        self._encoding = "utf-8"
+        self._namespaces = {}
+        self._header = {}
+        self._scan()
+
+        self.esi = ESI()
+        self.esi.lan9252 = self._lan9252
+        _read_header(self.esi, self._load_element(*self._header["Vendor"]) if "Vendor" in self._header else None,
+                     self._load_element(*self._header["Group"]) if "Group" in self._header else None)
+
+    def _scan(self):
+        parser = xml.parsers.expat.ParserCreate()
+        stack = []
+        current = {}
+        self._lan9252 = False
+
+        def xml_decl(version, encoding, standalone):
+            if encoding:
+                self._encoding = encoding
+
+        def start(name, attributes):
+            parent = stack[-1] if stack else None
+            stack.append(name)
+            if parent is None:
+                self._namespaces = {key: value for key, value in attributes.items() if key.startswith("xmlns")}
+            elif name == "Device" and parent == "Devices":
+                current["start"] = parser.CurrentByteIndex
+                current["key"] = (None, None)
+            elif name == "Type" and parent == "Device" and "start" in current:
+                current["key"] = (parse_number(attributes.get("ProductCode")), parse_number(attributes.get("RevisionNo")))
+            elif name == "Eeprom" and parent == "Device":
+                self._lan9252 = True
+            elif (name == "Vendor" and len(stack) == 2) or (name == "Group" and parent == "Groups"):
+                if name not in self._header:
+                    self._header[name] = (parser.CurrentByteIndex, None)
+
+        def end(name):
+            stack.pop()
+            parent = stack[-1] if stack else None
+            if name == "Device" and parent == "Devices":
+                key = current.pop("key")
+                self._by_key.setdefault(key, len(self.index))
+                self._by_key.setdefault((key[0], None), len(self.index))
+                self.index.append(key)
+                self._ranges.append((current.pop("start"), parser.CurrentByteIndex))
+            elif name in self._header and self._header[name][1] is None:
+                if (name == "Vendor" and len(stack) == 1) or (name == "Group" and parent == "Groups"):
+                    self._header[name] = (self._header[name][0], parser.CurrentByteIndex)
+
+        parser.XmlDeclHandler = xml_decl
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        with open(self.filename, "rb") as f:
+            parser.ParseFile(f)
+
+    def _load_element(self, start, end):
+        """
+        _load_element: Parse the element found in a byte range of the file
+
+        start: Offset of the start tag
+        end: Offset of the end tag (or right after an empty element tag)
+
+        return: The element
+        """
+        with open(self.filename, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start + 256)
+        tail = end - start
+        if data[tail:tail + 2] == b"</":
+            tail = data.index(b">", tail) + 1
+        namespaces = "".join(f' {key}="{value}"' for key, value in self._namespaces.items())
+        document = (f'<?xml version="1.0" encoding="{self._encoding}"?><Fragment{namespaces}>'.encode("ascii")
+                    + data[:tail] + b"</Fragment>")
+        return ET.fromstring(document)[0]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return device_from_element(self._load_element(*self._ranges[i]))
+
+    def __iter__(self):
+        return iter_devices(self.filename)
+
+    def get(self, product_code, revision_no=None):
+        """
+        get: Load a device by product code and revision number
+
+        product_code: The product code (integer or ESI number text)
+        revision_no: The revision number (None for the first device with
+                     this product code)
+
+        return: The Device, or None if there is no such device
+        """
+        if isinstance(product_code, str):
+            product_code = parse_number(product_code)
+        if isinstance(revision_no, str):
+            revision_no = parse_number(revision_no)
+        i = self._by_key.get((product_code, revision_no))
+        if i is None:
+            return None
+        return self[i]
+
+    def load(self):
+        """
+        load: Load all the devices
+
+        return: The ESI with all its devices
+        """
+        esi = ESI()
+        esi.vendor_id, esi.vendor_name = self.esi.vendor_id, self.esi.vendor_name
+        esi.group_type, esi.group_name = self.esi.group_type, self.esi.group_name
+        esi.lan9252 = self.esi.lan9252
+        esi.devices = list(self)
+        return esi
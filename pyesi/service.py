@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from pyesi.cache import DeviceCache, content_hash
+from pyesi.generator import iter_pretty_xml
+from pyesi.loader import esi_from_spec
+
+# Size of the chunks the generated ESI is streamed back in
+CHUNK_SIZE = 1 << 16
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def generate_esi(spec):
+    """
+    generate_esi: Generate the ESI document of a spec
+
+    Runs in the worker processes of the service.
+
+    spec: The spec dictionary, see pyesi.loader.esi_from_spec
+
+    return: The XML document (bytes)
+    """
+    return "".join(iter_pretty_xml(esi_from_spec(spec).to_xml())).encode("utf-8")
+
+
+def parse_spec(body, content_type=""):
+    """
+    parse_spec: Decode the spec sent to the service
+
+    body: The request body
+    content_type: The Content-Type of the request (YAML if it contains
+                  "yaml", JSON otherwise)
+
+    return: The spec dictionary
+    """
+    try:
+        spec = yaml.safe_load(body) if "yaml" in content_type else json.loads(body)
+    except (ValueError, yaml.YAMLError) as e:
+        raise ValueError(f"Invalid spec: {e}") from None
+    if not isinstance(spec, dict):
+        raise ValueError("The spec must be a mapping")
+    return spec
+
+
+class ESIService:
+    """
+    ESIService: Local HTTP service generating ESI documents from specs
+
+    POST /esi with a JSON (or YAML) spec returns the ESI document, streamed
+    with chunked transfer encoding. Documents are cached in an LRU keyed by
+    the spec hash, and concurrent requests for the same spec share one
+    build. Builds run in a process pool so they do not block the event loop
+    nor each other. GET /stats returns the cache statistics.
+
+    cache: DeviceCache of the generated documents by spec hash
+    executor: Executor running the builds
+    builds: Number of documents built by the workers
+    """
+
+    def __init__(self, cache_size=64, jobs=None, executor=None):
+        self.cache = DeviceCache(maxsize=cache_size)
+        self.executor = executor
+        self._jobs = jobs
+        self._own_executor = executor is None
+        self.builds = 0
+        self._pending = {}
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        start: Start listening
+
+        host: The address to listen on
+        port: The port (0 for any free port)
+
+        return: The (host, port) the service listens on
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self._jobs)
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """
+        close: Stop listening and shut the worker pool down
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._own_executor and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def serve_forever(self, host="127.0.0.1", port=8765):
+        await self.start(host, port)
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def generate(self, spec):
+        """
+        generate: Get the ESI document of a spec, from the cache or a worker
+
+        spec: The spec dictionary
+
+        return: (document bytes, True if it came from the cache)
+        """
+        key = content_hash(spec)
+        document = self.cache.get(key)
+        if document is not None:
+            return document, True
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending), True
+
+        loop = asyncio.get_running_loop()
+        self.builds += 1
+        pending = self._pending[key] = loop.run_in_executor(self.executor, generate_esi, spec)
+        try:
+            document = await pending
+        finally:
+            del self._pending[key]
+        self.cache.put(key, document)
+        return document, False
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                request = await self._read_request(reader)
+            except ValueError as e:
+                # malformed request line or Content-Length, or a line too long
+                await self._send(writer, 400, f"Malformed request: {e}\n".encode())
+                return
+            if request is not None:
+                await self._respond(writer, *request)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, path, headers, body
+
+    async def _respond(self, writer, method, path, headers, body):
+        if path == "/stats" and method == "GET":
+            stats = {"hits": self.cache.hits, "misses": self.cache.misses, "cached": len(self.cache), "builds": self.builds}
+            await self._send(writer, 200, json.dumps(stats).encode(), "application/json")
+            return
+        if path != "/esi":
+            await self._send(writer, 404, b"Unknown path\n")
+            return
+        if method != "POST":
+            await self._send(writer, 405, b"Use POST\n")
+            return
+        try:
+            document, cached = await self.generate(parse_spec(body, headers.get("content-type", "")))
+        except (ValueError, KeyError, TypeError) as e:
+            await self._send(writer, 400, f"{e}\n".encode())
+            return
+        except Exception as e:
+            await self._send(writer, 500, f"{type(e).__name__}: {e}\n".encode())
+            return
+
+        writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: application/xml\r\nTransfer-Encoding: chunked\r\n"
+                     f"X-Pyesi-Cache: {'hit' if cached else 'miss'}\r\nConnection: close\r\n\r\n".encode())
+        view = memoryview(document)
+        for start in range(0, len(view), CHUNK_SIZE):
+            chunk = view[start:start + CHUNK_SIZE]
+            writer.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _send(writer, status, body, content_type="text/plain"):
+        writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+
+class ServiceError(Exception):
+    """
+    ServiceError: Error response of the ESI service
+
+    status: The HTTP status
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def iter_remote_esi(spec, host="127.0.0.1", port=8765):
+    """
+    iter_remote_esi: Request the ESI of a spec from a service, chunk by chunk
+
+    spec: The spec dictionary
+    host: The address of the service
+    port: The port of the service
+
+    return: An async generator of the document chunks (bytes)
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        body = json.dumps(spec).encode()
+        writer.write(f"POST /esi HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if status != 200:
+            message = await reader.read()
+            raise ServiceError(status, message.decode("utf-8", "replace").strip())
+
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            if size == 0:
+                break
+            yield await reader.readexactly(size)
+            await reader.readexactly(2)
+    finally:
+        writer.close()
+
+
+async def request_esi(spec, host="127.0.0.1", port=8765):
+    """
+    request_esi: Request the ESI document of a spec from a service
+
+    spec: The spec dictionary
+    host: The address of the service
+    port: The port of the service
+
+    return: The XML document (bytes)
+    """
+    return b"".join([chunk async for chunk in iter_remote_esi(spec, host, port)])
+
+
+def fetch_esi(spec, host="127.0.0.1", port=8765):
+    """
+    fetch_esi: Blocking version of request_esi, for scripts
+    """
+    return asyncio.run(request_esi(spec, host, port))
+
+
+def main(argv=None):
+    """
+    main: Entry point of python -m pyesi.service
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code
+    """
+    parser = argparse.ArgumentParser(prog="python -m pyesi.service", description="Serve ESI generation over local HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--cache-size", type=int, default=64, help="number of documents kept in the cache")
+    args = parser.parse_args(argv)
+
+    service = ESIService(cache_size=args.cache_size, jobs=args.jobs)
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
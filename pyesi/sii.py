@@ -0,0 +1,285 @@
+import struct
+
+from pyesi.allocator import parse_index
+from pyesi.cache import write_if_changed
+from pyesi.generator import (EntryType, SyncManagerType, SyncManagerDir, LAN9252_EEPROM_BYTE_SIZE, LAN9252_CONFIG_DATA,
+                             LAN9252_BOOTSTRAP)
+from pyesi.layout import DeviceLayout
+from pyesi.reader import parse_number
+
+# SII category types (ETG.1000.6)
+CATEGORY_STRINGS = 10
+CATEGORY_GENERAL = 30
+CATEGORY_FMMU = 40
+CATEGORY_SYNCM = 41
+CATEGORY_TXPDO = 50
+CATEGORY_RXPDO = 51
+CATEGORY_END = 0xFFFF
+
+# CoE data type codes of the entry types
+_COE_DATA_TYPES = {
+    EntryType.BOOL: 0x0001,
+    EntryType.INT8: 0x0002,
+    EntryType.INT16: 0x0003,
+    EntryType.INT32: 0x0004,
+    EntryType.UINT8: 0x0005,
+    EntryType.UINT16: 0x0006,
+    EntryType.UINT32: 0x0007,
+    EntryType.REAL: 0x0008,
+    EntryType.LREAL: 0x0011,
+    EntryType.INT64: 0x0015,
+    EntryType.UINT64: 0x001B,
+}
+
+# Mailbox protocols word
+_MBOX_COE = 0x0004
+_MBOX_FOE = 0x0008
+
+# CoE details byte of the General category, as in the MailboxConfig of the
+# ESI: the PDO assignment can be changed when the device has PDO sets
+_COE_ENABLE_SDO = 0x01
+_COE_SDO_INFO = 0x02
+_COE_PDO_ASSIGN = 0x04
+_COE_COMPLETE_ACCESS = 0x20
+
+# PDO flags, as emitted in the ESI: PdoFixedContent, and PdoMandatory for
+# the PDOs found in every PDO set
+_PDO_MANDATORY = 0x0001
+_PDO_FIXED_CONTENT = 0x0010
+
+# Offsets (in bytes) of the fields patched per board
+_ALIAS_OFFSET = 0x08
+_SERIAL_OFFSET = 0x1C
+
+
+def crc8(data):
+    """
+    crc8: CRC of the SII configuration area (polynomial 0x07, initial 0xFF)
+
+    data: The first 14 bytes of the image
+
+    return: The CRC
+    """
+    crc = 0xFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+class _Strings:
+    """
+    _Strings: STRINGS category, indices start at 1 (0 means no string)
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.indices = {}
+
+    def index(self, text):
+        if not text:
+            return 0
+        index = self.indices.get(text)
+        if index is None:
+            if len(self.strings) == 255:
+                raise ValueError("An SII image can't hold more than 255 strings")
+            data = text.encode("latin-1", "replace")[:255]
+            self.strings.append(data)
+            index = self.indices[text] = len(self.strings)
+        return index
+
+    def data(self):
+        return bytes([len(self.strings)]) + b"".join(bytes([len(data)]) + data for data in self.strings)
+
+
+def _category(category_type, data):
+    if len(data) % 2:
+        data += b"\x00"
+    return struct.pack("<HH", category_type, len(data) // 2) + data
+
+
+def _sync_manager_type(sm):
+    if sm.sm_type == SyncManagerType.MAILBOX:
+        return 1 if sm.dir == SyncManagerDir.Rx else 2
+    return 3 if sm.dir == SyncManagerDir.Rx else 4
+
+
+def _header(esi, device):
+    """
+    _header: Words 0x00 to 0x3F of the image (alias and serial number zero)
+    """
+    header = bytearray(0x80)
+    if esi.lan9252:
+        header[0:10] = bytes.fromhex(LAN9252_CONFIG_DATA)
+        bootstrap = bytes.fromhex(LAN9252_BOOTSTRAP)
+        header[0x28:0x30] = bootstrap
+    try:
+        identity = [parse_number(value) for value in (esi.vendor_id, device.product_code, device.revision_no)]
+    except ValueError:
+        raise ValueError(f"The vendor id, product code and revision number of {device.name} must be numbers "
+                         f"to build its SII image") from None
+    struct.pack_into("<III", header, 0x10, *identity)
+
+    mailboxes = [sm for sm in device.sync_managers if sm.sm_type == SyncManagerType.MAILBOX]
+    for sm in mailboxes:
+        offset = 0x30 if sm.dir == SyncManagerDir.Rx else 0x34
+        struct.pack_into("<HH", header, offset, parse_index(sm.address), sm.default_size or 0)
+    protocols = 0
+    if device.enable_sdos:
+        protocols |= _MBOX_COE
+    if device.enable_foe:
+        protocols |= _MBOX_FOE
+    struct.pack_into("<H", header, 0x38, protocols)
+
+    kbits = LAN9252_EEPROM_BYTE_SIZE * 8 // 1024
+    struct.pack_into("<HH", header, 0x7C, kbits - 1, 1)
+    return header
+
+
+def _categories(esi, device):
+    strings = _Strings()
+    group = strings.index(esi.group_type)
+    name = strings.index(device.name)
+
+    general = bytearray(32)
+    general[0] = group
+    general[2] = name
+    general[3] = name
+    if device.enable_sdos:
+        general[5] = _COE_ENABLE_SDO
+        if device.sdo_info:
+            general[5] |= _COE_SDO_INFO
+        if device.pdo_sets:
+            general[5] |= _COE_PDO_ASSIGN
+        if device.complete_access:
+            general[5] |= _COE_COMPLETE_ACCESS
+    if device.enable_foe:
+        general[6] = 0x01
+    general[14] = group
+    # two MII ports ("YY")
+    struct.pack_into("<H", general, 16, 0x0011)
+
+    fmmus = bytearray()
+    for sm in device.sync_managers:
+        if sm.sm_type == SyncManagerType.BUFFERED:
+            fmmus.append(1 if sm.dir == SyncManagerDir.Rx else 2)
+    if any(sm.sm_type == SyncManagerType.MAILBOX for sm in device.sync_managers):
+        fmmus.append(3)
+
+    layout = DeviceLayout(device)
+    syncms = bytearray()
+    for sm_index, sm in enumerate(device.sync_managers):
+        length = sm.default_size
+        if length is None:
+            mapped = layout.sync_managers.get(sm_index)
+            length = mapped.size if mapped is not None else 0
+        syncms += struct.pack("<HHBBBB", parse_index(sm.address), length, parse_number(sm.control_byte), 0,
+                              0x01 if sm.enabled else 0x00, _sync_manager_type(sm))
+
+    pdos = {"RxPdo": bytearray(), "TxPdo": bytearray()}
+    optional = device.optional_pdos()
+    for tag, pdo, pdo_index, entries in device.iter_mapped_pdos():
+        data = pdos[tag]
+        flags = _PDO_FIXED_CONTENT if pdo.name in optional else _PDO_FIXED_CONTENT | _PDO_MANDATORY
+        data += struct.pack("<HBBBBH", parse_index(pdo_index), len(entries), pdo.sm_index, 0, strings.index(pdo.name), flags)
+        for entry_name, entry_type, index, sub_index, bitlen in entries:
+            data_type = 0 if entry_type is None else _COE_DATA_TYPES.get(entry_type, 0)
+            data += struct.pack("<HBBBBH", parse_index(index), sub_index if entry_type is not None else 0,
+                                strings.index(entry_name), data_type, int(bitlen), 0)
+
+    return b"".join([
+        _category(CATEGORY_STRINGS, strings.data()),
+        _category(CATEGORY_GENERAL, bytes(general)),
+        _category(CATEGORY_FMMU, bytes(fmmus)),
+        _category(CATEGORY_SYNCM, bytes(syncms)),
+        _category(CATEGORY_TXPDO, bytes(pdos["TxPdo"])) if pdos["TxPdo"] else b"",
+        _category(CATEGORY_RXPDO, bytes(pdos["RxPdo"])) if pdos["RxPdo"] else b"",
+        struct.pack("<H", CATEGORY_END),
+    ])
+
+
+def _patch(image, alias, serial):
+    struct.pack_into("<H", image, _ALIAS_OFFSET, alias)
+    struct.pack_into("<I", image, _SERIAL_OFFSET, serial)
+    image[0x0E] = crc8(image[0:14])
+    image[0x0F] = 0
+
+
+def sii_template(esi, device, size=None):
+    """
+    sii_template: Build the SII image of a device with alias and serial
+    number zero
+
+    esi: The ESI the device belongs to
+    device: The device
+    size: Pad the image with 0xFF to this many bytes (None for no padding)
+
+    return: The image (bytearray)
+    """
+    image = _header(esi, device) + _categories(esi, device)
+    if size is not None:
+        if len(image) > size:
+            raise ValueError(f"The SII image of {device.name} is {len(image)} bytes, more than {size}")
+        image += b"\xff" * (size - len(image))
+    _patch(image, 0, 0)
+    return image
+
+
+def sii_image(esi, device, alias=0, serial=0, size=None):
+    """
+    sii_image: Build the SII EEPROM image of a device
+
+    The image holds the configuration area (with its CRC), the identity and
+    mailbox words, and the STRINGS, General, FMMU, SyncM, TXPDO and RXPDO
+    categories.
+
+    esi: The ESI the device belongs to
+    device: The device
+    alias: Configured station alias
+    serial: Serial number
+    size: Pad the image with 0xFF to this many bytes (None for no padding)
+
+    return: The image (bytes)
+    """
+    image = sii_template(esi, device, size)
+    _patch(image, alias, serial)
+    return bytes(image)
+
+
+def sii_images(esi, device, boards, size=None):
+    """
+    sii_images: Build the SII images of many boards of the same device
+
+    The image is built once, each board only patches its alias, serial
+    number and the configuration CRC.
+
+    esi: The ESI the device belongs to
+    device: The device
+    boards: Iterable of (alias, serial number)
+    size: Pad the images with 0xFF to this many bytes (None for no padding)
+
+    return: A generator of images (bytes)
+    """
+    template = sii_template(esi, device, size)
+    for alias, serial in boards:
+        image = bytearray(template)
+        _patch(image, alias, serial)
+        yield bytes(image)
+
+
+def write_sii(esi, device, filename, alias=0, serial=0, size=None):
+    """
+    write_sii: Write the SII EEPROM image (.bin) of a device, only if it
+    changed
+
+    esi: The ESI the device belongs to
+    device: The device
+    filename: The file name
+    alias: Configured station alias
+    serial: Serial number
+    size: Pad the image with 0xFF to this many bytes (None for no padding)
+
+    return: True if the file was written, False if it was unchanged
+    """
+    return write_if_changed([sii_image(esi, device, alias, serial, size)], filename)
@@ -0,0 +1,496 @@
+import argparse
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from pyesi.layout import DeviceLayout, np
+
+# Header of the frames exchanged over sockets: the cycle counter
+_HEADER = struct.Struct("<I")
+
+
+class Histogram:
+    """
+    Histogram: Distribution of durations with a fixed resolution
+
+    Durations are counted in bins of resolution nanoseconds, the ones above
+    the last bin in an overflow count, so recording is O(1) and does not
+    allocate.
+
+    resolution: Width of the bins in nanoseconds
+    bins: Number of bins
+    count: Number of durations recorded
+    min: Shortest duration in nanoseconds (None if empty)
+    max: Longest duration in nanoseconds (None if empty)
+    overflow: Number of durations above the last bin
+    """
+
+    def __init__(self, resolution=1000, bins=10000):
+        self.resolution = resolution
+        self.bins = array("Q", bytes(8 * bins))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.overflow = 0
+
+    def record(self, duration):
+        """
+        record: Count a duration
+
+        duration: The duration in nanoseconds
+        """
+        duration = max(duration, 0)
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        bin_index = duration // self.resolution
+        if bin_index < len(self.bins):
+            self.bins[bin_index] += 1
+        else:
+            self.overflow += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        """
+        percentile: Estimate a percentile of the durations
+
+        p: The percentile (0-100)
+
+        return: The upper bound of the bin of the percentile in nanoseconds
+                (the maximum if it is in the overflow, None if empty)
+        """
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * p // 100))
+        seen = 0
+        for bin_index, count in enumerate(self.bins):
+            seen += count
+            if seen >= rank:
+                return min((bin_index + 1) * self.resolution, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "p99.9": self.percentile(99.9),
+            "max": self.max,
+            "overflow": self.overflow,
+        }
+
+    def __str__(self):
+        if not self.count:
+            return "no samples"
+        values = self.to_dict()
+        return "  ".join(f"{name} {values[name] / 1000:.1f} us" for name in ("min", "mean", "p50", "p99", "p99.9", "max"))
+
+
+class VirtualSlave:
+    """
+    VirtualSlave: Process data of a simulated device on a VirtualBus
+
+    The slave owns a slice of the bus output frame (its Rx image, written by
+    the master) and of the bus input frame (its Tx image, read by the
+    master), laid out as its PDOs and sync managers (see DeviceLayout).
+
+    bus: The VirtualBus of the slave
+    position: Position of the slave on the bus
+    device: The Device
+    layout: The DeviceLayout of the device
+    rx_offset: Offset of its Rx image in the output frame
+    tx_offset: Offset of its Tx image in the input frame
+    """
+
+    def __init__(self, bus, position, device, layout, rx_offset, tx_offset):
+        self.bus = bus
+        self.position = position
+        self.device = device
+        self.layout = layout
+        self.rx_offset = rx_offset
+        self.tx_offset = tx_offset
+
+    @property
+    def rx_image(self):
+        return memoryview(self.bus.outputs)[self.rx_offset:self.rx_offset + self.layout.rx.size]
+
+    @property
+    def tx_image(self):
+        return memoryview(self.bus.inputs)[self.tx_offset:self.tx_offset + self.layout.tx.size]
+
+    def outputs(self):
+        """
+        outputs: Decode the values the master sent to the slave
+
+        return: Dictionary of the values by field name
+        """
+        return self.layout.rx.unpack(self.bus.outputs, self.rx_offset)
+
+    def set_inputs(self, **values):
+        """
+        set_inputs: Encode the values the slave sends to the master
+
+        values: The values by field name (missing ones are set to 0)
+        """
+        self.layout.tx.pack_into(self.bus.inputs, self.tx_offset, **values)
+
+
+class VirtualBus:
+    """
+    VirtualBus: Simulated slaves sharing one pair of process data frames
+
+    As with the logical addressing of a real segment, the Rx images of all
+    the slaves follow each other in the output frame, and their Tx images in
+    the input frame. Identical consecutive slaves can then be read and
+    written together through one NumPy view (see view), and the update
+    function simulates the whole bus in one call per cycle.
+
+    slaves: The VirtualSlave, in bus order
+    outputs: The output frame (master to slaves)
+    inputs: The input frame (slaves to master)
+    update: Function called as update(bus, cycle) after the outputs of each
+            cycle are received, to compute the inputs (None to keep them)
+    cycles: Number of cycles exchanged
+    """
+
+    def __init__(self, devices, update=None):
+        self.slaves = []
+        self.update = update
+        self.cycles = 0
+        layouts = {}
+        rx_size = tx_size = 0
+        for position, device in enumerate(devices):
+            # identical definitions share their layout
+            layout = layouts.get(id(device))
+            if layout is None:
+                layout = layouts[id(device)] = DeviceLayout(device)
+            self.slaves.append(VirtualSlave(self, position, device, layout, rx_size, tx_size))
+            rx_size += layout.rx.size
+            tx_size += layout.tx.size
+        self.outputs = bytearray(rx_size)
+        self.inputs = bytearray(tx_size)
+        self._lock = threading.Lock()
+
+    def exchange(self, outputs, cycle=None):
+        """
+        exchange: Run one cycle: receive the outputs, update and return the
+        inputs
+
+        outputs: The output frame sent by the master
+        cycle: The cycle number (defaults to the number of cycles exchanged)
+
+        return: The input frame (bytes)
+        """
+        with self._lock:
+            if len(outputs) != len(self.outputs):
+                raise ValueError(f"Output frame of {len(outputs)} bytes, the bus expects {len(self.outputs)}")
+            self.outputs[:] = outputs
+            if self.update is not None:
+                self.update(self, self.cycles if cycle is None else cycle)
+            self.cycles += 1
+            return bytes(self.inputs)
+
+    def view(self, direction, start=0, count=None):
+        """
+        view: View the images of consecutive slaves as one NumPy array
+
+        direction: "rx" (outputs) or "tx" (inputs)
+        start: Position of the first slave
+        count: Number of slaves (defaults to the rest of the bus)
+
+        return: The structured numpy array, one row per slave, sharing the
+                memory of the frame
+        """
+        if np is None:
+            raise ImportError("VirtualBus.view requires numpy")
+        slaves = self.slaves[start:None if count is None else start + count]
+        if not slaves:
+            raise ValueError("No slave to view")
+        images = [getattr(slave.layout, direction) for slave in slaves]
+        if any(image.struct.format != images[0].struct.format or image.fields != images[0].fields for image in images):
+            raise ValueError("The slaves of a view must have the same layout")
+        frame = self.outputs if direction == "rx" else self.inputs
+        offset = slaves[0].rx_offset if direction == "rx" else slaves[0].tx_offset
+        return images[0].view(frame, offset, len(slaves))
+
+
+def _address_family(address):
+    # a path is a unix socket, a (host, port) an UDP socket
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+class SocketServer:
+    """
+    SocketServer: Serve a VirtualBus to a master over a datagram socket
+
+    Each datagram holds a cycle counter and the output frame; the reply
+    holds the same counter and the input frame. The server runs in a thread.
+
+    bus: The VirtualBus
+    address: The (host, port) of the UDP socket, or the path of a unix
+             datagram socket
+    """
+
+    def __init__(self, bus, address=("127.0.0.1", 0)):
+        self.bus = bus
+        self._socket = socket.socket(_address_family(address), socket.SOCK_DGRAM)
+        if isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)
+        self._socket.bind(address)
+        self._socket.settimeout(0.1)
+        self.address = self._socket.getsockname()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        start: Serve the bus in a background thread
+
+        return: The address of the socket
+        """
+        self._thread = threading.Thread(target=self.serve, name="pyesi-simulator", daemon=True)
+        self._thread.start()
+        return self.address
+
+    def serve(self):
+        size = _HEADER.size + len(self.bus.outputs)
+        while not self._stop.is_set():
+            try:
+                datagram, sender = self._socket.recvfrom(size)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(datagram) != size:
+                continue
+            cycle, = _HEADER.unpack_from(datagram)
+            inputs = self.bus.exchange(memoryview(datagram)[_HEADER.size:], cycle)
+            self._socket.sendto(_HEADER.pack(cycle) + inputs, sender)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._socket.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class LocalMaster:
+    """
+    LocalMaster: Stand-in master exchanging frames with an in-process bus
+
+    outputs: The output frame sent at each cycle
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.outputs = bytearray(len(bus.outputs))
+
+    def exchange(self, cycle):
+        """
+        exchange: Send the outputs and receive the inputs of a cycle
+
+        cycle: The cycle number
+
+        return: The input frame, None if it was lost
+        """
+        return self.bus.exchange(self.outputs, cycle)
+
+    def close(self):
+        pass
+
+
+class SocketMaster:
+    """
+    SocketMaster: Stand-in master exchanging frames with a SocketServer
+
+    outputs: The output frame sent at each cycle
+    timeout: Time to wait for the reply of a cycle, in seconds
+    """
+
+    def __init__(self, address, rx_size, tx_size, timeout=0.01):
+        self.outputs = bytearray(rx_size)
+        self.timeout = timeout
+        self._reply_size = _HEADER.size + tx_size
+        self._socket = socket.socket(_address_family(address), socket.SOCK_DGRAM)
+        self._path = None
+        if isinstance(address, str):
+            # unix datagram sockets need a bound address to get replies
+            self._path = os.path.join(tempfile.gettempdir(), f"pyesi-master-{os.getpid()}-{id(self)}")
+            self._socket.bind(self._path)
+        self._socket.connect(address)
+        self._socket.settimeout(timeout)
+
+    def exchange(self, cycle):
+        cycle &= 0xFFFFFFFF
+        self._socket.send(_HEADER.pack(cycle) + self.outputs)
+        while True:
+            try:
+                reply = self._socket.recv(self._reply_size)
+            except socket.timeout:
+                return None
+            # drop the late replies of previous cycles
+            if _HEADER.unpack_from(reply)[0] == cycle:
+                return reply[_HEADER.size:]
+
+    def close(self):
+        self._socket.close()
+        if self._path is not None and os.path.exists(self._path):
+            os.unlink(self._path)
+
+
+class CycleStats:
+    """
+    CycleStats: Measurements of a cyclic exchange, see run_cycles
+
+    frequency: The requested cycle frequency in Hz
+    cycles: Number of cycles run
+    lost: Number of cycles without a reply
+    overruns: Number of cycles that ended after the start of the next one
+    duration: Wall time of the run in seconds
+    latency: Histogram of the round trip time of the frames
+    jitter: Histogram of the delay between the scheduled and actual start
+            of the cycles
+    """
+
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.cycles = 0
+        self.lost = 0
+        self.overruns = 0
+        self.duration = 0.0
+        self.latency = Histogram()
+        self.jitter = Histogram()
+
+    def to_dict(self):
+        return {
+            "frequency": self.frequency,
+            "cycles": self.cycles,
+            "lost": self.lost,
+            "overruns": self.overruns,
+            "duration": self.duration,
+            "latency": self.latency.to_dict(),
+            "jitter": self.jitter.to_dict(),
+        }
+
+    def __str__(self):
+        rate = self.cycles / self.duration if self.duration else 0.0
+        return (f"{self.cycles} cycles at {rate:.0f} Hz (requested {self.frequency:g} Hz), "
+                f"{self.lost} lost, {self.overruns} overruns\n"
+                f"latency  {self.latency}\n"
+                f"jitter   {self.jitter}")
+
+
+# Sleep until this close to the start of a cycle, then spin
+_SPIN_NS = 200_000
+
+
+def run_cycles(master, frequency=1000, cycles=1000, before_cycle=None):
+    """
+    run_cycles: Exchange frames at a fixed frequency and measure the cycles
+
+    A cycle that overruns its period does not trigger catch-up cycles: the
+    next one starts as soon as it ends.
+
+    master: The LocalMaster or SocketMaster
+    frequency: The cycle frequency in Hz
+    cycles: Number of cycles to run
+    before_cycle: Optional function called as before_cycle(master, cycle)
+                  to fill the outputs
+
+    return: The CycleStats
+    """
+    stats = CycleStats(frequency)
+    period = round(1e9 / frequency)
+    clock = time.perf_counter_ns
+    start = deadline = clock()
+    for cycle in range(cycles):
+        now = clock()
+        if deadline - now > _SPIN_NS:
+            time.sleep((deadline - now - _SPIN_NS) / 1e9)
+        while now < deadline:
+            now = clock()
+        stats.jitter.record(now - deadline)
+
+        if before_cycle is not None:
+            before_cycle(master, cycle)
+        if master.exchange(cycle) is None:
+            stats.lost += 1
+        end = clock()
+        stats.latency.record(end - now)
+        stats.cycles += 1
+
+        deadline += period
+        if end > deadline:
+            stats.overruns += 1
+            deadline = end
+    stats.duration = (clock() - start) / 1e9
+    return stats
+
+
+def main(argv=None):
+    """
+    main: Entry point of python -m pyesi.simulator
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code
+    """
+    from pyesi.loader import load_esi
+    from pyesi.reader import read_esi
+
+    parser = argparse.ArgumentParser(prog="python -m pyesi.simulator",
+                                     description="Exchange cyclic frames with simulated slaves and measure the cycles.")
+    parser.add_argument("file", help="YAML/JSON spec or ESI XML file")
+    parser.add_argument("-n", "--slaves", type=int, default=1, help="number of copies of each device (default: 1)")
+    parser.add_argument("-f", "--frequency", type=float, default=1000, help="cycle frequency in Hz (default: 1000)")
+    parser.add_argument("-c", "--cycles", type=int, default=1000, help="number of cycles (default: 1000)")
+    parser.add_argument("--udp", action="store_true", help="exchange the frames over a local UDP socket")
+    parser.add_argument("--unix", metavar="PATH", help="exchange the frames over a unix datagram socket")
+    args = parser.parse_args(argv)
+
+    esi = read_esi(args.file) if args.file.lower().endswith(".xml") else load_esi(args.file)
+    bus = VirtualBus([device for device in esi.devices for _ in range(args.slaves)])
+    print(f"{len(bus.slaves)} slaves, {len(bus.outputs)} bytes out, {len(bus.inputs)} bytes in")
+
+    server = None
+    if args.udp or args.unix:
+        server = SocketServer(bus, args.unix or ("127.0.0.1", 0))
+        address = server.start()
+        master = SocketMaster(address, len(bus.outputs), len(bus.inputs))
+    else:
+        master = LocalMaster(bus)
+    try:
+        print(run_cycles(master, args.frequency, args.cycles))
+    finally:
+        master.close()
+        if server is not None:
+            server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
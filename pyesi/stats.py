@@ -0,0 +1,230 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# GenerationStats collecting the phases of the current context (None when
+# instrumentation is disabled)
+_active = ContextVar("pyesi_stats", default=None)
+
+
+class PhaseStats:
+    """
+    PhaseStats: Measurements of one phase of a generation run
+
+    name: Name of the phase ("to_xml", "device", "prettify_xml", "write_xml")
+    device: Name of the device the phase worked on (None for whole-run phases)
+    duration: Wall time in seconds
+    elements: Number of XML elements built (None if not relevant)
+    bytes: Number of bytes produced (None if not relevant)
+    peak_memory: Peak of the memory allocated during the phase, in bytes
+                 (None if memory tracing is disabled)
+    info: Extra values of the phase
+    """
+
+    def __init__(self, name, device=None):
+        self.name = name
+        self.device = device
+        self.duration = 0.0
+        self.elements = None
+        self.bytes = None
+        self.peak_memory = None
+        self.info = {}
+        self._start = 0.0
+        self._memory_start = 0
+        self._memory_peak = 0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "device": self.device,
+            "duration": self.duration,
+            "elements": self.elements,
+            "bytes": self.bytes,
+            "peak_memory": self.peak_memory,
+            "info": self.info,
+        }
+
+    def __repr__(self):
+        return f"PhaseStats(name={self.name!r}, device={self.device!r}, duration={self.duration:.6f})"
+
+
+class GenerationStats:
+    """
+    GenerationStats: Measurements of a generation run, see instrument
+
+    phases: PhaseStats of the finished phases, in completion order
+    memory: Whether the peak memory of the phases is measured
+    """
+
+    def __init__(self, memory=False, callback=None):
+        self.phases = []
+        self.memory = memory
+        self._callback = callback
+        self._open = []
+
+    def _start(self, phase):
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            for parent in self._open:
+                parent._memory_peak = max(parent._memory_peak, peak)
+            tracemalloc.reset_peak()
+            phase._memory_start = phase._memory_peak = current
+        self._open.append(phase)
+        phase._start = time.perf_counter()
+
+    def _stop(self, phase):
+        phase.duration = time.perf_counter() - phase._start
+        self._open.remove(phase)
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            phase.peak_memory = max(phase._memory_peak, peak) - phase._memory_start
+            for parent in self._open:
+                parent._memory_peak = max(parent._memory_peak, peak)
+        self.phases.append(phase)
+        if self._callback is not None:
+            self._callback(phase)
+
+    def summary(self):
+        """
+        summary: Aggregate the phases by name
+
+        return: Dictionary by phase name of the count, total duration,
+                elements, bytes and largest peak memory
+        """
+        summary = {}
+        for phase in self.phases:
+            total = summary.setdefault(phase.name, {"count": 0, "duration": 0.0, "elements": 0, "bytes": 0,
+                                                    "peak_memory": None})
+            total["count"] += 1
+            total["duration"] += phase.duration
+            total["elements"] += phase.elements or 0
+            total["bytes"] += phase.bytes or 0
+            if phase.peak_memory is not None:
+                total["peak_memory"] = max(total["peak_memory"] or 0, phase.peak_memory)
+        return summary
+
+    def devices(self):
+        """
+        devices: The per-device phases
+
+        return: Dictionary of the list of PhaseStats by device name
+        """
+        devices = {}
+        for phase in self.phases:
+            if phase.device is not None:
+                devices.setdefault(phase.device, []).append(phase)
+        return devices
+
+    def to_dict(self):
+        return {"summary": self.summary(), "phases": [phase.to_dict() for phase in self.phases]}
+
+    def to_json(self, indent=None):
+        """
+        to_json: Export the stats as JSON
+
+        indent: Indentation of the JSON (None for a single line)
+
+        return: The JSON text
+        """
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def __str__(self):
+        lines = []
+        for name, total in self.summary().items():
+            line = f"{name:14} x{total['count']:<6} {total['duration'] * 1000:10.2f} ms"
+            if total["elements"]:
+                line += f" {total['elements']:8} elements"
+            if total["bytes"]:
+                line += f" {total['bytes']:10} bytes"
+            if total["peak_memory"] is not None:
+                line += f" peak {total['peak_memory'] / 1024:.0f} KiB"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class _NullPhase:
+    """
+    _NullPhase: Phase context used when instrumentation is disabled
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+
+    def __enter__(self):
+        self.stats._start(self.phase)
+        return self.phase
+
+    def __exit__(self, *exc):
+        self.stats._stop(self.phase)
+        return False
+
+
+def phase(name, device=None):
+    """
+    phase: Measure a phase of the generation
+
+    Without an active instrument context this returns a shared no-op context
+    manager yielding None, so the instrumented code only pays for a lookup.
+    The code can fill the elements, bytes and info of the yielded PhaseStats
+    when it is not None.
+
+    name: Name of the phase
+    device: Name of the device the phase works on
+
+    return: The context manager, yielding the PhaseStats or None
+    """
+    stats = _active.get()
+    if stats is None:
+        return _NULL_PHASE
+    return _Phase(stats, PhaseStats(name, device))
+
+
+def enabled():
+    """
+    enabled: Whether an instrument context is active
+
+    return: True if the phases are measured
+    """
+    return _active.get() is not None
+
+
+@contextmanager
+def instrument(memory=False, callback=None):
+    """
+    instrument: Measure the generation phases run in the context
+
+        with instrument(memory=True) as stats:
+            write_xml(esi.to_xml(), "device.xml")
+        print(stats.to_json())
+
+    memory: Also measure the peak memory of each phase with tracemalloc
+            (slows the generation down)
+    callback: Optional function called with each PhaseStats when it ends
+
+    return: The GenerationStats, filled as the phases end
+    """
+    stats = GenerationStats(memory, callback)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    token = _active.set(stats)
+    try:
+        yield stats
+    finally:
+        _active.reset(token)
+        if started:
+            tracemalloc.stop()
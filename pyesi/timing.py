@@ -0,0 +1,206 @@
+import argparse
+import sys
+
+from pyesi.layout import DeviceLayout
+
+# Bytes of an Ethernet frame on the wire around its payload: preamble and
+# SFD (8), header (14), FCS (4) and inter-frame gap (12)
+ETHERNET_OVERHEAD = 38
+ETHERNET_MIN_PAYLOAD = 46
+ETHERNET_MAX_PAYLOAD = 1500
+# EtherCAT header of a frame, header and working counter of a datagram
+ETHERCAT_HEADER = 2
+DATAGRAM_OVERHEAD = 12
+# Datagram distributing the DC system time (ARMW of 8 bytes) sent each cycle
+DC_DATAGRAM = DATAGRAM_OVERHEAD + 8
+# Propagation delay of a copper cable in ns per meter
+CABLE_DELAY = 5
+
+
+class BusTiming:
+    """
+    BusTiming: Cycle time budget of a chain of devices, see bus_timing
+
+    All the times are in ns.
+
+    slaves: Number of devices in the chain
+    output_bytes: Process data sent to the devices per cycle
+    input_bytes: Process data read from the devices per cycle
+    frames: Wire size of the frames sent per cycle, in bytes
+    wire_time: Time to send the frames
+    outbound_time: Time for the process data to reach the last device
+    round_trip: Time for the last frame to come back to the master
+    sync0_shift: Recommended Sync0 shift: the outputs have reached all
+                 the devices, plus the jitter margin
+    cycle_time: Minimum safe cycle time
+    """
+
+    def __init__(self):
+        self.slaves = 0
+        self.output_bytes = 0
+        self.input_bytes = 0
+        self.frames = []
+        self.wire_time = 0
+        self.outbound_time = 0
+        self.round_trip = 0
+        self.sync0_shift = 0
+        self.cycle_time = 0
+
+    @property
+    def frequency(self):
+        """
+        frequency: Highest cycle frequency in Hz
+        """
+        return 1e9 / self.cycle_time if self.cycle_time else None
+
+    def to_dict(self):
+        return {
+            "slaves": self.slaves,
+            "output_bytes": self.output_bytes,
+            "input_bytes": self.input_bytes,
+            "frames": self.frames,
+            "wire_time": self.wire_time,
+            "outbound_time": self.outbound_time,
+            "round_trip": self.round_trip,
+            "sync0_shift": self.sync0_shift,
+            "cycle_time": self.cycle_time,
+            "frequency": self.frequency,
+        }
+
+    def __str__(self):
+        return (f"{self.slaves} slaves, {self.output_bytes} bytes out, {self.input_bytes} bytes in\n"
+                f"frames        {len(self.frames)} ({sum(self.frames)} bytes on the wire)\n"
+                f"wire time     {self.wire_time / 1000:.2f} us\n"
+                f"round trip    {self.round_trip / 1000:.2f} us\n"
+                f"sync0 shift   {self.sync0_shift / 1000:.2f} us\n"
+                f"cycle time    {self.cycle_time / 1000:.2f} us ({self.frequency:.0f} Hz)")
+
+
+def frame_sizes(process_bytes, dc=True):
+    """
+    frame_sizes: Wire size of the frames carrying the process data of a cycle
+
+    The process data is read and written by LRW datagrams, split into as
+    many frames as needed. The first frame also carries the DC datagram.
+
+    process_bytes: Size of the process data (outputs and inputs)
+    dc: Send the DC system time datagram
+
+    return: The list of the frame sizes in bytes, overhead included
+    """
+    frames = []
+    remaining = process_bytes
+    first = True
+    while remaining > 0 or first:
+        payload = ETHERCAT_HEADER + (DC_DATAGRAM if dc and first else 0)
+        data = min(remaining, ETHERNET_MAX_PAYLOAD - payload - DATAGRAM_OVERHEAD)
+        if data > 0:
+            payload += DATAGRAM_OVERHEAD + data
+        frames.append(ETHERNET_OVERHEAD + max(payload, ETHERNET_MIN_PAYLOAD))
+        remaining -= data
+        first = False
+    return frames
+
+
+def _round_up(value, granularity):
+    return -(-round(value) // granularity) * granularity
+
+
+def bus_timing(devices, forwarding_delay=1000, cable_length=1, link_speed=100_000_000, jitter_margin=20_000,
+               processing_time=0, master_time=0, granularity=1000, dc=True, pdo_set=None):
+    """
+    bus_timing: Estimate the cycle time budget of a chain of devices
+
+    The frames go through every device and come back: the round trip is
+    the wire time of the frames plus, per device, the forwarding delay and
+    the cable there and back. Sync0 fires once the outputs have reached
+    the last device. The next cycle can start once the frames are back and
+    processed by the master, and once the devices have processed their
+    outputs after Sync0.
+
+    devices: The devices, in chain order (repeat a device for each copy)
+    forwarding_delay: Delay of a device in ns, both directions (processing
+                      and forwarding through its ports)
+    cable_length: Length of the cable between devices in meters
+    link_speed: Speed of the link in bit/s
+    jitter_margin: Margin for the jitter of the master in ns
+    processing_time: Time the devices need after Sync0 to update their
+                     inputs, in ns
+    master_time: Time the master needs between receiving the frames and
+                 sending the next ones, in ns
+    granularity: The recommended times are rounded up to a multiple of it,
+                 in ns
+    dc: Send the DC system time datagram every cycle
+    pdo_set: Count the PDOs of this set of the devices that define it (see
+             Device.pdo_sets), their default assignment otherwise
+
+    return: The BusTiming
+    """
+    timing = BusTiming()
+    layouts = {}
+    for device in devices:
+        layout = layouts.get(id(device))
+        if layout is None:
+            layout = layouts[id(device)] = DeviceLayout(device, pdo_set if pdo_set in device.pdo_sets else None)
+        timing.slaves += 1
+        timing.output_bytes += layout.rx.size
+        timing.input_bytes += layout.tx.size
+
+    timing.frames = frame_sizes(timing.output_bytes + timing.input_bytes, dc)
+    timing.wire_time = round(sum(timing.frames) * 8 * 1e9 / link_speed)
+    hop = forwarding_delay / 2 + cable_length * CABLE_DELAY
+    timing.outbound_time = round(timing.wire_time + timing.slaves * hop)
+    timing.round_trip = round(timing.wire_time + 2 * timing.slaves * hop)
+    timing.sync0_shift = _round_up(timing.outbound_time + jitter_margin, granularity)
+    timing.cycle_time = _round_up(max(timing.round_trip + master_time + jitter_margin,
+                                      timing.sync0_shift + processing_time), granularity)
+    return timing
+
+
+def apply_timing(devices, timing):
+    """
+    apply_timing: Configure the DC timing of devices from a budget
+
+    devices: The devices
+    timing: The BusTiming, see bus_timing
+    """
+    for device in devices:
+        device.dc_cycle_time = timing.cycle_time
+        device.dc_shift_time = timing.sync0_shift
+
+
+def main(argv=None):
+    """
+    main: Entry point of python -m pyesi.timing
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code
+    """
+    from pyesi.loader import load_esi
+    from pyesi.reader import read_esi
+
+    parser = argparse.ArgumentParser(prog="python -m pyesi.timing",
+                                     description="Estimate the minimum cycle time of a chain of devices.")
+    parser.add_argument("file", help="YAML/JSON spec or ESI XML file")
+    parser.add_argument("-n", "--slaves", type=int, default=1, help="number of copies of each device (default: 1)")
+    parser.add_argument("--forwarding-delay", type=float, default=1.0, help="delay of a device in us (default: 1)")
+    parser.add_argument("--cable-length", type=float, default=1.0, help="cable length between devices in m (default: 1)")
+    parser.add_argument("--jitter-margin", type=float, default=20.0, help="margin for the master jitter in us (default: 20)")
+    parser.add_argument("--processing-time", type=float, default=0.0,
+                        help="time the devices need after Sync0 in us (default: 0)")
+    parser.add_argument("--pdo-set", help="count the PDOs of this alternative PDO set")
+    parser.add_argument("--master-time", type=float, default=0.0,
+                        help="time the master needs between cycles in us (default: 0)")
+    args = parser.parse_args(argv)
+
+    esi = read_esi(args.file) if args.file.lower().endswith(".xml") else load_esi(args.file)
+    devices = [device for device in esi.devices for _ in range(args.slaves)]
+    print(bus_timing(devices, forwarding_delay=args.forwarding_delay * 1000, cable_length=args.cable_length,
+                     jitter_margin=args.jitter_margin * 1000, processing_time=args.processing_time * 1000,
+                     master_time=args.master_time * 1000, pdo_set=args.pdo_set))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
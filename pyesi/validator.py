@@ -0,0 +1,248 @@
+import argparse
+import sys
+
+from pyesi.allocator import parse_index
+from pyesi.generator import SyncManagerType, SyncManagerDir
+
+# PDO index ranges of the CoE communication area
+PDO_INDEX_RANGES = {
+    "RxPdo": (0x1600, 0x17FF),
+    "TxPdo": (0x1A00, 0x1BFF),
+}
+
+# Process data RAM of the ESC: registers end at 0x1000, the LAN9252 has 4 KB
+PROCESS_RAM_START = 0x1000
+LAN9252_PROCESS_RAM_END = 0x2000
+
+
+class Violation:
+    """
+    Violation: A rule of the model broken by a device
+
+    device: Name of the device
+    location: Where the violation is ("Sm[2] OrbitaIn", "TxPdo OrbitaState"...)
+    message: Description of the violation
+    """
+
+    def __init__(self, device, location, message):
+        self.device = device
+        self.location = location
+        self.message = message
+
+    def __str__(self):
+        return f"{self.device}: {self.location}: {self.message}"
+
+    def __repr__(self):
+        return f"Violation({str(self)!r})"
+
+
+class ValidationError(ValueError):
+    """
+    ValidationError: The model has violations
+
+    violations: The list of Violation
+    """
+
+    def __init__(self, violations):
+        super().__init__("\n".join(str(violation) for violation in violations))
+        self.violations = violations
+
+    def __reduce__(self):
+        # keep the violations when raised in a worker process
+        return type(self), (self.violations,)
+
+
+def _sm_location(sm_index, sm):
+    return f"Sm[{sm_index}] {sm.name}"
+
+
+def _check_pdo_sync_manager(device, tag, pdo, report):
+    """
+    _check_pdo_sync_manager: Check the sync manager a PDO is mapped to
+
+    return: True if the sync manager exists
+    """
+    location = f"{tag} {pdo.name}"
+    if not 0 <= pdo.sm_index < len(device.sync_managers):
+        report(location, f"mapped to sync manager {pdo.sm_index}, the device has {len(device.sync_managers)}")
+        return False
+    sm = device.sync_managers[pdo.sm_index]
+    if sm.sm_type == SyncManagerType.MAILBOX:
+        report(location, f"mapped to the mailbox {_sm_location(pdo.sm_index, sm)}")
+    expected = SyncManagerDir.Rx if tag == "RxPdo" else SyncManagerDir.Tx
+    if sm.dir != expected:
+        report(location, f"mapped to {_sm_location(pdo.sm_index, sm)} of direction {sm.dir.name}")
+    return True
+
+
+def validate_device(device, lan9252=False):
+    """
+    validate_device: Check a device in a single pass over its model
+
+    Entries are indexed by (index, sub_index) and by index, PDOs by index,
+    and the sync manager address ranges are checked for overlaps and for
+    the process RAM limits.
+
+    device: The device
+    lan9252: Check the sync managers against the 4 KB process RAM of the
+             LAN9252
+
+    return: The list of Violation, empty if the device is valid
+    """
+    violations = []
+
+    def report(location, message):
+        violations.append(Violation(device.name, location, message))
+
+    pdo_indices = {}
+    entries = {}
+    sub_zero = {}
+    sub_other = {}
+    bits = {}
+    for tag, pdo, pdo_index, mapped in device.iter_mapped_pdos():
+        location = f"{tag} {pdo.name}"
+        if _check_pdo_sync_manager(device, tag, pdo, report):
+            bits[pdo.sm_index] = bits.get(pdo.sm_index, 0) + sum(int(entry[4]) for entry in mapped)
+
+        try:
+            index = parse_index(pdo_index)
+        except ValueError:
+            report(location, f"invalid index {pdo_index!r}")
+        else:
+            low, high = PDO_INDEX_RANGES[tag]
+            if not low <= index <= high:
+                report(location, f"index #x{index:04X} outside of the {tag} range #x{low:04X}-#x{high:04X}")
+            if index in pdo_indices:
+                report(location, f"index #x{index:04X} already used by {pdo_indices[index]}")
+            else:
+                pdo_indices[index] = location
+
+        if len(mapped) > 255:
+            report(location, f"{len(mapped)} entries, a PDO maps at most 255")
+
+        for position, (name, entry_type, entry_index, sub_index, bitlen) in enumerate(mapped):
+            if entry_type is None:
+                continue
+            entry_location = f"{location} entry {position} ({name})"
+            try:
+                index = parse_index(entry_index)
+            except ValueError:
+                report(entry_location, f"invalid index {entry_index!r}")
+                continue
+            if sub_index > 255:
+                report(entry_location, f"sub index {sub_index} does not fit in 8 bits")
+            key = (index, sub_index)
+            if key in entries:
+                report(entry_location, f"#x{index:04X}:{sub_index} already mapped by {entries[key]}")
+                continue
+            entries[key] = entry_location
+            if sub_index == 0:
+                sub_zero.setdefault(index, entry_location)
+            else:
+                sub_other.setdefault(index, entry_location)
+
+    for index, location in sub_zero.items():
+        if index in sub_other:
+            report(location, f"#x{index:04X}:0 is mapped as a value while {sub_other[index]} maps the sub indices "
+                             f"of #x{index:04X} (sub index 0 of an array or record is its number of entries)")
+
+    names = {pdo.name for pdo in device.RxPdos} | {pdo.name for pdo in device.TxPdos}
+    for set_name, pdo_names in device.pdo_sets.items():
+        for pdo_name in pdo_names:
+            if pdo_name not in names:
+                report(f"PDO set {set_name}", f"unknown PDO {pdo_name!r}")
+
+    intervals = []
+    for sm_index, sm in enumerate(device.sync_managers):
+        location = _sm_location(sm_index, sm)
+        try:
+            start = parse_index(sm.address)
+        except ValueError:
+            report(location, f"invalid address {sm.address!r}")
+            continue
+        size = (bits.get(sm_index, 0) + 7) // 8
+        if sm.default_size is not None:
+            if size > sm.default_size:
+                report(location, f"{size} bytes of PDOs mapped, its size is {sm.default_size} bytes")
+            size = max(size, sm.default_size)
+        # buffered sync managers use three buffers of their size
+        length = size if sm.sm_type == SyncManagerType.MAILBOX else 3 * size
+        intervals.append((start, start + length, location))
+        if start < PROCESS_RAM_START:
+            report(location, f"address #x{start:04X} is below the process RAM (#x{PROCESS_RAM_START:04X})")
+        if lan9252 and start + length > LAN9252_PROCESS_RAM_END:
+            report(location, f"ends at #x{start + length:04X}, after the LAN9252 process RAM (#x{LAN9252_PROCESS_RAM_END:04X})")
+
+    intervals.sort()
+    end, previous = None, None
+    for start, stop, location in intervals:
+        if end is not None and start < end and stop > start:
+            report(location, f"#x{start:04X}-#x{stop - 1:04X} overlaps {previous}")
+        if end is None or stop > end:
+            end, previous = stop, location
+
+    return violations
+
+
+def validate_esi(esi):
+    """
+    validate_esi: Check all the devices of an ESI, see validate_device
+
+    Devices must also have distinct (product code, revision number).
+
+    esi: The ESI
+
+    return: The list of Violation, empty if the ESI is valid
+    """
+    violations = []
+    identities = {}
+    for device in esi.devices:
+        identity = (device.product_code, device.revision_no)
+        if identity in identities:
+            violations.append(Violation(device.name, "Type", f"product code {device.product_code} revision "
+                                                             f"{device.revision_no} already used by {identities[identity]}"))
+        else:
+            identities[identity] = device.name
+        violations += validate_device(device, esi.lan9252)
+    return violations
+
+
+def check_esi(esi):
+    """
+    check_esi: Raise if an ESI has violations, see validate_esi
+
+    esi: The ESI
+
+    raise: ValidationError with all the violations
+    """
+    violations = validate_esi(esi)
+    if violations:
+        raise ValidationError(violations)
+
+
+def main(argv=None):
+    """
+    main: Entry point of python -m pyesi.validator
+
+    argv: The command line arguments (defaults to sys.argv)
+
+    return: The exit code, 1 if any file has violations
+    """
+    from pyesi.loader import load_esi
+    from pyesi.reader import read_esi
+
+    parser = argparse.ArgumentParser(prog="python -m pyesi.validator", description="Check ESI specs and files.")
+    parser.add_argument("files", nargs="+", help="YAML/JSON specs or ESI XML files")
+    args = parser.parse_args(argv)
+
+    status = 0
+    for filename in args.files:
+        esi = read_esi(filename) if filename.lower().endswith(".xml") else load_esi(filename)
+        for violation in validate_esi(esi):
+            print(f"{filename}: {violation}")
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='pyesi',
@@ -7,4 +7,9 @@ setup(
     install_requires=[
         'pyyaml',
     ],
-)
\ No newline at end of file
+    entry_points={
+        'console_scripts': [
+            'pyesi = pyesi.cli:main',
+        ],
+    },
+)
@@ -0,0 +1,307 @@
+"""
+Benchmark and memory-regression suite of the generator
+
+Each workload builds an ESI and runs it through the phases of the
+generator: model build, ESI.to_xml, prettify_xml and write_xml. The wall
+time (best of the repeats) and the tracemalloc peak of every phase are
+recorded, and can be saved as a JSON baseline or compared to one:
+
+    python test/benchmarks.py --save test/benchmark_baseline.json
+    python test/benchmarks.py --compare test/benchmark_baseline.json
+
+The comparison exits with status 1 when a phase got slower or uses more
+memory than the baseline beyond the thresholds. The baseline records the
+time of a fixed calibration loop, and the baseline times are scaled by the
+speed of the current machine, so a baseline recorded on one machine can be
+compared on another (CI runs the SMOKE workloads against
+test/benchmark_baseline.json).
+
+--cache measures ESI.to_xml and prettify_xml with a DeviceCache, when
+every device misses and when every device hits.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "examples"))
+
+from pyesi.cache import DeviceCache
+from pyesi.generator import (ESI, Device, PDOs, EntryType, SyncManager, SyncManagerType, SyncManagerDir, prettify_xml,
+                             write_xml)
+
+PHASES = ("build", "to_xml", "prettify_xml", "write_xml")
+
+# Phases faster than this are not compared on time, their timing is noise
+MIN_TIME = 0.002
+# Memory peak increases below this many bytes are not regressions
+MIN_PEAK = 16384
+# Workloads of the CI regression check, a few seconds in total
+SMOKE = ("orbita3d", "devices_100", "entries_1000", "mailbox_sdofoe")
+
+
+def synthetic_esi(devices=1, entries=8, sdos=False, foe=False):
+    """
+    synthetic_esi: Build an ESI of identical devices
+
+    devices: Number of devices
+    entries: Number of entries of each RxPdo and TxPdo
+    sdos: Enable the SDOs of the devices
+    foe: Enable the FoE of the devices
+
+    return: The ESI
+    """
+    esi = ESI()
+    esi.vendor_id = "#xF3F"
+    esi.vendor_name = "Pollen Robotics SAS"
+    for i in range(devices):
+        device = Device()
+        device.name = f"Device{i}"
+        device.product_code = f"#x{i + 1:X}"
+        device.sync_managers = [
+            SyncManager("MBoxOut", 1000, SyncManagerType.MAILBOX, SyncManagerDir.Rx, 128),
+            SyncManager("MBoxIn", 1180, SyncManagerType.MAILBOX, SyncManagerDir.Tx, 128),
+            SyncManager("Outputs", 1300, SyncManagerType.BUFFERED, SyncManagerDir.Rx),
+            SyncManager("Inputs", 1400, SyncManagerType.BUFFERED, SyncManagerDir.Tx),
+        ]
+        for pdos_list, name, sm_index, index in ((device.RxPdos, "Outputs", 2, "7000"), (device.TxPdos, "Inputs", 3, "6000")):
+            pdos = PDOs(compact=True)
+            pdos.name = name
+            pdos.sm_index = sm_index
+            pdos.add_entry("status", EntryType.UINT16, index)
+            if entries > 1:
+                pdos.add_array("value", EntryType.REAL, f"{int(index, 16) + 1:X}", entries - 1)
+            pdos_list.append(pdos)
+        device.enable_sdos = sdos
+        device.enable_foe = foe
+        esi.devices.append(device)
+    return esi
+
+
+def orbita_esi():
+    """
+    orbita_esi: Build the ESI of examples/orbita.py (3 axes)
+    """
+    from orbita import build_orbita
+    return build_orbita("", 3)
+
+
+def _workloads():
+    workloads = {"orbita3d": orbita_esi}
+    for devices in (1, 10, 100, 1000, 10000):
+        workloads[f"devices_{devices}"] = lambda devices=devices: synthetic_esi(devices=devices)
+    for entries in (1, 10, 100, 1000, 5000):
+        workloads[f"entries_{entries}"] = lambda entries=entries: synthetic_esi(entries=entries)
+    for sdos, foe in ((True, False), (False, True), (True, True)):
+        name = f"mailbox_{'sdo' if sdos else ''}{'foe' if foe else ''}"
+        workloads[name] = lambda sdos=sdos, foe=foe: synthetic_esi(devices=100, entries=16, sdos=sdos, foe=foe)
+    return workloads
+
+
+WORKLOADS = _workloads()
+
+
+def _phases(factory, directory):
+    """
+    _phases: Run the phases of a workload once
+
+    factory: Function building the ESI of the workload
+    directory: Directory of the written file
+
+    return: Generator of (phase, function), each function using the result of
+            the previous one
+    """
+    filename = os.path.join(directory, "benchmark.xml")
+
+    def write(tree):
+        # write_xml skips unchanged files, always measure a full write
+        if os.path.exists(filename):
+            os.remove(filename)
+        write_xml(tree, filename)
+
+    state = {}
+    yield "build", lambda: state.update(esi=factory())
+    yield "to_xml", lambda: state.update(tree=state["esi"].to_xml())
+    yield "prettify_xml", lambda: prettify_xml(state["tree"])
+    yield "write_xml", lambda: write(state["tree"])
+
+
+def run_workload(factory, repeat=3):
+    """
+    run_workload: Measure the phases of a workload
+
+    The times are the best of the repeats, run without tracemalloc; the
+    memory peaks are measured on one extra run with tracemalloc.
+
+    factory: Function building the ESI of the workload
+    repeat: Number of timed runs
+
+    return: Dictionary of {"time": seconds, "peak": bytes} by phase
+    """
+    results = {phase: {"time": float("inf"), "peak": 0} for phase in PHASES}
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(repeat):
+            for phase, function in _phases(factory, directory):
+                gc.collect()
+                start = time.perf_counter()
+                function()
+                results[phase]["time"] = min(results[phase]["time"], time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            for phase, function in _phases(factory, directory):
+                gc.collect()
+                tracemalloc.reset_peak()
+                baseline, _ = tracemalloc.get_traced_memory()
+                function()
+                results[phase]["peak"] = tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            tracemalloc.stop()
+    return results
+
+
+def measure_cache(factory, repeat=3):
+    """
+    measure_cache: Measure the generation of a workload through a DeviceCache
+
+    factory: Function building the ESI of the workload
+    repeat: Number of timed runs
+
+    return: Dictionary of the best to_xml + prettify_xml time in seconds,
+            with an empty cache ("miss") and a filled one ("hit")
+    """
+    esi = factory()
+    results = {"miss": float("inf"), "hit": float("inf")}
+    for _ in range(repeat):
+        cache = DeviceCache(maxsize=len(esi.devices))
+        for case in ("miss", "hit"):
+            gc.collect()
+            start = time.perf_counter()
+            prettify_xml(esi.to_xml(cache=cache))
+            results[case] = min(results[case], time.perf_counter() - start)
+    return results
+
+
+def calibrate(repeat=20):
+    """
+    calibrate: Measure the speed of the machine
+
+    A fixed loop of the kind of work the generator does (formatting,
+    building elements, joining strings) gives a reference time.
+
+    repeat: Number of timed runs
+
+    return: The best time of the loop in seconds
+    """
+    import xml.etree.ElementTree as ET
+
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        root = ET.Element("Root")
+        for i in range(2000):
+            ET.SubElement(root, "Entry", Index=f"#x{i:04X}").text = f"{i * 0.5}"
+        "".join(f"<{node.tag} {node.attrib}>{node.text}\n" for node in root)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_suite(names=None, repeat=3, log=None):
+    """
+    run_suite: Measure the workloads
+
+    names: Names of the workloads to run (None for all)
+    repeat: Number of timed runs of each workload
+    log: Optional function called with a line of text after each workload
+
+    return: Dictionary of the run_workload results by workload name
+    """
+    results = {}
+    for name, factory in WORKLOADS.items():
+        if names is not None and name not in names:
+            continue
+        results[name] = run_workload(factory, repeat)
+        if log is not None:
+            log(f"{name:20}" + "".join(f" {phase} {r['time'] * 1000:9.2f} ms {r['peak'] / 1024:9.0f} KiB"
+                                       for phase, r in results[name].items()))
+    return results
+
+
+def compare(results, baseline, time_threshold=0.25, memory_threshold=0.10, scale=1.0):
+    """
+    compare: Find the regressions of results with respect to a baseline
+
+    results: The results of run_suite
+    baseline: The results of a previous run_suite
+    time_threshold: Relative slowdown tolerated
+    memory_threshold: Relative memory peak increase tolerated
+    scale: Speed of this machine relative to the baseline's (calibration
+           time here / calibration time there), applied to the baseline times
+
+    return: The list of regressions, as text
+    """
+    regressions = []
+    for name, phases in results.items():
+        for phase, result in phases.items():
+            reference = baseline.get(name, {}).get(phase)
+            if reference is None:
+                continue
+            expected = reference["time"] * scale
+            if result["time"] >= MIN_TIME and result["time"] > expected * (1 + time_threshold):
+                regressions.append(f"{name} {phase}: {result['time'] * 1000:.2f} ms, "
+                                   f"baseline {expected * 1000:.2f} ms")
+            if result["peak"] > max(reference["peak"] * (1 + memory_threshold), reference["peak"] + MIN_PEAK):
+                regressions.append(f"{name} {phase}: peak {result['peak']} bytes, baseline {reference['peak']} bytes")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ESI generator.")
+    parser.add_argument("workloads", nargs="*", help=f"workloads to run (default: all of {', '.join(WORKLOADS)})")
+    parser.add_argument("--smoke", action="store_true", help=f"run the CI workloads ({', '.join(SMOKE)})")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of each workload")
+    parser.add_argument("--save", metavar="JSON", help="save the results as a baseline")
+    parser.add_argument("--cache", action="store_true", help="measure the device cache hits and misses instead")
+    parser.add_argument("--compare", metavar="JSON", help="compare the results to a baseline")
+    parser.add_argument("--time-threshold", type=float, default=0.25, help="relative slowdown tolerated (default 0.25)")
+    parser.add_argument("--memory-threshold", type=float, default=0.10, help="relative memory increase tolerated (default 0.10)")
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.workloads if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(unknown)}")
+    if args.cache:
+        for name in args.workloads or ["orbita3d", "devices_100", "mailbox_sdofoe"]:
+            results = measure_cache(WORKLOADS[name], args.repeat)
+            print(f"{name:20} miss {results['miss'] * 1000:9.2f} ms hit {results['hit'] * 1000:9.2f} ms")
+        return 0
+    if args.smoke:
+        args.workloads = list(SMOKE)
+    results = run_suite(args.workloads or None, args.repeat, log=print)
+    calibration = calibrate()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(dict(results, calibration=calibration), f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        scale = calibration / baseline["calibration"] if "calibration" in baseline else 1.0
+        print(f"machine speed: {scale:.2f}x the baseline's time")
+        regressions = compare(results, baseline, args.time_threshold, args.memory_threshold, scale)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
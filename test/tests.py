@@ -3,8 +3,39 @@ import xml.etree.ElementTree as ET
 from xml.dom import minidom
 import yaml
 import os
+import io
+import sys
+import tempfile
+import contextlib
+import shutil
+import warnings
+import subprocess
+import struct
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from pyesi.generator import *
+from pyesi.generator import _sync_manager_fragment
+from pyesi.cache import DeviceCache, device_key, file_digest
+from pyesi.loader import load_spec, load_esi, esi_from_spec
+from pyesi.reader import read_esi, iter_devices, ESIReader
+from pyesi.layout import DeviceLayout, np
+from pyesi.cheader import generate_c_header, c_identifier
+from pyesi.optimizer import optimize_pdos, optimize_device, size_report, total_size, pdo_set_sizes
+from pyesi.cli import load_manifest, build_fleet, main
+from pyesi.sii import crc8, sii_image, sii_images
+from pyesi.stats import instrument, phase, enabled
+from pyesi.interning import Interner, intern_esi
+from pyesi.service import ESIService, ServiceError, generate_esi, request_esi, iter_remote_esi
+from pyesi.validator import validate_esi, check_esi, ValidationError
+from pyesi.allocator import IndexRange, ObjectAllocator
+from pyesi.diff import esi_tree, diff_esi, diff_trees
+from pyesi.simulator import Histogram, VirtualBus, LocalMaster, SocketMaster, SocketServer, run_cycles
+from pyesi.timing import bus_timing, apply_timing, frame_sizes
+from pyesi.catalog import Catalog, compile_catalog
+from pyesi.mailbox import plan_mailboxes, apply_mailbox_plan, foe_round_trips, sdo_round_trips, main as mailbox_main
+import benchmarks
 
 class TestEntryType(unittest.TestCase):
     def test_bitlen(self):
@@ -18,7 +49,73 @@ class TestEntry(unittest.TestCase):
         self.assertEqual(entry.name, "TestEntry")
         self.assertEqual(entry.type, EntryType.UINT8)
 
+class TestPDOs(unittest.TestCase):
+    def build_pdos(self, compact):
+        pdos = PDOs(compact=compact)
+        pdos.add_entry("controlword", EntryType.UINT16, "0x6041")
+        pdos.add_array("target_position", EntryType.REAL, "0x607A", 3)
+        pdos.entries.append(Entry(name="no_index", type=EntryType.UINT8))
+        return pdos
+
+    def test_add_array(self):
+        pdos = self.build_pdos(compact=False)
+        self.assertEqual([e.sub_index for e in pdos.entries], [0, 1, 2, 3, 0])
+        self.assertEqual(pdos.entries[2].index, "0x607A")
+
+    def test_compact_entries(self):
+        entries = self.build_pdos(compact=True).entries
+        self.assertIsInstance(entries, EntryArray)
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(entries[3].name, "target_position")
+        self.assertEqual(entries[3].type, EntryType.REAL)
+        self.assertEqual(entries[3].sub_index, 3)
+        self.assertIsNone(entries[4].index)
+        del entries[0]
+        self.assertEqual([e.sub_index for e in entries], [1, 2, 3, 0])
+        self.assertEqual(list(entries.bitlens), [32, 32, 32, 8])
+
+    def test_compact_entries_xml(self):
+        xml = []
+        for compact in (False, True):
+            esi = ESI()
+            device = Device()
+            device.RxPdos.append(self.build_pdos(compact))
+            esi.devices.append(device)
+            xml.append(prettify_xml(esi.to_xml()))
+        self.assertEqual(xml[0], xml[1])
+
 class TestESI(unittest.TestCase):
+    @staticmethod
+    def build_esi():
+        esi = ESI()
+        esi.vendor_id = "#xF3F"
+        esi.vendor_name = "Pollen Robotics SAS"
+        device = Device()
+        device.name = "MyDevice"
+        device.sync_managers = [
+            SyncManager("MBoxOut", 1000, SyncManagerType.MAILBOX, SyncManagerDir.Rx, 128),
+            SyncManager("MBoxIn", 1180, SyncManagerType.MAILBOX, SyncManagerDir.Tx, 128),
+            SyncManager("MyPDOIn", 1300, SyncManagerType.BUFFERED, SyncManagerDir.Rx),
+            SyncManager("MyPDOOut", 1400, SyncManagerType.BUFFERED, SyncManagerDir.Tx),
+        ]
+        pdos = PDOs()
+        pdos.name = "MyOutputPDO"
+        pdos.sm_index = 2
+        pdos.add_entry("controlword", EntryType.UINT16, "6041")
+        pdos.add_array("target_position", EntryType.REAL, "607A", 2)
+        pdos.entries.append(Entry(name="MyOutput", type=EntryType.UINT32))
+        device.RxPdos.append(pdos)
+        pdos = PDOs()
+        pdos.name = "MyInputPDO"
+        pdos.sm_index = 3
+        pdos.add_entry("statusword", EntryType.UINT16, "6040")
+        pdos.add_entry("mode", EntryType.INT8, "6061")
+        device.TxPdos.append(pdos)
+        device.enable_sdos = True
+        device.enable_foe = True
+        esi.devices.append(device)
+        return esi
+
     def setUp(self):
         self.esi = ESI()
         self.esi.vendor_id = "#xF3F"
@@ -60,11 +157,117 @@ class TestESI(unittest.TestCase):
         self.assertEqual(root.tag, "EtherCATInfo")
         self.assertEqual(root.get("Version"), "1.6")
 
+    def test_to_xml_cache(self):
+        cache = DeviceCache(maxsize=4)
+        expected = prettify_xml(self.esi.to_xml())
+        self.assertEqual(prettify_xml(self.esi.to_xml(cache=cache)), expected)
+        self.assertEqual(prettify_xml(self.esi.to_xml(cache=cache)), expected)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        self.device.enable_foe = True
+        self.device.enable_sdos = True
+        self.assertIn("<FoE/>", prettify_xml(self.esi.to_xml(cache=cache)))
+        self.assertEqual(cache.misses, 2)
+
+    def test_to_xml_disk_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            expected = prettify_xml(self.esi.to_xml(cache=DeviceCache(directory=directory)))
+            cache = DeviceCache(directory=directory)
+            self.assertEqual(prettify_xml(self.esi.to_xml(cache=cache)), expected)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_device_key(self):
+        key = device_key(True, self.device)
+        self.assertEqual(device_key(True, self.device), key)
+        self.device.RxPdos[0].entries[0].type = EntryType.UINT16
+        self.assertNotEqual(device_key(True, self.device), key)
+        self.assertNotEqual(device_key(False, self.device), device_key(True, self.device))
+        key = device_key(True, self.device)
+        self.device.product_code = f"#x{self.device.product_code}"
+        self.assertNotEqual(device_key(True, self.device), key)
+
     def test_prettify_xml(self):
         tree = self.esi.to_xml()
         pretty_xml = prettify_xml(tree)
         self.assertIn("<EtherCATInfo", pretty_xml)
 
+    def test_prettify_xml_matches_minidom(self):
+        tree = self.esi.to_xml()
+        raw_xml = ET.tostring(tree.getroot(), 'utf-8')
+        expected = minidom.parseString(raw_xml).toprettyxml(indent="  ")
+        self.assertEqual(prettify_xml(tree), expected)
+
+    def test_constant_fragments(self):
+        self.esi.devices.append(self.device)
+        vendor = self.esi.create_vendor()
+        self.assertIsNot(vendor, self.esi.create_vendor())
+        # editing a returned element leaves the shared fragments untouched
+        vendor.find("Name").text = "Edited"
+        self.esi.generate_ln9252_config().append(ET.Element("Extra"))
+        self.assertEqual(self.esi.create_vendor().find("Name").text, "Pollen Robotics SAS")
+        self.assertIsNone(self.esi.generate_ln9252_config().find("Extra"))
+        self.esi.vendor_name = "Other Vendor"
+        self.assertEqual(self.esi.create_vendor().find("Name").text, "Other Vendor")
+
+        tree = self.esi.to_xml()
+        raw_xml = ET.tostring(tree.getroot(), 'utf-8')
+        expected = minidom.parseString(raw_xml).toprettyxml(indent="  ")
+        self.assertEqual(prettify_xml(tree), expected)
+        self.assertNotIn("Edited", prettify_xml(tree))
+        self.assertIn((4, "  "), _sync_manager_fragment(DC_CYCLE_TIME, DC_SHIFT_TIME).rendered)
+
+    def test_edit_to_xml(self):
+        self.esi.devices.append(self.device)
+        tree = self.esi.to_xml()
+        tree.getroot().find("Vendor/Name").text = "Edited"
+        tree.getroot().find("Descriptions/Devices/Device/Eeprom/ByteSize").text = "9"
+        pretty_xml = prettify_xml(tree)
+        self.assertIn("<Name>Edited</Name>", pretty_xml)
+        self.assertIn("<ByteSize>9</ByteSize>", pretty_xml)
+        self.assertNotIn("Edited", prettify_xml(ESI().to_xml()))
+        self.assertEqual(self.esi.generate_ln9252_config().find("ByteSize").text, "4096")
+
+    def test_edit_cached_device(self):
+        self.esi.devices.append(self.device)
+        cache = DeviceCache(maxsize=4)
+        expected = prettify_xml(self.esi.to_xml(cache=cache))
+        tree = self.esi.to_xml(cache=cache)
+        tree.getroot().find("Descriptions/Devices/Device/Name").text = "Edited"
+        self.assertIn("<Name LcId=\"1033\">Edited</Name>", prettify_xml(tree))
+        self.assertEqual(prettify_xml(self.esi.to_xml(cache=cache)), expected)
+
+    def test_prettify_xml_mixed_content(self):
+        root = ET.Element("Root", Attr='a "quoted" <value> & more')
+        root.text = "text & <markup>"
+        child = ET.SubElement(root, "Child")
+        child.tail = "tail"
+        root.append(ET.Comment(" comment "))
+        ET.SubElement(ET.SubElement(root, "Parent"), "Leaf").text = "leaf"
+        tree = ET.ElementTree(root)
+        raw_xml = ET.tostring(root, 'utf-8')
+        expected = minidom.parseString(raw_xml).toprettyxml(indent="  ")
+        self.assertEqual(prettify_xml(tree), expected)
+
+    def test_prettify_xml_line_endings(self):
+        root = ET.Element("Root")
+        root.append(ET.Comment(" first\r\nsecond\rthird "))
+        ET.SubElement(root, "Child").text = "a\r\nb"
+        tree = ET.ElementTree(root)
+        raw_xml = ET.tostring(root, 'utf-8')
+        expected = minidom.parseString(raw_xml).toprettyxml(indent="  ")
+        self.assertEqual(prettify_xml(tree), expected)
+
+    def test_prettify_xml_tree_type(self):
+        self.assertEqual("".join(iter_pretty_xml(self.esi.to_xml().getroot())), prettify_xml(self.esi.to_xml()))
+        with self.assertRaises(TypeError):
+            "".join(iter_pretty_xml("<EtherCATInfo/>"))
+
+    def test_write_xml_file_object(self):
+        tree = self.esi.to_xml()
+        with io.StringIO() as f:
+            write_xml(tree, f)
+            self.assertEqual(f.getvalue(), prettify_xml(tree))
+
     def test_write_xml(self):
         tree = self.esi.to_xml()
         write_xml(tree, "test.xml")
@@ -72,4 +275,1125 @@ class TestESI(unittest.TestCase):
             content = f.read()
             self.assertIn("<EtherCATInfo", content)
         # delete the file
-        os.remove("test.xml")
\ No newline at end of file
+        os.remove("test.xml")
+
+FLEET_BUILDER = """
+from pyesi.generator import *
+
+def build(name, entries):
+    esi = ESI()
+    device = Device()
+    device.name = name
+    pdos = PDOs()
+    pdos.name = "In"
+    pdos.entries = [Entry(name=f"in{i}", type=EntryType.UINT16) for i in range(entries)]
+    device.RxPdos.append(pdos)
+    esi.devices.append(device)
+    return esi
+"""
+
+FLEET_MANIFEST = """
+builder: fleet_builder:build
+output_dir: out
+variants:
+  - output: "{name}_{entries}.xml"
+    matrix:
+      name: [A, B]
+      entries: [1, 2, 3]
+"""
+
+class TestWriteIfChanged(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "device.xml")
+        self.tree = TestESI.build_esi().to_xml()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_skip_unchanged(self):
+        self.assertTrue(write_xml(self.tree, self.filename))
+        os.utime(self.filename, (0, 0))
+        self.assertFalse(write_xml(self.tree, self.filename))
+        self.assertEqual(os.path.getmtime(self.filename), 0)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["device.xml"])
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), prettify_xml(self.tree))
+
+    def test_replace_changed(self):
+        with open(self.filename, "w") as f:
+            f.write("old")
+        os.chmod(self.filename, 0o640)
+        self.assertTrue(write_xml(self.tree, self.filename))
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o640)
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), prettify_xml(self.tree))
+
+    def test_sidecar(self):
+        self.assertTrue(write_xml(self.tree, self.filename, sidecar=True))
+        with open(self.filename + ".sha256") as f:
+            self.assertEqual(f.read().split()[0], file_digest(self.filename))
+        self.assertFalse(write_xml(self.tree, self.filename, sidecar=True))
+        # a file edited after its sidecar was written is hashed again
+        with open(self.filename, "a") as f:
+            f.write(" ")
+        os.utime(self.filename, (os.path.getmtime(self.filename + ".sha256") + 10,) * 2)
+        self.assertTrue(write_xml(self.tree, self.filename, sidecar=True))
+
+class TestFleetCli(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, "fleet_builder.py"), "w") as f:
+            f.write(FLEET_BUILDER)
+        self.manifest = os.path.join(self.tmpdir.name, "fleet.yaml")
+        with open(self.manifest, "w") as f:
+            f.write(FLEET_MANIFEST)
+
+    def tearDown(self):
+        sys.modules.pop("fleet_builder", None)
+        if self.tmpdir.name in sys.path:
+            sys.path.remove(self.tmpdir.name)
+        self.tmpdir.cleanup()
+
+    def test_load_manifest_matrix(self):
+        variants = load_manifest(self.manifest)
+        names = [os.path.basename(v["output"]) for v in variants]
+        self.assertEqual(names, ["A_1.xml", "A_2.xml", "A_3.xml", "B_1.xml", "B_2.xml", "B_3.xml"])
+        self.assertEqual(variants[4]["args"], {"name": "B", "entries": 2})
+
+    def test_build_fleet_parallel_order(self):
+        variants = load_manifest(self.manifest)
+        results = build_fleet(variants, jobs=2, search_paths=[self.tmpdir.name])
+        self.assertEqual([r[0] for r in results], [v["output"] for v in variants])
+        with open(variants[5]["output"]) as f:
+            self.assertEqual(f.read().count("<Entry>"), 3)
+
+    def test_main(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(main([self.manifest, "-j", "1"]), 0)
+        self.assertIn("6 ESI files generated", out.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, "out", "B_3.xml")))
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            main([self.manifest, "-j", "1"])
+        self.assertIn("(6 unchanged)", out.getvalue())
+
+class TestDeviceCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = DeviceCache(maxsize=2)
+        cache.put("a", b"<a/>")
+        cache.put("b", b"<b/>")
+        cache.get("a")
+        cache.put("c", b"<c/>")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"<a/>")
+
+
+SPEC_SYNC_MANAGERS = """
+- {name: MyPDOIn, address: 1000, type: BUFFERED, dir: Rx}
+- {name: MyPDOOut, address: 1200, type: BUFFERED, dir: Tx}
+"""
+
+SPEC_ESI = """
+vendor_id: "#xF3F"
+vendor_name: Pollen Robotics SAS
+devices:
+  - name: MyDevice
+    sync_managers: !include sync_managers.yaml
+    RxPdos:
+      - name: MyOutputPDO
+        sm_index: 0
+        entries:
+          - {name: MyOutput, type: UINT32}
+    TxPdos:
+      - name: MyInputPDO
+        sm_index: 1
+        compact: true
+        entries:
+          - {name: MyInput, type: UINT32}
+          - {name: position, type: REAL, index: "0x6064", count: 3}
+"""
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, "sync_managers.yaml"), "w") as f:
+            f.write(SPEC_SYNC_MANAGERS)
+        self.spec = os.path.join(self.tmpdir.name, "esi.yaml")
+        with open(self.spec, "w") as f:
+            f.write(SPEC_ESI)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_load_esi(self):
+        esi = load_esi(self.spec)
+        self.assertEqual(esi.vendor_id, "#xF3F")
+        device = esi.devices[0]
+        self.assertEqual([sm.control_byte for sm in device.sync_managers], ["#x64", "#x20"])
+        entries = device.TxPdos[0].entries
+        self.assertIsInstance(entries, EntryArray)
+        self.assertEqual([e.sub_index for e in entries], [0, 1, 2, 3])
+        self.assertEqual(device.RxPdos[0].entries[0].type, EntryType.UINT32)
+
+    def test_compiled_spec_cache(self):
+        cache_dir = os.path.join(self.tmpdir.name, "cache")
+        spec = load_spec(self.spec, cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(load_spec(self.spec, cache_dir), spec)
+
+        # changing an included file invalidates the compiled spec
+        with open(os.path.join(self.tmpdir.name, "sync_managers.yaml"), "w") as f:
+            f.write(SPEC_SYNC_MANAGERS.replace("1200", "1400"))
+        spec = load_spec(self.spec, cache_dir)
+        self.assertEqual(spec["devices"][0]["sync_managers"][1]["address"], 1400)
+
+    def test_unknown_keys(self):
+        with self.assertRaises(ValueError):
+            esi_from_spec({"devices": [{"name": "MyDevice", "enable_sdo": True}]})
+
+    def test_identity(self):
+        esi = esi_from_spec({"devices": [{"name": "A", "product_code": 0x3F03052, "revision_no": "#x100000"},
+                                         {"name": "B", "product_code": 0x3F03053}]})
+        self.assertEqual([(device.product_code, device.revision_no) for device in esi.devices],
+                         [("#x3F03052", "#x100000"), ("#x3F03053", "#x1")])
+        self.assertEqual(validate_esi(esi), [])
+
+
+    def test_pdo_index_and_padding(self):
+        spec = yaml.safe_load("""
+name: MyInputPDO
+index: 0x1A02
+entries:
+  - {name: flag, type: BOOL, index: 0x6000, sub_index: 1}
+  - {padding: 7}
+  - {name: value, type: UINT16, index: "0x6001"}
+""")
+        device = esi_from_spec({"devices": [{"name": "MyDevice", "TxPdos": [spec]}]}).devices[0]
+        tag, pdo, pdo_index, entries = next(device.iter_mapped_pdos())
+        self.assertEqual(pdo_index, "1A02")
+        self.assertEqual([(name, entry_type, index, sub_index, int(bitlen)) for name, entry_type, index, sub_index, bitlen in entries],
+                         [("flag", EntryType.BOOL, "6000", 1, 1), ("", None, "0000", 0, 7), ("value", EntryType.UINT16, "6001", 0, 16)])
+        with self.assertRaises(ValueError):
+            esi_from_spec({"devices": [{"TxPdos": [dict(spec, compact=True)]}]})
+        with self.assertRaises(ValueError):
+            esi_from_spec({"devices": [{"TxPdos": [dict(spec, entries=[{"padding": 7, "name": "gap"}])]}]})
+
+
+VENDOR_ESI = """<?xml version="1.0" encoding="ISO-8859-1"?>
+<EtherCATInfo xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" Version="1.6">
+  <Vendor><Id>#x2</Id><Name>Vendor \xe9</Name></Vendor>
+  <Descriptions>
+    <Groups><Group><Type>IO</Type><Name LcId="1033">IO Terminals</Name></Group></Groups>
+    <Devices>
+      <Device Physics="YY">
+        <Type ProductCode="#x03f03052" RevisionNo="#x00100000">EL1008</Type>
+        <Name LcId="1033">EL1008 8Ch. Dig. Input \xe9</Name>
+        <Sm StartAddress="#x1000" ControlByte="#x00" Enable="1">Inputs</Sm>
+        <TxPdo Fixed="1" Sm="0">
+          <Index>#x1a00</Index><Name>Channel 1</Name>
+          <Entry><Index>#x6000</Index><SubIndex>1</SubIndex><BitLen>1</BitLen><Name>Input</Name><DataType>BOOL</DataType></Entry>
+          <Entry><Index>#x0</Index><BitLen>7</BitLen></Entry>
+          <Entry><Index>#x6010</Index><SubIndex>1</SubIndex><BitLen>16</BitLen><Name>Value</Name><DataType xsi:type="x">INT</DataType></Entry>
+        </TxPdo>
+      </Device>
+      <Device Physics="YY">
+        <Type ProductCode="#x03f03052" RevisionNo="#x00110000">EL1008</Type>
+        <Name LcId="1033">EL1008 rev 11</Name>
+        <Mailbox><CoE/></Mailbox>
+      </Device>
+      <Device/>
+    </Devices>
+  </Descriptions>
+</EtherCATInfo>
+"""
+
+class TestReader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "vendor.xml")
+        with open(self.filename, "w", encoding="iso-8859-1") as f:
+            f.write(VENDOR_ESI)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        esi = TestESI.build_esi()
+        filename = os.path.join(self.tmpdir.name, "mine.xml")
+        write_xml(esi.to_xml(), filename)
+        with open(filename) as f:
+            expected = f.read()
+        self.assertEqual(prettify_xml(read_esi(filename).to_xml()), expected)
+        self.assertEqual(prettify_xml(ESIReader(filename).load().to_xml()), expected)
+
+    def test_read_vendor_file(self):
+        esi = read_esi(self.filename)
+        self.assertEqual(esi.vendor_name, "Vendor \xe9")
+        self.assertEqual(esi.group_name, "IO Terminals")
+        self.assertFalse(esi.lan9252)
+        device = esi.devices[0]
+        self.assertEqual(device.sync_managers[0].sm_type, SyncManagerType.BUFFERED)
+        self.assertEqual(device.sync_managers[0].dir, SyncManagerDir.Tx)
+        entries = device.TxPdos[0].entries
+        self.assertEqual([e.type for e in entries], [EntryType.BOOL, None, EntryType.INT16])
+        self.assertEqual(entries[1].bitlen, 7)
+        self.assertEqual(device.TxPdos[0].index, "1a00")
+        self.assertTrue(esi.devices[1].enable_sdos)
+        self.assertEqual(len(list(iter_devices(self.filename))), 3)
+
+    def test_0x_prefix(self):
+        with open(self.filename, "w", encoding="iso-8859-1") as f:
+            f.write(VENDOR_ESI.replace('StartAddress="#x1000"', 'StartAddress="0x1000"').replace("#x1a00", "0x1a00")
+                    .replace("#x6010", "0x6010"))
+        device = read_esi(self.filename).devices[0]
+        self.assertEqual(device.sync_managers[0].address, "1000")
+        self.assertEqual(device.TxPdos[0].index, "1a00")
+        self.assertEqual(device.TxPdos[0].entries[2].index, "6010")
+
+    def test_lazy_reader(self):
+        reader = ESIReader(self.filename)
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(reader.esi.vendor_id, "#x2")
+        self.assertEqual(reader.get(0x03f03052, 0x00110000).name, "EL1008 rev 11")
+        self.assertEqual(reader.get("#x03f03052").name, "EL1008 8Ch. Dig. Input \xe9")
+        self.assertIsNone(reader.get(0x1234))
+        self.assertEqual(reader[2].name, "Test Device")
+
+
+class TestLayout(unittest.TestCase):
+    def setUp(self):
+        self.device = TestESI.build_esi().devices[0]
+        pdos = PDOs()
+        pdos.name = "Bits"
+        pdos.sm_index = 3
+        pdos.entries = [
+            Entry(name="flag", type=EntryType.BOOL, index="6100", sub_index=1),
+            Entry(name="", type=None, bitlen=7),
+            Entry(name="temperature", type=EntryType.INT16, index="6101"),
+        ]
+        self.device.TxPdos.append(pdos)
+        self.layout = DeviceLayout(self.device)
+
+    def test_offsets(self):
+        rx = self.layout.rx
+        self.assertEqual([e.byte_offset for e in rx.entries], [0, 2, 6, 10])
+        self.assertEqual([e.field for e in rx.entries], ["controlword", "target_position_1", "target_position_2", "MyOutput"])
+        self.assertEqual(rx.size, 14)
+        self.assertEqual(rx.struct.size, 14)
+        tx = self.layout.tx
+        self.assertEqual(tx.size, 6)
+        self.assertEqual(self.layout.sync_managers[3].size, 6)
+        self.assertEqual(tx.entry("temperature").byte_offset, 4)
+        self.assertEqual(tx.fields, ["statusword", "mode", "temperature"])
+
+    def test_pack_unpack(self):
+        buffer = bytearray(self.layout.tx.size)
+        self.layout.tx.pack_into(buffer, statusword=0x1234, mode=-2, temperature=-40)
+        buffer[3] = 0x01
+        values = self.layout.tx.unpack(bytes(buffer))
+        self.assertEqual(values, {"statusword": 0x1234, "mode": -2, "temperature": -40})
+        self.assertEqual(self.layout.tx.read_bit(buffer, "flag"), 1)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_numpy_view(self):
+        buffer = bytearray(self.layout.rx.size * 2)
+        self.layout.rx.pack_into(buffer, self.layout.rx.size, controlword=7, target_position_2=1.5)
+        images = self.layout.rx.view(buffer, count=2)
+        self.assertEqual(images["controlword"][1], 7)
+        self.assertEqual(images["target_position_2"][1], 1.5)
+        self.assertIs(self.layout.rx.view(buffer).dtype, images.dtype)
+
+
+class TestCHeader(unittest.TestCase):
+    def setUp(self):
+        layout_test = TestLayout()
+        layout_test.setUp()
+        self.device = layout_test.device
+
+    def test_c_identifier(self):
+        self.assertEqual(c_identifier("My Device 1"), "My_Device_1")
+        self.assertEqual(c_identifier("1st"), "_1st")
+
+    def test_generate_c_header(self):
+        header = generate_c_header(self.device, prefix="orbita")
+        self.assertIn("} orbita_rxpdo_t;", header)
+        self.assertIn("    float target_position_2; /* 607A:2 REAL (MyOutputPDO) */", header)
+        self.assertIn('static_assert(offsetof(orbita_txpdo_t, temperature) == 4, "orbita_txpdo_t.temperature offset");', header)
+        self.assertIn("#define ORBITA_TXPDO_FLAG_BIT 0", header)
+        self.assertIn("#define ORBITA_RXPDO_SIZE 14", header)
+
+    def test_allocated_index(self):
+        self.device.TxPdos[0].add_entry("counter", EntryType.UINT16)
+        mapped = {entry[0]: entry[2] for _, _, _, entries in self.device.iter_mapped_pdos() for entry in entries}
+        header = generate_c_header(self.device)
+        self.assertIn(f"uint16_t counter; /* {mapped['counter']}:0 UINT16 (MyInputPDO) */", header)
+        self.assertNotIn("auto", header)
+
+    @unittest.skipIf(shutil.which("cc") is None, "no C compiler")
+    def test_c_header_compiles(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "pdo.h"), "w") as f:
+                f.write(generate_c_header(self.device))
+            with open(os.path.join(directory, "main.c"), "w") as f:
+                f.write('#include "pdo.h"\nint main(void) { return sizeof(mydevice_txpdo_t); }\n')
+            subprocess.run(["cc", "-std=c11", "-c", "main.c", "-o", "main.o"], cwd=directory, check=True)
+
+
+class TestOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.device = TestESI.build_esi().devices[0]
+        pdos = PDOs(compact=True)
+        pdos.name = "State"
+        pdos.sm_index = 3
+        pdos.add_entry("error", EntryType.UINT16, "603F")
+        pdos.add_array("temperature", EntryType.REAL, "6500", 2)
+        self.device.TxPdos.append(pdos)
+
+    def test_optimize_pdos(self):
+        pdos = self.device.RxPdos[0]
+        pdos.entries.insert(1, Entry(name="flag", type=EntryType.BOOL, index="6100"))
+        pdos.entries.insert(2, Entry(name="", type=None, bitlen=7))
+        optimize_pdos(pdos)
+        self.assertEqual([(e.name, e.sub_index) for e in pdos.entries],
+                         [("target_position", 1), ("target_position", 2), ("MyOutput", 0), ("controlword", 0), ("flag", 0)])
+
+    def test_optimize_device(self):
+        before = size_report(self.device)
+        self.assertEqual(before[1].misaligned, ["error:0", "temperature:1", "temperature:2"])
+        reports = optimize_device(self.device)
+        self.assertEqual(reports[0].misaligned, [])
+        self.assertEqual(total_size(reports), total_size(before))
+        self.assertIsInstance(self.device.TxPdos[1].entries, EntryArray)
+
+        reports = optimize_device(self.device, pad=True)
+        self.assertEqual([r.misaligned for r in reports], [[], []])
+        self.assertEqual(reports[1].size, 4 + 10)
+
+    def test_overflow_warning(self):
+        self.device.sync_managers[3].default_size = 4
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            reports = size_report(self.device)
+        self.assertTrue(reports[1].overflow)
+        self.assertEqual(len(caught), 1)
+
+class TestSII(unittest.TestCase):
+    @staticmethod
+    def categories(image):
+        categories = {}
+        offset = 0x80
+        while True:
+            category_type, = struct.unpack_from("<H", image, offset)
+            if category_type == 0xFFFF:
+                return categories
+            words, = struct.unpack_from("<H", image, offset + 2)
+            categories[category_type] = image[offset + 4:offset + 4 + words * 2]
+            offset += 4 + words * 2
+
+    def setUp(self):
+        self.esi = TestESI.build_esi()
+        self.device = self.esi.devices[0]
+
+    def test_crc8(self):
+        data = bytes.fromhex("8003006EFF00FF00000000000000")
+        self.assertEqual(crc8(b""), 0xFF)
+        self.assertEqual(crc8(data + bytes([crc8(data)])), 0)
+
+    def test_header(self):
+        image = sii_image(self.esi, self.device, alias=7, serial=0x1234)
+        self.assertEqual(image[0:10], bytes.fromhex("8003006EFF00FF000700"))
+        self.assertEqual(image[14], crc8(image[0:14]))
+        self.assertEqual(struct.unpack_from("<IIII", image, 0x10), (0xF3F, 1, 1, 0x1234))
+        self.assertEqual(struct.unpack_from("<HHHHH", image, 0x30), (0x1000, 128, 0x1180, 128, 0x0C))
+        self.assertEqual(struct.unpack_from("<HH", image, 0x7C), (31, 1))
+
+    def test_coe_details(self):
+        def coe_details():
+            return self.categories(sii_image(self.esi, self.device))[30][5]
+
+        self.device.enable_sdos = False
+        self.assertEqual(coe_details(), 0x00)
+        self.device.enable_sdos = True
+        self.assertEqual(coe_details(), 0x03)
+        self.device.sdo_info = False
+        self.assertEqual(coe_details(), 0x01)
+        self.device.complete_access = True
+        self.assertEqual(coe_details(), 0x21)
+        self.device.add_pdo_set("all", [pdo.name for pdo in self.device.RxPdos + self.device.TxPdos])
+        self.assertEqual(coe_details(), 0x25)
+
+    def test_categories(self):
+        categories = self.categories(sii_image(self.esi, self.device))
+        self.assertEqual(sorted(categories), [10, 30, 40, 41, 50, 51])
+        strings = categories[10]
+        self.assertEqual(strings[1:1 + 1 + strings[1]][1:], b"SSC_Device")
+        self.assertEqual(len(categories[41]), 4 * 8)
+        sm = struct.unpack_from("<HHBBBB", categories[41], 16)
+        self.assertEqual(sm, (0x1300, 14, 0x64, 0, 1, 3))
+        rxpdo = categories[51]
+        self.assertEqual(struct.unpack_from("<HBB", rxpdo), (0x1600, 4, 2))
+        self.assertEqual(struct.unpack_from("<HBBBBH", rxpdo, 8 + 8), (0x607A, 1, 5, 8, 32, 0))
+        self.assertEqual(len(categories[50]), 8 + 2 * 8)
+
+    def test_bulk_images(self):
+        boards = [(1, 100), (2, 101)]
+        images = list(sii_images(self.esi, self.device, boards, size=2048))
+        for (alias, serial), image in zip(boards, images):
+            self.assertEqual(len(image), 2048)
+            self.assertEqual(image, sii_image(self.esi, self.device, alias, serial, size=2048))
+        differences = [i for i in range(2048) if images[0][i] != images[1][i]]
+        self.assertTrue(all(i in (8, 14, 0x1C) for i in differences))
+        with self.assertRaises(ValueError):
+            sii_image(self.esi, self.device, size=64)
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_workload(self):
+        results = benchmarks.run_workload(lambda: benchmarks.synthetic_esi(devices=2, entries=4, sdos=True), repeat=1)
+        self.assertEqual(list(results), list(benchmarks.PHASES))
+        self.assertTrue(all(r["time"] > 0 and r["peak"] >= 0 for r in results.values()))
+
+    def test_compare(self):
+        baseline = {"w": {"to_xml": {"time": 0.1, "peak": 10 ** 6}, "build": {"time": 0.0001, "peak": 100}}}
+        results = {"w": {"to_xml": {"time": 0.11, "peak": 10 ** 6}, "build": {"time": 0.001, "peak": 200}},
+                   "new": {"to_xml": {"time": 1, "peak": 1}}}
+        self.assertEqual(benchmarks.compare(results, baseline), [])
+        results["w"]["to_xml"] = {"time": 0.2, "peak": 2 * 10 ** 6}
+        self.assertEqual(len(benchmarks.compare(results, baseline)), 2)
+        # on a machine 3 times slower, 0.2 s is not a regression
+        self.assertEqual(len(benchmarks.compare(results, baseline, scale=3)), 1)
+
+    def test_baseline(self):
+        with open(os.path.join(os.path.dirname(benchmarks.__file__), "benchmark_baseline.json")) as f:
+            baseline = json.load(f)
+        self.assertGreater(baseline["calibration"], 0)
+        self.assertTrue(all(name in baseline for name in benchmarks.SMOKE))
+
+    def test_cache(self):
+        results = benchmarks.measure_cache(lambda: benchmarks.synthetic_esi(devices=50, entries=16, sdos=True))
+        self.assertLess(results["hit"], results["miss"])
+
+class TestStats(unittest.TestCase):
+    def test_disabled(self):
+        self.assertFalse(enabled())
+        with phase("to_xml") as stats:
+            self.assertIsNone(stats)
+
+    def test_instrument(self):
+        esi = TestESI.build_esi()
+        finished = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with instrument(memory=True, callback=finished.append) as stats:
+                tree = esi.to_xml()
+                xml = prettify_xml(tree)
+                write_xml(tree, os.path.join(tmpdir, "device.xml"))
+        self.assertFalse(enabled())
+        self.assertEqual([p.name for p in stats.phases], ["device", "to_xml", "prettify_xml", "write_xml"])
+        self.assertEqual(finished, stats.phases)
+        device, to_xml, pretty, write = stats.phases
+        self.assertEqual(device.device, "MyDevice")
+        self.assertEqual(to_xml.elements, sum(1 for _ in tree.getroot().iter()))
+        self.assertLess(device.elements, to_xml.elements)
+        self.assertEqual(pretty.bytes, len(xml))
+        self.assertEqual(write.bytes, len(xml))
+        self.assertTrue(write.info["written"])
+        self.assertGreaterEqual(to_xml.peak_memory, device.peak_memory)
+        self.assertEqual(list(stats.devices()), ["MyDevice"])
+        summary = json.loads(stats.to_json())["summary"]
+        self.assertEqual(summary["device"]["count"], 1)
+        self.assertIn("prettify_xml", str(stats))
+
+class TestInterning(unittest.TestCase):
+    def test_slots(self):
+        devices = [Device(), Device()]
+        devices[0].sync_managers.append(SyncManager("Out", 1000, SyncManagerType.BUFFERED, SyncManagerDir.Rx))
+        self.assertEqual(devices[1].sync_managers, [])
+        self.assertFalse(hasattr(devices[0], "__dict__"))
+        self.assertFalse(hasattr(Entry("a", EntryType.UINT8), "__dict__"))
+        with self.assertRaises(AttributeError):
+            PDOs().address = "1000"
+
+    def test_intern_esi(self):
+        esi = ESI()
+        for i in range(3):
+            device = TestESI.build_esi().devices[0]
+            device.name = f"MyDevice {i}"
+            device.product_code = f"#x{i + 1}"
+            esi.devices.append(device)
+        xml = prettify_xml(esi.to_xml())
+        interner = intern_esi(esi)
+        self.assertEqual(interner.counts(), {"sync_managers": 4, "entries": 6, "pdos": 2})
+        first, second = esi.devices[0], esi.devices[2]
+        self.assertIs(first.sync_managers[3], second.sync_managers[3])
+        self.assertIs(first.RxPdos[0], second.RxPdos[0])
+        self.assertIsNot(first.sync_managers, second.sync_managers)
+        self.assertEqual(prettify_xml(esi.to_xml()), xml)
+
+    def test_mutators_copy_shared(self):
+        esi = ESI()
+        for i in range(2):
+            device = TestESI.build_esi().devices[0]
+            device.product_code = f"#x{i + 1}"
+            device.TxPdos[0].entries.insert(0, Entry(name="flag", type=EntryType.BOOL, index="6100"))
+            esi.devices.append(device)
+        intern_esi(esi)
+        first, second = esi.devices
+        shared_sm, shared_pdos = second.sync_managers[0], second.TxPdos[0]
+        names = [entry.name for entry in shared_pdos.entries]
+        apply_mailbox_plan(first, plan_mailboxes(first))
+        optimize_device(first, pad=True)
+        self.assertNotEqual(first.sync_managers[0].default_size, 128)
+        self.assertEqual(shared_sm.default_size, 128)
+        self.assertNotEqual([entry.name for entry in first.TxPdos[0].entries], names)
+        self.assertEqual([entry.name for entry in shared_pdos.entries], names)
+        self.assertIs(second.TxPdos[0], shared_pdos)
+
+    def test_intern_strings(self):
+        name = "".join(["Sync", "Manager"])
+        sm = Interner().sync_manager(SyncManager(name, 1000, SyncManagerType.BUFFERED, SyncManagerDir.Rx))
+        self.assertIs(sm.name, sys.intern("SyncManager"))
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.spec = yaml.safe_load(SPEC_ESI.replace("!include sync_managers.yaml", "[]"))
+        self.spec["devices"][0]["sync_managers"] = yaml.safe_load(SPEC_SYNC_MANAGERS)
+
+    async def run_service(self, client, **kwargs):
+        service = ESIService(**kwargs)
+        host, port = await service.start()
+        try:
+            return await client(service, host, port)
+        finally:
+            await service.close()
+
+    def test_generate_and_cache(self):
+        async def client(service, host, port):
+            documents = await asyncio.gather(*(request_esi(self.spec, host, port) for _ in range(3)))
+            other = dict(self.spec, vendor_name="Other")
+            documents.append(await request_esi(other, host, port))
+            documents.append(await request_esi(self.spec, host, port))
+            return documents, service.builds
+
+        documents, builds = asyncio.run(self.run_service(client, jobs=2))
+        expected = generate_esi(self.spec)
+        self.assertEqual(documents[:3], [expected] * 3)
+        self.assertEqual(documents[4], expected)
+        self.assertIn(b"<Name>Other</Name>", documents[3])
+        self.assertEqual(builds, 2)
+
+    def test_streamed_chunks(self):
+        self.spec["devices"] *= 200
+
+        async def client(service, host, port):
+            return [chunk async for chunk in iter_remote_esi(self.spec, host, port)]
+
+        chunks = asyncio.run(self.run_service(client, executor=ThreadPoolExecutor(1)))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), generate_esi(self.spec))
+
+    def test_bad_spec(self):
+        async def client(service, host, port):
+            with self.assertRaises(ServiceError) as caught:
+                await request_esi({"devices": [{"colour": "red"}]}, host, port)
+            return caught.exception.status
+
+        self.assertEqual(asyncio.run(self.run_service(client, executor=ThreadPoolExecutor(1))), 400)
+
+    def test_malformed_request(self):
+        async def client(service, host, port):
+            responses = []
+            for request in (b"GARBAGE\r\n\r\n", b"POST /esi HTTP/1.1\r\nContent-Length: many\r\n\r\n"):
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write(request)
+                await writer.drain()
+                responses.append(await reader.readline())
+                writer.close()
+            return responses
+
+        responses = asyncio.run(self.run_service(client, executor=ThreadPoolExecutor(1)))
+        self.assertEqual(responses, [b"HTTP/1.1 400 Bad Request\r\n"] * 2)
+
+
+class TestValidator(unittest.TestCase):
+    def setUp(self):
+        self.esi = TestESI.build_esi()
+        self.device = self.esi.devices[0]
+        self.device.TxPdos[0].index = "1A00"
+
+    def messages(self):
+        return [f"{v.location}: {v.message}" for v in validate_esi(self.esi)]
+
+    def test_valid(self):
+        self.assertEqual(validate_esi(self.esi), [])
+        check_esi(self.esi)
+
+    def test_entries(self):
+        self.device.TxPdos[0].add_entry("status_copy", EntryType.UINT16, "6040")
+        self.device.TxPdos[0].add_entry("errors", EntryType.UINT16, "603F")
+        self.device.TxPdos[0].add_array("errors", EntryType.UINT16, "603F", 2)
+        messages = self.messages()
+        self.assertEqual(len(messages), 2)
+        self.assertIn("#x6040:0 already mapped by TxPdo MyInputPDO entry 0 (statusword)", messages[0])
+        self.assertTrue(messages[1].startswith("TxPdo MyInputPDO entry 3 (errors): #x603F:0 is mapped as a value"))
+
+    def test_pdos_and_sync_managers(self):
+        self.device.RxPdos[0].index = "1600"
+        self.device.TxPdos[0].index = "1600"
+        self.device.TxPdos[0].sm_index = 1
+        self.device.sync_managers[2].default_size = 4
+        self.device.sync_managers[3].address = "11F0"
+        self.device.sync_managers[3].default_size = 2
+        self.assertEqual(self.messages(), [
+            "TxPdo MyInputPDO: mapped to the mailbox Sm[1] MBoxIn",
+            "TxPdo MyInputPDO: index #x1600 outside of the TxPdo range #x1A00-#x1BFF",
+            "TxPdo MyInputPDO: index #x1600 already used by RxPdo MyOutputPDO",
+            "Sm[2] MyPDOIn: 14 bytes of PDOs mapped, its size is 4 bytes",
+            "Sm[3] MyPDOOut: #x11F0-#x11F5 overlaps Sm[1] MBoxIn",
+        ])
+
+    def test_check_esi(self):
+        self.esi.devices.append(self.device)
+        with self.assertRaises(ValidationError) as caught:
+            check_esi(self.esi)
+        self.assertEqual(caught.exception.violations[0].location, "Type")
+
+class TestAllocator(unittest.TestCase):
+    def test_index_range(self):
+        index_range = IndexRange(0x1600, 0x1603)
+        self.assertTrue(index_range.reserve(0x1601))
+        self.assertFalse(index_range.reserve(0x1601))
+        self.assertEqual([index_range.allocate() for _ in range(3)], [0x1600, 0x1602, 0x1603])
+        self.assertEqual(len(index_range), 4)
+        with self.assertRaises(ValueError):
+            index_range.allocate()
+        with self.assertRaises(ValueError):
+            index_range.reserve(0x1700)
+
+    def test_object_allocator(self):
+        allocator = ObjectAllocator()
+        self.assertTrue(allocator.reserve(0x1A00))
+        self.assertFalse(allocator.reserve(0x1A00))
+        # indices outside of the ranges are not tracked
+        self.assertTrue(allocator.reserve(0x6041))
+        self.assertEqual([allocator.allocate("TxPdo"), allocator.allocate("RxPdo"), allocator.allocate("manufacturer")],
+                         [0x1A01, 0x1600, 0x2000])
+
+    def test_malformed_pdo_index(self):
+        esi = TestESI.build_esi()
+        device = esi.devices[0]
+        device.RxPdos[0].index = "16xx"
+        self.assertEqual([index for _, _, index, _ in device.iter_mapped_pdos()], ["16xx", "1A00"])
+        self.assertEqual([str(violation) for violation in validate_esi(esi)],
+                         ["MyDevice: RxPdo MyOutputPDO: invalid index '16xx'"])
+
+    def test_device_indices(self):
+        device = TestESI.build_esi().devices[0]
+        device.TxPdos[0].index = "0x1A00"
+        pdos = PDOs()
+        pdos.name = "Extra"
+        pdos.sm_index = 3
+        pdos.add_entry("explicit", EntryType.UINT8, "2000")
+        pdos.entries.extend(Entry(name=f"auto{i}", type=EntryType.UINT8) for i in range(3000))
+        device.TxPdos.append(pdos)
+        mapped = list(device.iter_mapped_pdos())
+        self.assertEqual([index for _, _, index, _ in mapped], ["1600", "1A00", "1A01"])
+        self.assertEqual(mapped[0][3][3][2], "2001")
+        indices = [entry[2] for _, _, _, entries in mapped for entry in entries if entry[0].startswith(("auto", "explicit", "MyOutput"))]
+        self.assertEqual(len(indices), len(set(indices)))
+        self.assertEqual(indices[:3], ["2001", "2000", "2002"])
+
+
+class TestDictionary(unittest.TestCase):
+    def setUp(self):
+        self.esi = TestESI.build_esi()
+        self.device = self.esi.devices[0]
+
+    def dictionary(self):
+        return self.esi.create_device(self.device).find("Profile/Dictionary")
+
+    def test_objects(self):
+        objects = {obj.findtext("Index"): obj for obj in self.dictionary().iterfind("Objects/Object")}
+        self.assertEqual(list(objects), ["#x1600", "#x1A00", "#x1C12", "#x1C13", "#x2000", "#x6040", "#x6041", "#x6061", "#x607A"])
+        self.assertEqual(objects["#x6041"].findtext("Type"), "UINT16")
+        self.assertEqual(objects["#x6041"].findtext("Flags/PdoMapping"), "R")
+        self.assertEqual(objects["#x6040"].findtext("Flags/Access"), "ro")
+        # the array entries are compacted in one object
+        self.assertEqual(objects["#x607A"].findtext("BitSize"), "80")
+        self.assertEqual([item.findtext("Info/DefaultData") for item in objects["#x607A"].iterfind("Info/SubItem")], ["02", None, None])
+        mapping = [item.findtext("Info/DefaultData") for item in objects["#x1600"].iterfind("Info/SubItem")]
+        self.assertEqual(mapping, ["04", "10004160", "20017A60", "20027A60", "20000020"])
+        self.assertEqual([item.findtext("Info/DefaultData") for item in objects["#x1C13"].iterfind("Info/SubItem")], ["01", "001A"])
+
+    def test_data_types_deduplicated(self):
+        dictionary = self.dictionary()
+        names = [data_type.findtext("Name") for data_type in dictionary.iterfind("DataTypes/DataType")]
+        self.assertEqual(len(names), len(set(names)))
+        types = {obj.findtext("Index"): obj.findtext("Type") for obj in dictionary.iterfind("Objects/Object")}
+        self.assertEqual(types["#x1C12"], types["#x1C13"])
+        defined = set(names)
+        for data_type in dictionary.iterfind("DataTypes/DataType"):
+            for used in data_type.iterfind("SubItem/Type"):
+                self.assertIn(used.text, defined)
+        self.assertTrue(set(types.values()) <= defined)
+
+    def test_disabled(self):
+        self.device.embed_dictionary = False
+        self.assertIsNone(self.dictionary())
+        self.device.embed_dictionary = True
+        self.device.enable_sdos = False
+        self.assertIsNone(self.dictionary())
+
+
+    def test_assignment_per_sync_manager(self):
+        # PDOs on SM0/SM1, and a second output sync manager
+        self.device.sync_managers = [
+            SyncManager("Outputs", 1000, SyncManagerType.BUFFERED, SyncManagerDir.Rx),
+            SyncManager("Inputs", 1100, SyncManagerType.BUFFERED, SyncManagerDir.Tx),
+            SyncManager("MoreOutputs", 1200, SyncManagerType.BUFFERED, SyncManagerDir.Rx),
+        ]
+        self.device.RxPdos[0].sm_index = 0
+        self.device.TxPdos[0].sm_index = 1
+        pdos = PDOs()
+        pdos.name = "Extra"
+        pdos.sm_index = 2
+        pdos.add_entry("extra", EntryType.UINT8, "7000")
+        self.device.RxPdos.append(pdos)
+        objects = {obj.findtext("Index"): obj for obj in self.dictionary().iterfind("Objects/Object")}
+        self.assertNotIn("#x1C13", objects)
+        self.assertEqual(objects["#x1C10"].findtext("Name"), "Sync manager 0 PDO assignment")
+        self.assertEqual([item.findtext("Info/DefaultData") for item in objects["#x1C10"].iterfind("Info/SubItem")], ["01", "0016"])
+        self.assertEqual([item.findtext("Info/DefaultData") for item in objects["#x1C11"].iterfind("Info/SubItem")], ["01", "001A"])
+        self.assertEqual([item.findtext("Info/DefaultData") for item in objects["#x1C12"].iterfind("Info/SubItem")], ["01", "0116"])
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.old = TestESI.build_esi()
+        self.new = TestESI.build_esi()
+
+    def test_identical(self):
+        self.assertEqual(diff_esi(self.old, self.new), [])
+        self.assertEqual(esi_tree(self.old).hash, esi_tree(self.new).hash)
+
+    def test_file_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "esi.xml")
+            write_xml(self.old.to_xml(), filename)
+            self.assertEqual(diff_esi(self.old, read_esi(filename)), [])
+
+    def test_semantic_changes(self):
+        device = self.new.devices[0]
+        device.RxPdos[0].entries[0].type = EntryType.INT16
+        device.TxPdos[0].sm_index = 2
+        device.TxPdos[0].entries.reverse()
+        device.RxPdos[0].entries.pop()
+        changes = [str(change) for change in diff_esi(self.old, self.new)]
+        self.assertEqual(changes, [
+            "ESI / Device MyDevice / RxPdo MyOutputPDO / entry controlword (#x6041:0): type 'UINT16' -> 'INT16'",
+            "ESI / Device MyDevice / RxPdo MyOutputPDO / entry MyOutput (#x2000:0): removed",
+            "ESI / Device MyDevice / TxPdo MyInputPDO: sm_index 3 -> 2",
+            "ESI / Device MyDevice / TxPdo MyInputPDO: reordered",
+        ])
+
+    def test_identical_subtrees_skipped(self):
+        self.new.devices.append(TestESI.build_esi().devices[0])
+        self.new.devices[1].name = "Other"
+        old, new = esi_tree(self.old), esi_tree(self.new)
+        self.assertEqual([str(change) for change in diff_trees(old, new)], ["ESI / Device Other: added"])
+        # the entries of unchanged PDOs are never expanded
+        pdo = new.children["MyDevice"].children[("RxPdo", "MyOutputPDO")]
+        self.assertIsNone(pdo._children)
+
+
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        self.device = TestESI.build_esi().devices[0]
+        self.bus = VirtualBus([self.device] * 3)
+
+    def test_frames(self):
+        layout = DeviceLayout(self.device)
+        self.assertEqual(len(self.bus.outputs), 3 * layout.rx.size)
+        self.assertEqual(len(self.bus.inputs), 3 * layout.tx.size)
+        self.assertEqual([slave.tx_offset for slave in self.bus.slaves], [0, layout.tx.size, 2 * layout.tx.size])
+
+    def test_exchange(self):
+        def update(bus, cycle):
+            for slave in bus.slaves:
+                slave.set_inputs(statusword=slave.outputs()["controlword"] + slave.position, mode=cycle)
+
+        self.bus.update = update
+        master = LocalMaster(self.bus)
+        for slave in self.bus.slaves:
+            slave.layout.rx.pack_into(master.outputs, slave.rx_offset, controlword=0x0F)
+        inputs = master.exchange(7)
+        values = [slave.layout.tx.unpack(inputs, slave.tx_offset) for slave in self.bus.slaves]
+        self.assertEqual([value["statusword"] for value in values], [0x0F, 0x10, 0x11])
+        self.assertEqual({value["mode"] for value in values}, {7})
+        with self.assertRaises(ValueError):
+            self.bus.exchange(b"\0")
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_view(self):
+        view = self.bus.view("tx")
+        view["statusword"] = [1, 2, 3]
+        self.assertEqual(self.bus.slaves[2].layout.tx.unpack(self.bus.inputs, self.bus.slaves[2].tx_offset)["statusword"], 3)
+
+    def test_socket(self):
+        self.bus.update = lambda bus, cycle: bus.slaves[0].set_inputs(mode=cycle % 100)
+        with SocketServer(self.bus) as server:
+            master = SocketMaster(server.address, len(self.bus.outputs), len(self.bus.inputs), timeout=1)
+            try:
+                inputs = master.exchange(42)
+                stats = run_cycles(master, frequency=2000, cycles=20)
+            finally:
+                master.close()
+        self.assertEqual(self.bus.slaves[0].layout.tx.unpack(inputs)["mode"], 42)
+        self.assertEqual(stats.cycles, 20)
+        self.assertEqual(stats.latency.count, 20)
+        self.assertEqual(stats.lost, 0)
+
+    def test_histogram(self):
+        histogram = Histogram(resolution=10, bins=10)
+        for duration in range(100):
+            histogram.record(duration)
+        histogram.record(1000)
+        self.assertEqual(histogram.count, 101)
+        self.assertEqual(histogram.overflow, 1)
+        self.assertEqual(histogram.percentile(50), 60)
+        self.assertEqual(histogram.percentile(100), 1000)
+        self.assertEqual((histogram.min, histogram.max), (0, 1000))
+
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        self.esi = TestESI.build_esi()
+        self.device = self.esi.devices[0]
+
+    def test_frame_sizes(self):
+        # Ethernet overhead, EtherCAT header, DC datagram and LRW datagram
+        self.assertEqual(frame_sizes(170), [38 + 2 + 20 + 12 + 170])
+        self.assertEqual(frame_sizes(0, dc=False), [38 + 46])
+        self.assertEqual(frame_sizes(3000), [1538, 1538, 38 + 2 + 12 + 48])
+
+    def test_bus_timing(self):
+        timing = bus_timing([self.device] * 10)
+        self.assertEqual((timing.output_bytes, timing.input_bytes), (140, 30))
+        self.assertEqual(timing.wire_time, 242 * 80)
+        self.assertEqual(timing.round_trip, 242 * 80 + 10 * 1010)
+        self.assertEqual(timing.sync0_shift, 45000)
+        self.assertEqual(timing.cycle_time, 50000)
+        self.assertEqual(bus_timing([self.device] * 10, processing_time=20000).cycle_time, 65000)
+
+    def test_dc_config(self):
+        apply_timing([self.device], bus_timing([self.device] * 10))
+        dc_sync = self.esi.create_device(self.device).find("Dc/OpMode[Name='DC_Sync']")
+        self.assertEqual(dc_sync.findtext("CycleTimeSync0"), "50000")
+        self.assertEqual(dc_sync.findtext("ShiftTimeSync0"), "45000")
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "esi.xml")
+            write_xml(self.esi.to_xml(), filename)
+            device = read_esi(filename).devices[0]
+        self.assertEqual((device.dc_cycle_time, device.dc_shift_time), (50000, 45000))
+
+
+class TestPdoSets(unittest.TestCase):
+    def setUp(self):
+        self.esi = TestESI.build_esi()
+        self.device = self.esi.devices[0]
+        pdos = PDOs()
+        pdos.name = "Diagnostic"
+        pdos.sm_index = 3
+        pdos.add_array("temperatures", EntryType.REAL, "6500", 4)
+        self.device.TxPdos.append(pdos)
+        self.device.add_pdo_set("position", ["MyOutputPDO", "MyInputPDO"])
+        self.device.add_pdo_set("diagnostic", ["MyOutputPDO", "Diagnostic"])
+
+    def test_device(self):
+        element = self.esi.create_device(self.device)
+        pdos = {pdo.findtext("Name"): pdo for pdo in element.iter() if pdo.tag in ("RxPdo", "TxPdo")}
+        self.assertEqual(pdos["MyOutputPDO"].get("Mandatory"), "1")
+        self.assertIsNone(pdos["MyInputPDO"].get("Mandatory"))
+        self.assertEqual([exclude.text for exclude in pdos["MyInputPDO"].iterfind("Exclude")], ["#x1A01"])
+        self.assertEqual([exclude.text for exclude in pdos["Diagnostic"].iterfind("Exclude")], ["#x1A00"])
+        self.assertEqual(pdos["MyOutputPDO"].find("Exclude"), None)
+        self.assertEqual(element.find("Mailbox/CoE").get("PdoAssign"), "true")
+        assignment = element.find("Profile/Dictionary/Objects/Object[Index='#x1C13']")
+        self.assertEqual([item.findtext("Info/DefaultData") for item in assignment.iterfind("Info/SubItem")], ["01", "001A", "0000"])
+        self.assertEqual(assignment.findtext("Flags/Access"), "rw")
+
+    def test_sizes(self):
+        self.assertEqual(pdo_set_sizes(self.device), {"position": (14, 3), "diagnostic": (14, 16)})
+        self.assertEqual(DeviceLayout(self.device, "diagnostic").tx.fields, ["temperatures_1", "temperatures_2", "temperatures_3", "temperatures_4"])
+        self.assertLess(bus_timing([self.device] * 10, pdo_set="position").wire_time,
+                        bus_timing([self.device] * 10, pdo_set="diagnostic").wire_time)
+
+    def test_default_assignment(self):
+        # the first set is the default assignment of the ESI
+        self.assertEqual(DeviceLayout(self.device).tx.fields, ["statusword", "mode"])
+        self.assertEqual(bus_timing([self.device] * 10).wire_time, bus_timing([self.device] * 10, pdo_set="position").wire_time)
+        self.assertEqual(len(DeviceLayout(self.device, all_pdos=True).tx.fields), 6)
+        self.assertNotIn("temperatures", generate_c_header(self.device))
+        syncm = TestSII.categories(sii_image(self.esi, self.device))[41]
+        self.assertEqual(struct.unpack_from("<HH", syncm, 3 * 8), (0x1400, 3))
+
+    def test_read_back(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "esi.xml")
+            write_xml(self.esi.to_xml(), filename)
+            esi = read_esi(filename)
+            self.assertEqual(esi.devices[0].pdo_sets, self.device.pdo_sets)
+            self.assertEqual(diff_esi(self.esi, esi), [])
+            with open(filename) as f:
+                self.assertEqual(prettify_xml(esi.to_xml()), f.read())
+
+            # without the named sets, they are rebuilt from the exclusions
+            tree = ET.parse(filename)
+            device = tree.getroot().find("Descriptions/Devices/Device")
+            device.remove(device.find("VendorSpecific"))
+            tree.write(filename)
+            self.assertEqual(read_esi(filename).devices[0].pdo_sets,
+                             {"set 1": ["MyOutputPDO", "MyInputPDO"], "set 2": ["MyOutputPDO", "Diagnostic"]})
+
+    def test_sii_flags(self):
+        flags = {}
+        for category in (50, 51):
+            data = TestSII.categories(sii_image(self.esi, self.device))[category]
+            offset = 0
+            while offset < len(data):
+                index, entries = struct.unpack_from("<HB", data, offset)
+                flags[index] = struct.unpack_from("<H", data, offset + 6)[0]
+                offset += 8 + 8 * entries
+        self.assertEqual(flags, {0x1600: 0x0011, 0x1A00: 0x0010, 0x1A01: 0x0010})
+
+    def test_validation(self):
+        self.device.add_pdo_set("broken", ["Missing"])
+        self.assertEqual([str(violation) for violation in validate_esi(self.esi)], ["MyDevice: PDO set broken: unknown PDO 'Missing'"])
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.catalog = os.path.join(self.tmp, "catalog.bin")
+        self.xml = os.path.join(self.tmp, "esi.xml")
+        write_xml(TestESI.build_esi().to_xml(), self.xml)
+        self.model = TestESI.build_esi()
+        device = self.model.devices[0]
+        device.product_code = "#x2"
+        device.revision_no = "#x10"
+        device.add_pdo_set("all", ["MyOutputPDO", "MyInputPDO"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_lookup(self):
+        compile_catalog([self.xml, self.model], self.catalog)
+        with Catalog(self.catalog) as catalog:
+            self.assertEqual(len(catalog), 2)
+            self.assertEqual(catalog.keys(), [(1, 1, 0xF3F), (2, 0x10, 0xF3F)])
+            device = catalog.get(2, "#x10", vendor_id="#xF3F")
+            self.assertEqual(diff_esi(self.model, self._esi(device)), [])
+            self.assertEqual(catalog.get("#x1").name, "MyDevice")
+            self.assertIsNone(catalog.get(2, 1))
+            self.assertIsNone(catalog.get(2, vendor_id=1))
+            self.assertIsNone(catalog.get(3))
+
+    def _esi(self, device):
+        esi = TestESI.build_esi()
+        esi.devices = [device]
+        return esi
+
+    def test_incremental(self):
+        self.assertEqual(len(compile_catalog([self.xml, self.model], self.catalog)), 2)
+        self.assertEqual(compile_catalog([self.xml, self.model], self.catalog), [])
+        esi = TestESI.build_esi()
+        esi.devices[0].name = "Renamed"
+        write_xml(esi.to_xml(), self.xml)
+        self.assertEqual(compile_catalog([self.xml, self.model], self.catalog), [os.path.abspath(self.xml)])
+        with Catalog(self.catalog) as catalog:
+            self.assertEqual(catalog.get(1).name, "Renamed")
+            self.assertEqual(catalog.get(2).pdo_sets, {"all": ["MyOutputPDO", "MyInputPDO"]})
+
+    def test_negative_shift_time(self):
+        self.model.devices[0].dc_shift_time = -25000
+        compile_catalog([self.model], self.catalog)
+        with Catalog(self.catalog) as catalog:
+            self.assertEqual(catalog.get(2).dc_shift_time, -25000)
+
+    def test_included_file(self):
+        with open(os.path.join(self.tmp, "sync_managers.yaml"), "w") as f:
+            f.write(SPEC_SYNC_MANAGERS)
+        spec = os.path.join(self.tmp, "esi.yaml")
+        with open(spec, "w") as f:
+            f.write(SPEC_ESI.replace("  - name: MyDevice\n", "  - name: MyDevice\n    product_code: 3\n"))
+        self.assertEqual(len(compile_catalog([self.xml, spec], self.catalog)), 2)
+        self.assertEqual(compile_catalog([self.xml, spec], self.catalog), [])
+        with open(os.path.join(self.tmp, "sync_managers.yaml"), "w") as f:
+            f.write(SPEC_SYNC_MANAGERS.replace("1200", "1400"))
+        self.assertEqual(compile_catalog([self.xml, spec], self.catalog), [os.path.abspath(spec)])
+        with Catalog(self.catalog) as catalog:
+            self.assertEqual(catalog.get(3).sync_managers[1].address, "1400")
+
+    def test_duplicate(self):
+        with self.assertRaises(ValueError):
+            compile_catalog([self.xml, self.xml], self.catalog)
+        self.assertFalse(os.path.exists(self.catalog))
+
+    def test_not_a_catalog(self):
+        with self.assertRaises(ValueError):
+            Catalog(self.xml)
+
+
+class TestMailbox(unittest.TestCase):
+    def setUp(self):
+        self.esi = TestESI.build_esi()
+        self.device = self.esi.devices[0]
+
+    def test_coe_options(self):
+        self.device.complete_access = True
+        self.device.segmented_sdo = False
+        coe = self.esi.create_device(self.device).find("Mailbox/CoE")
+        self.assertEqual((coe.get("SdoInfo"), coe.get("SegmentedSdo"), coe.get("CompleteAccess")), ("true", "false", "true"))
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "esi.xml")
+            write_xml(self.esi.to_xml(), filename)
+            device = read_esi(filename).devices[0]
+        self.assertEqual((device.sdo_info, device.segmented_sdo, device.complete_access), (True, False, True))
+
+    def test_plan(self):
+        plan = plan_mailboxes(self.device)
+        self.assertEqual(plan.sizes, {0: 384, 1: 384})
+        self.assertEqual(plan.addresses, {0: 0x1000, 1: 0x1180, 2: 0x1300, 3: 0x1400})
+        with self.assertRaises(ValueError):
+            plan_mailboxes(self.device, size=512)
+
+    def test_relocate(self):
+        plan = plan_mailboxes(self.device, relocate=True, max_size=4096)
+        self.assertEqual(plan.addresses[0], 0x1000)
+        self.assertEqual(plan.addresses[1], 0x1000 + plan.sizes[0])
+        self.assertLess(plan.free, 32)
+        apply_mailbox_plan(self.device, plan)
+        self.assertEqual(self.device.sync_managers[1].default_size, plan.sizes[1])
+        self.assertEqual(validate_esi(self.esi), [])
+        with self.assertRaises(ValueError):
+            plan_mailboxes(self.device, size=2048, relocate=True)
+
+    def test_main_firmware(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "esi.xml")
+            write_xml(self.esi.to_xml(), filename)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(mailbox_main([filename, "--firmware", "1160"]), 0)
+            self.assertIn("12 with 128 bytes mailboxes, 5 with 384 bytes", out.getvalue())
+            self.device.sync_managers[0].default_size = None
+            write_xml(self.esi.to_xml(), filename)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(mailbox_main([filename, "--firmware", "1160"]), 0)
+            self.assertIn("the current mailbox size is not set", out.getvalue())
+
+    def test_round_trips(self):
+        self.assertEqual(foe_round_trips(1160, 128), 12)
+        self.assertEqual(foe_round_trips(1000, 1024), 2)
+        self.assertEqual(sdo_round_trips(4, 128), 1)
+        self.assertEqual(sdo_round_trips(112, 128), 1)
+        self.assertEqual(sdo_round_trips(231, 128), 2)
+        with self.assertRaises(ValueError):
+            sdo_round_trips(200, 128, segmented_sdo=False)